@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Drives many players from one process, each connection keeping several infection requests in flight,
+and reports the achieved requests per second and the latency distribution.
+
+The players must exist in the database of the server, --generate-players prints entries to append to it:
+    python load_generator.py --generate-players 500 >> ../Server/player_database.data
+    rm ../Server/player_database.db     # the server imports the text database again on start
+    python load_generator.py --host 127.0.0.1 --clients 500 --depth 16 --duration 30
+"""
+import argparse
+import collections
+import os
+import select
+import sys
+import time
+
+CLIENTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Clients')
+SERVER_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server')
+sys.path.insert(0, CLIENTS_DIRECTORY)
+
+from generic_client import PipelinedVirusGameClient, InfectionResult, MUTATION_STRATEGIES, DEFAULT_ROOM, Subscription
+
+GENERATED_PLAYERS_FIRST_ID = 10000
+
+
+def read_player_ids(filename):
+    with open(filename, 'r') as f:
+        return [int(line.split(':')[0]) for line in f if line.strip()]
+
+
+def percentile(ordered, ratio):
+    return ordered[min(len(ordered) - 1, int(ratio * len(ordered)))]
+
+
+def run(clients, duration):
+    by_fd = dict((client.fileno(), client) for client in clients)
+    poller = select.poll()
+    for fd in by_fd:
+        poller.register(fd, select.POLLIN)
+
+    latencies = []
+    successes = 0
+    maximum_reached = 0
+    start = time.time()
+    stop_at = start + duration
+    stopped = False
+
+    while by_fd:
+        now = time.time()
+        if not stopped and now >= stop_at:
+            stopped = True
+            for client in clients:
+                client.stop()
+
+        for fd, client in by_fd.items():
+            client.fill(now)
+            if client.finished():
+                poller.unregister(fd)
+                del by_fd[fd]
+                client.send_end()
+            else:
+                poller.modify(fd, select.POLLIN | (select.POLLOUT if client.wants_write() else 0))
+
+        for fd, events in poller.poll(100):
+            client = by_fd[fd]
+            if events & select.POLLOUT:
+                client.on_writable()
+            if events & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                for latency, result_type, result in client.on_readable(time.time()):
+                    latencies.append(latency)
+                    if result_type == InfectionResult.PLAIN:
+                        successes += result[1]
+                    else:
+                        maximum_reached += 1
+
+    return latencies, successes, maximum_reached, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipelined multi-player load generator.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--players', default=os.path.join(SERVER_DIRECTORY, 'player_database.data'),
+        help="player database to take the ids from")
+    parser.add_argument('--clients', type=int, default=None, help="number of players connected (all the database by default)")
+    parser.add_argument('--depth', type=int, default=16, help="infection requests in flight per connection")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load")
+    parser.add_argument('--mutation', choices=sorted(MUTATION_STRATEGIES), default='aleatoire',
+        help="strategy generating the codes of each player")
+    parser.add_argument('--room', type=int, default=DEFAULT_ROOM, help="room joined by the players")
+    parser.add_argument('--subscribe', action='store_true', help="players subscribe to the notifications of the lost computers and world events")
+    parser.add_argument('--generate-players', type=int, default=None, metavar='COUNT',
+        help="print COUNT player entries for the database and exit")
+    args = parser.parse_args()
+
+    if args.generate_players is not None:
+        for player_id in range(GENERATED_PLAYERS_FIRST_ID, GENERATED_PLAYERS_FIRST_ID + args.generate_players):
+            print "{player_id}:load-{player_id}".format(player_id=player_id)
+        return
+
+    player_ids = read_player_ids(args.players)[:args.clients]
+    clients = [PipelinedVirusGameClient(args.host, player_id, args.depth, mutation=MUTATION_STRATEGIES[args.mutation](), room=args.room)
+        for player_id in player_ids]
+    if args.subscribe:
+        for client in clients:
+            client.subscribe(Subscription.ALL)
+    print "{count} players connected to room {room}, {depth} requests in flight each.".format(count=len(clients), room=args.room, depth=args.depth)
+
+    latencies, successes, maximum_reached, elapsed = run(clients, args.duration)
+    latencies.sort()
+    print "{count} requests in {elapsed:.2f} s: {rate:.0f} requests/s ({successes} infections, {success_rate:.1%} of the requests, {maximum} maximum reached)".format(
+        count=len(latencies), elapsed=elapsed, rate=len(latencies) / elapsed, successes=successes,
+        success_rate=float(successes) / max(1, len(latencies)), maximum=maximum_reached)
+    if latencies:
+        print "latency (ms): min {0:.2f}  p50 {1:.2f}  p90 {2:.2f}  p99 {3:.2f}  p99.9 {4:.2f}  max {5:.2f}".format(
+            *[1000 * value for value in (latencies[0], percentile(latencies, 0.5), percentile(latencies, 0.9),
+                percentile(latencies, 0.99), percentile(latencies, 0.999), latencies[-1])])
+    if args.subscribe:
+        kinds = collections.Counter(kind.name.lower() for client in clients for kind, value, player_id in client.notifications)
+        print "notifications: " + (", ".join("{count} {kind}".format(count=count, kind=kind) for kind, count in sorted(kinds.items())) or "none")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Infection throughput as the number of handler threads grows, with every infection
+serialized on the game lock (as before) or with the network split in lock shards.
+
+Usage: python lock_contention.py [infections per thread]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from threading import Thread, RLock
+
+SERVER_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server')
+sys.path.insert(0, SERVER_DIRECTORY)
+
+from server import GameState, PlayerStore, GAME_PATTERNS, NETWORK_LOCK_SHARDS
+
+THREAD_COUNTS = [1, 2, 4, 8, 16, 32]
+NETWORK_SIZE = 200000
+
+
+def worker(state, player_id, patterns, global_lock):
+    for pattern in patterns:
+        if global_lock is not None:
+            with global_lock:
+                list(state.on_dispatch_infection(player_id, pattern))
+        else:
+            list(state.on_dispatch_infection(player_id, pattern))
+
+
+def measure(threads_count, shards, global_lock, infections):
+    # The bench players are added to a copy of the player database
+    handle, players_filename = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    os.remove(players_filename)
+    PlayerStore.import_text(os.path.join(SERVER_DIRECTORY, 'player_database.data'), players_filename).close()
+    try:
+        return measure_state(threads_count, shards, global_lock, infections, players_filename)
+    finally:
+        os.remove(players_filename)
+
+
+def measure_state(threads_count, shards, global_lock, infections, players_filename):
+    rlock = RLock()
+    state = GameState(rlock, network_size=NETWORK_SIZE, shards=shards, players_filename=players_filename)
+    players = [state.player_manager.add_player("bench-{idx}".format(idx=idx)) for idx in range(threads_count)]
+    patterns = [random.choice(GAME_PATTERNS) for x in xrange(infections)]
+
+    threads = [Thread(target=worker, args=(state, player_id, patterns, rlock if global_lock else None)) for player_id in players]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    state.event_publisher.close(linger=0)
+    return threads_count * infections / elapsed
+
+
+def main():
+    infections = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print "{0:>8} {1:>20} {2:>20}".format("threads", "game lock (inf/s)", "{shards} shards (inf/s)".format(shards=NETWORK_LOCK_SHARDS))
+    for threads_count in THREAD_COUNTS:
+        global_throughput = measure(threads_count, 1, True, infections)
+        sharded_throughput = measure(threads_count, NETWORK_LOCK_SHARDS, False, infections)
+        print "{0:>8} {1:>20.0f} {2:>20.0f}".format(threads_count, global_throughput, sharded_throughput)
+
+if __name__ == '__main__':
+    main()
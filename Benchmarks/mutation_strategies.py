@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Requests a player needs with each mutation strategy of the client, against an in-process network
+(no sockets): success-rate curve and number of requests to own a share of the network.
+
+Usage: python mutation_strategies.py [difficulty] [requests]   (default: the hardest difficulty, 100000 requests)
+"""
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Clients'))
+
+import server
+from server import GAME_PREDICAT_LEVEL, Network
+from generic_client import MUTATION_STRATEGIES
+
+NETWORK_SIZE = 2000
+OWNED_SHARES = [0.25, 0.5, 0.9]
+PLAYER_ID = 2
+
+
+def play(network, mutation, requests):
+    """
+    Returns the number of requests after which each share of OWNED_SHARES of the network was owned (None if never).
+    """
+    owned = 0
+    reached = {}
+    for request_idx in xrange(1, requests + 1):
+        code = mutation.next_code()
+        c_id = network.random_index()
+        success = network.predicat_system(c_id).eval_system(code)
+        mutation.record(code, success)
+        if success and network.state[c_id] != PLAYER_ID:
+            network.set_state(c_id, PLAYER_ID)
+            owned += 1
+            for share in OWNED_SHARES:
+                if share not in reached and owned >= share * network.size:
+                    reached[share] = request_idx
+    return [reached.get(share) for share in OWNED_SHARES]
+
+
+def main():
+    server.GAME_DIFFICULTY = int(sys.argv[1]) if len(sys.argv) > 1 else len(GAME_PREDICAT_LEVEL)
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    seed = random.randrange(2**32)
+
+    print "difficulty {difficulty}, network of {size} computers, {requests} requests".format(difficulty=server.GAME_DIFFICULTY,
+        size=NETWORK_SIZE, requests=requests)
+    for name in sorted(MUTATION_STRATEGIES):
+        # Same network and same targets for every strategy
+        random.seed(seed)
+        network = Network(NETWORK_SIZE, None, None)
+        network.construct_random_network()
+        mutation = MUTATION_STRATEGIES[name]()
+        reached = play(network, mutation, requests)
+        print
+        print "{name}:".format(name=name)
+        lines = mutation.success_curve()
+        for line in lines[:-1][::max(1, len(mutation.curve) // 10)] + lines[-1:]:
+            print "    " + line
+        for share, request_idx in zip(OWNED_SHARES, reached):
+            print "    {share:.0%} of the network owned after {requests} requests".format(share=share,
+                requests=request_idx if request_idx is not None else "more than {0}".format(requests))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Memory and throughput of the array-backed Network against the list-backed representation it replaced.
+
+Usage: python network_representation.py [size ...]   (default sizes: 2000 200000 2000000)
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server'))
+
+from server import GAME_DIFFICULTY, GAME_PREDICAT_LEVEL, GAME_PATTERNS
+from server import Network, NetworkValueState, PredicatSystem
+
+OPERATIONS = 200000
+
+
+class ListNetwork(object):
+    """
+    The former representation: one list entry per computer for the state,
+    one PredicatSystem instance per computer for the predicats.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.state = [NetworkValueState.COMPUTER_ALIVE] * size
+        self.predicat_system = [PredicatSystem(GAME_DIFFICULTY) for x in xrange(size)]
+
+    def construct_random_network(self):
+        for x in xrange(self.size):
+            self.predicat_system[x].construct_random_system(GAME_PREDICAT_LEVEL)
+
+    def set_state(self, c_id, new_state):
+        assert c_id >= 0 and c_id < self.size
+        self.state[c_id] = new_state
+
+    def random_computer(self):
+        idx = random.randint(0, self.size - 1)
+        return (idx, self.state[idx], self.predicat_system[idx])
+
+
+def list_network_memory(network):
+    total = sys.getsizeof(network.state) + sys.getsizeof(network.predicat_system)
+    for predicat_system in network.predicat_system:
+        total += sys.getsizeof(predicat_system) + sys.getsizeof(predicat_system.__dict__) + sys.getsizeof(predicat_system.system)
+    return total
+
+
+def array_network_memory(network):
+    return sys.getsizeof(network.state) + sys.getsizeof(network.predicats)
+
+
+def run_operations(network, patterns):
+    start = time.time()
+    for pattern in patterns:
+        c_id, state, predicat = network.random_computer()
+        if predicat.eval_system(pattern):
+            network.set_state(c_id, 2)
+    return len(patterns) / (time.time() - start)
+
+
+def measure(name, factory, memory, size, patterns):
+    start = time.time()
+    network = factory(size)
+    network.construct_random_network()
+    construction = time.time() - start
+    footprint = memory(network)
+    throughput = run_operations(network, patterns)
+    print "{name:>6} {size:>9} {memory:>12.2f} {construction:>16.3f} {throughput:>14.0f}".format(name=name, size=size,
+        memory=footprint / 1024.0 / 1024.0, construction=construction, throughput=throughput)
+    return footprint
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [2000, 200000, 2000000]
+    patterns = [random.choice(GAME_PATTERNS) for x in xrange(OPERATIONS)]
+
+    print "{0:>6} {1:>9} {2:>12} {3:>16} {4:>14}".format("kind", "size", "memory (MB)", "construction (s)", "infections/s")
+    for size in sizes:
+        list_footprint = measure("list", ListNetwork, list_network_memory, size, patterns)
+        array_footprint = measure("array", lambda size: Network(size, None, None), array_network_memory, size, patterns)
+        print "{0:>6} {1:>9} {2:>11.1f}x".format("ratio", size, float(list_footprint) / array_footprint)
+
+if __name__ == '__main__':
+    main()
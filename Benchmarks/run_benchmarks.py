@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible benchmarks of the server hot paths, in process and over loopback TCP, with a local
+ZeroMQ subscriber standing in for the website. Network size, GAME_DIFFICULTY and the number of
+concurrent clients are swept, every measurement is saved with its parameters in a JSON file:
+    python run_benchmarks.py --output results/before.json
+    python run_benchmarks.py --output results/after.json
+    python run_benchmarks.py --compare results/before.json results/after.json
+
+Latencies are per operation, in milliseconds. For the in-process micro benchmarks
+(eval_system, opcode parsing) they are averaged over each round of operations.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread, RLock
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIRECTORY, '..', 'Server'))
+
+import zmq
+import server
+from server import GAME_PATTERNS, GAME_PREDICAT_LEVEL, ClientOpcode, PlayerManager, PlayerStore, PredicatSystem, Network
+from server import RoomManager, RoomRegistry, VirusGameConnection, VirusGameEventLoopServer, create_listener, NETWORK_CONSTRUCTIONS
+from load_generator import GENERATED_PLAYERS_FIRST_ID, percentile, run as run_clients
+from generic_client import PipelinedVirusGameClient
+
+RESULTS_DIRECTORY = os.path.join(BENCHMARKS_DIRECTORY, 'results')
+
+
+class Results(object):
+
+    def __init__(self):
+        self.records = []
+
+    def add(self, benchmark, params, unit, count, seconds, latencies, **extra):
+        latencies = sorted(latencies)
+        record = {
+            'benchmark': benchmark,
+            'params': params,
+            'unit': unit,
+            'count': count,
+            'seconds': seconds,
+            'throughput': count / seconds,
+            'p50_ms': 1000 * percentile(latencies, 0.5),
+            'p99_ms': 1000 * percentile(latencies, 0.99),
+        }
+        record.update(extra)
+        self.records.append(record)
+        print "{benchmark:<18} {params:<44} {throughput:>14.0f} {unit:<12} p50 {p50:>9.3f} ms  p99 {p99:>9.3f} ms".format(
+            benchmark=benchmark, params=format_params(params), throughput=record['throughput'], unit=unit + "/s",
+            p50=record['p50_ms'], p99=record['p99_ms'])
+
+
+class EventSubscriber(Thread):
+    """
+    Stand-in for the website: subscribes to every event of the game states and counts them.
+    """
+
+    def __init__(self, context):
+        Thread.__init__(self, name="Event subscriber")
+        self.daemon = True
+        self.socket = context.socket(zmq.XSUB)
+        self.port = self.socket.bind_to_random_port('tcp://127.0.0.1')
+        # XSUB subscriptions are messages: 1 followed by the prefix, an empty one for everything
+        self.socket.send(b'\x01')
+        self.received = 0
+
+    def run(self):
+        while True:
+            self.socket.recv()
+            self.received += 1
+
+
+class FakeRequest(object):
+    """
+    Socket of a VirusGameConnection replaying prepared data and discarding the responses.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def recv(self, size):
+        return next(self.chunks)
+
+    def send(self, data):
+        return len(data)
+
+
+class FakeServer(object):
+
+    def __init__(self, state):
+        self.rooms = RoomManager(state, None)
+
+
+def format_params(params):
+    return " ".join("{key}={value}".format(key=key, value=params[key]) for key in sorted(params))
+
+
+def write_players(filename, count):
+    with open(filename, 'w') as f:
+        for player_id in range(GENERATED_PLAYERS_FIRST_ID, GENERATED_PLAYERS_FIRST_ID + count):
+            f.write("{player_id}:bench-{player_id}\n".format(player_id=player_id))
+
+
+def players_store_filename(text_filename):
+    # Player store imported from the text database by the first game state loading it
+    return os.path.splitext(text_filename)[0] + '.db'
+
+
+def make_state(size, difficulty, players_filename, events_port):
+    server.GAME_DIFFICULTY = difficulty
+    return server.GameState(RLock(), network_size=size, event_publisher_port=events_port, players_filename=players_filename)
+
+
+def random_patterns(count):
+    return [random.choice(GAME_PATTERNS) for x in xrange(count)]
+
+
+def bench_eval_system(results, difficulty, rounds=20, per_round=20000):
+    systems = [PredicatSystem(difficulty) for x in range(64)]
+    for system in systems:
+        system.construct_random_system(GAME_PREDICAT_LEVEL)
+    patterns = random_patterns(per_round)
+
+    latencies = []
+    total = 0
+    for round_idx in range(rounds):
+        start = time.time()
+        for idx, pattern in enumerate(patterns):
+            systems[idx & 63].eval_system(pattern)
+        elapsed = time.time() - start
+        latencies.append(elapsed / per_round)
+        total += elapsed
+    results.add('eval_system', {'difficulty': difficulty}, 'evaluations', rounds * per_round, total, latencies)
+
+
+def bench_construct_network(results, size, difficulty, rounds=3):
+    server.GAME_DIFFICULTY = difficulty
+    # Sized through a room registry, like the networks of the rooms
+    registry = RoomRegistry(1, size)
+    registry.define(1, size)
+    for construction in NETWORK_CONSTRUCTIONS:
+        latencies = []
+        for round_idx in range(rounds):
+            network = Network(registry.size(1), None, None, seed=round_idx)
+            start = time.time()
+            network.construct_network(construction)
+            latencies.append(time.time() - start)
+        benchmark = 'construct_network' if construction == 'eager' else 'construct_' + construction
+        results.add(benchmark, {'size': size, 'difficulty': difficulty}, 'computers', rounds * size, sum(latencies), latencies)
+
+
+def bench_load_players(results, count, rounds=5):
+    handle, text_filename = tempfile.mkstemp(suffix='.data')
+    os.close(handle)
+    filename = players_store_filename(text_filename)
+    try:
+        write_players(text_filename, count)
+        start = time.time()
+        PlayerStore.import_text(text_filename, filename).close()
+        elapsed = time.time() - start
+        results.add('import_players', {'players': count}, 'players', count, elapsed, [elapsed])
+
+        latencies = []
+        for round_idx in range(rounds):
+            player_manager = PlayerManager(None)
+            start = time.time()
+            player_manager.load_players(filename)
+            latencies.append(time.time() - start)
+            player_manager.player_list.close()
+    finally:
+        os.remove(text_filename)
+        os.remove(filename)
+    results.add('load_players', {'players': count}, 'players', rounds * count, sum(latencies), latencies)
+
+
+def bench_dispatch_infection(results, subscriber, size, difficulty, players_filename, infections):
+    state = make_state(size, difficulty, players_filename, subscriber.port)
+    events_before = subscriber.received
+    patterns = random_patterns(infections)
+
+    latencies = []
+    for pattern in patterns:
+        start = time.time()
+        for packet in state.on_dispatch_infection(GENERATED_PLAYERS_FIRST_ID, pattern):
+            pass
+        latencies.append(time.time() - start)
+    state.event_publisher.close(linger=0)
+    results.add('dispatch_infection', {'size': size, 'difficulty': difficulty}, 'infections', infections, sum(latencies), latencies,
+        events=subscriber.received - events_before)
+
+
+def bench_opcode_parsing(results, subscriber, size, difficulty, players_filename, frames, batch_size):
+    state = make_state(size, difficulty, players_filename, subscriber.port)
+    patterns = random_patterns(frames * batch_size)
+    if batch_size == 1:
+        data = ''.join(struct.pack('!B8s', ClientOpcode.INFECTION, pattern) for pattern in patterns)
+    else:
+        data = ''.join(struct.pack('!BH' + '8s' * batch_size, ClientOpcode.INFECTION_BATCH, batch_size, *patterns[start:start + batch_size])
+            for start in xrange(0, len(patterns), batch_size))
+    chunk_size = VirusGameConnection.READ_SIZE
+    chunks = [data[start:start + chunk_size] for start in xrange(0, len(data), chunk_size)]
+
+    connection = VirusGameConnection(FakeServer(state), FakeRequest(chunks), ('benchmark', 0))
+    connection.authenticated = True
+    connection.game = state
+    connection.player_id = GENERATED_PLAYERS_FIRST_ID
+    connection.player_name = state.player_manager.name(GENERATED_PLAYERS_FIRST_ID)
+
+    latencies = []
+    total = 0
+    for chunk in chunks:
+        start = time.time()
+        connection.on_readable()
+        elapsed = time.time() - start
+        # Frames are spread evenly over the data
+        latencies.append(elapsed * len(data) / len(chunk) / frames)
+        total += elapsed
+    state.event_publisher.close(linger=0)
+    results.add('opcode_parsing', {'size': size, 'difficulty': difficulty, 'batch': batch_size}, 'frames', frames, total, latencies)
+
+
+def serve(listener, size, difficulty, players_filename, events_port, seed):
+    # Forked: the ZeroMQ context of the parent must not be used here
+    random.seed(seed)
+    server.context = zmq.Context()
+    state = make_state(size, difficulty, players_filename, events_port)
+    VirusGameEventLoopServer(listener.getsockname(), RoomManager(state, None), listener).serve_forever()
+
+
+def bench_loopback(results, subscriber, size, difficulty, players_filename, clients_count, depth, duration, seed):
+    listener = create_listener(('127.0.0.1', 0), VirusGameEventLoopServer.request_queue_size)
+    port = listener.getsockname()[1]
+    process = multiprocessing.Process(target=serve, args=(listener, size, difficulty, players_filename, subscriber.port, seed))
+    process.daemon = True
+    process.start()
+    listener.close()
+
+    events_before = subscriber.received
+    try:
+        clients = [PipelinedVirusGameClient('127.0.0.1', player_id, depth, port)
+            for player_id in range(GENERATED_PLAYERS_FIRST_ID, GENERATED_PLAYERS_FIRST_ID + clients_count)]
+        latencies, successes, maximum_reached, elapsed = run_clients(clients, duration)
+    finally:
+        process.terminate()
+        process.join()
+    results.add('loopback', {'size': size, 'difficulty': difficulty, 'clients': clients_count, 'depth': depth}, 'requests',
+        len(latencies), elapsed, latencies, events=subscriber.received - events_before)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARKS_DIRECTORY).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_filename, after_filename):
+    with open(before_filename, 'r') as f:
+        before = json.load(f)
+    with open(after_filename, 'r') as f:
+        after = json.load(f)
+
+    before_records = dict(((record['benchmark'], format_params(record['params'])), record) for record in before['results'])
+    print "{0:<18} {1:<44} {2:>14} {3:>14} {4:>10} {5:>10}".format("benchmark", "params", "before (/s)", "after (/s)", "speedup", "p99 ratio")
+    for record in after['results']:
+        key = (record['benchmark'], format_params(record['params']))
+        if key not in before_records:
+            continue
+        old = before_records[key]
+        print "{0:<18} {1:<44} {2:>14.0f} {3:>14.0f} {4:>9.2f}x {5:>9.2f}x".format(key[0], key[1], old['throughput'], record['throughput'],
+            record['throughput'] / old['throughput'], record['p99_ms'] / old['p99_ms'] if old['p99_ms'] else float('nan'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the server hot paths.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 200000], help="network sizes")
+    parser.add_argument('--difficulties', type=int, nargs='+', default=[1, 2], help="GAME_DIFFICULTY values")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 100], help="concurrent clients over loopback")
+    parser.add_argument('--depth', type=int, default=8, help="requests in flight per loopback client")
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds of every loopback run")
+    parser.add_argument('--infections', type=int, default=20000, help="infections of the in-process runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="JSON results file (results/<date>.json by default)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two results files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    for difficulty in args.difficulties:
+        if not 1 <= difficulty <= len(GAME_PREDICAT_LEVEL):
+            parser.error("difficulties must be between 1 and {maximum}".format(maximum=len(GAME_PREDICAT_LEVEL)))
+
+    random.seed(args.seed)
+    results = Results()
+    subscriber = EventSubscriber(server.context)
+    subscriber.start()
+
+    handle, text_filename = tempfile.mkstemp(suffix='.data')
+    os.close(handle)
+    write_players(text_filename, max(args.clients))
+    players_filename = players_store_filename(text_filename)
+    try:
+        for difficulty in args.difficulties:
+            bench_eval_system(results, difficulty)
+        for count in (1000, 50000):
+            bench_load_players(results, count)
+        for size in args.sizes:
+            for difficulty in args.difficulties:
+                bench_construct_network(results, size, difficulty)
+                bench_dispatch_infection(results, subscriber, size, difficulty, players_filename, args.infections)
+                for batch_size in (1, 64):
+                    bench_opcode_parsing(results, subscriber, size, difficulty, players_filename, args.infections // batch_size, batch_size)
+                for clients_count in args.clients:
+                    bench_loopback(results, subscriber, size, difficulty, players_filename, clients_count, args.depth, args.duration, args.seed)
+    finally:
+        os.remove(text_filename)
+        if os.path.isfile(players_filename):
+            os.remove(players_filename)
+
+    output = args.output or os.path.join(RESULTS_DIRECTORY, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as f:
+        json.dump({
+            'revision': git_revision(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'arguments': vars(args),
+            'results': results.records,
+        }, f, indent=2, sort_keys=True)
+    print "Results saved in {output}.".format(output=output)
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
+import collections
+import itertools
+import json
 import random
+import select
 import socket
 import struct
 import sys
-import time
 
 from enum import IntEnum
 
@@ -13,6 +16,12 @@ class ClientOpcode(IntEnum):
     AUTH = 1
     INFECTION = 2
     DISCONNECTION = 3
+    INFECTION_BATCH = 4
+    STATS = 5
+    LEADERBOARD = 6
+    AUTH_ROOM = 7
+    CREATE_ROOM = 8
+    SUBSCRIBE = 9
 
 class ServerOpcode(IntEnum):
     RESULT_INFECTION = 1
@@ -21,6 +30,46 @@ class ServerOpcode(IntEnum):
     INFECTION_OCCURRED = 4
     PLAYER_DISCONNECTED = 5
     NETWORK_SIZE_ANNOUNCEMENT = 6
+    RESULT_INFECTION_BATCH = 7
+    STATS = 8
+    LEADERBOARD = 9
+    ROOM_CREATED = 10
+    NOTIFICATION = 11
+
+# Answer to CREATE_ROOM
+class RoomStatus(IntEnum):
+    CREATED = 0
+    EXISTS = 1
+    LIMIT_REACHED = 2
+    INVALID = 3
+
+# AUTH joins the default room, AUTH_ROOM any other one
+DEFAULT_ROOM = 0
+
+# Flags of SUBSCRIBE: what the server pushes in NOTIFICATION frames (0 stops the notifications)
+class Subscription(object):
+    COMPUTERS_LOST = 1
+    WORLD_EVENTS = 2
+    ALL = COMPUTERS_LOST | WORLD_EVENTS
+
+class NotificationKind(IntEnum):
+    COMPUTER_INFECTED = 1       # computer id, id of the player who took it
+    COMPUTER_DETECTED = 2       # computer id, freed by an AV detection
+    RANDOMIZATION_STARTED = 3
+    RANDOMIZATION_ENDED = 4     # computers lost by all the players during the randomization
+    DROPPED = 5                 # notifications dropped by the server, too many were waiting
+
+# NOTIFICATION frames: score of the player and number of records after the opcode, then the records
+NOTIFICATION_HEADER = struct.Struct('!IH')
+NOTIFICATION_RECORD = struct.Struct('!BIH')     # kind, computer id or count, player id
+
+# Maximum number of patterns accepted by the server in one INFECTION_BATCH frame
+MAXIMUM_INFECTION_BATCH = 1024
+# Receive buffer of the clients, larger than any response
+FRAME_BUFFER_SIZE = 65536
+
+# Players listed in a LEADERBOARD reply: id, score and name
+LEADERBOARD_RECORD = struct.Struct('!HI32s')
 
 class InfectionResult(IntEnum):
 	PLAIN = 1
@@ -45,73 +94,418 @@ def generer_code_aleatoire(longueur):
 def generer_mutation(generation):
 	return generer_code_aleatoire(8)
 
+# Letters checked by the computers: the first one and the last SUFFIX_LENGTH
+SUFFIX_LENGTH = 3
+# Results per point of the success-rate curve
+SUCCESS_CURVE_WINDOW = 500
+# Exponent of the sampled success rates: the higher, the less the parts that rarely work are tried
+SAMPLING_SHARPNESS = 3
+
+class RandomMutation(object):
+	"""
+	Uniform random codes, the baseline: every result is only recorded in the success-rate curve.
+	"""
+
+	def __init__(self, window=SUCCESS_CURVE_WINDOW):
+		self.window = window
+		self.attempts = 0
+		self.successes = 0
+		self.window_successes = 0
+		# (attempts, successes in the window, total successes) every window results
+		self.curve = []
+
+	def next_code(self):
+		return generer_mutation(0)
+
+	def record(self, code, success):
+		self.attempts += 1
+		if success:
+			self.successes += 1
+			self.window_successes += 1
+		if self.attempts % self.window == 0:
+			self.curve.append((self.attempts, self.window_successes, self.successes))
+			self.window_successes = 0
+
+	def success_curve(self):
+		lines = ["{attempts:>8} tentatives : {rate:6.2%} de réussite ({total} au total)".format(attempts=attempts,
+			rate=float(window_successes) / self.window, total=total) for attempts, window_successes, total in self.curve]
+		if self.attempts:
+			lines.append("Moyenne : {rate:.2%} de réussite sur {attempts} tentatives".format(
+				rate=float(self.successes) / self.attempts, attempts=self.attempts))
+		return lines
+
+
+class AdaptiveMutation(RandomMutation):
+	"""
+	Learns which parts of the code the computers check work: the first letter and the suffix.
+	A success rate is drawn for each part from its Beta posterior, then a part is picked in proportion
+	to its drawn rate (raised to SAMPLING_SHARPNESS); the letters in between stay random.
+	Picking the best draw only would keep hitting the same computers, already owned after a while:
+	parts that work are mixed so that codes keep reaching every kind of computer accepting them.
+	"""
+
+	def __init__(self, window=SUCCESS_CURVE_WINDOW):
+		RandomMutation.__init__(self, window)
+		self.prefixes = list(ALPHABET_GENETIQUE)
+		self.suffixes = [''.join(letters) for letters in itertools.product(ALPHABET_GENETIQUE, repeat=SUFFIX_LENGTH)]
+		# [successes, failures] per first letter and per suffix
+		self.prefix_results = dict((prefix, [0, 0]) for prefix in self.prefixes)
+		self.suffix_results = dict((suffix, [0, 0]) for suffix in self.suffixes)
+
+	def sample(self, parts, results):
+		weights = [random.betavariate(results[part][0] + 1, results[part][1] + 1) ** SAMPLING_SHARPNESS for part in parts]
+		target = random.random() * sum(weights)
+		for part, weight in zip(parts, weights):
+			target -= weight
+			if target <= 0:
+				return part
+		return parts[-1]
+
+	def next_code(self):
+		return (self.sample(self.prefixes, self.prefix_results)
+			+ generer_code_aleatoire(8 - 1 - SUFFIX_LENGTH)
+			+ self.sample(self.suffixes, self.suffix_results))
+
+	def record(self, code, success):
+		RandomMutation.record(self, code, success)
+		outcome = 0 if success else 1
+		self.prefix_results[code[0]][outcome] += 1
+		self.suffix_results[code[-SUFFIX_LENGTH:]][outcome] += 1
+
+
+MUTATION_STRATEGIES = {'aleatoire': RandomMutation, 'adaptative': AdaptiveMutation}
+
+class FrameReader(object):
+	"""
+	Reads the socket into a reusable buffer with recv_into. read() returns the offset of the next field
+	in the buffer, decoded in place with struct.unpack_from: responses received together need a single recv.
+	"""
+
+	def __init__(self, sock, size=FRAME_BUFFER_SIZE):
+		self.socket = sock
+		self.buffer = bytearray(size)
+		self.view = memoryview(self.buffer)
+		self.start = 0
+		self.end = 0
+
+	def available(self):
+		return self.end - self.start
+
+	def receive(self):
+		"""
+		One recv_into after the bytes not read yet, returns the number of bytes received (0 once the connection is closed).
+		"""
+		if self.start:
+			pending = self.end - self.start
+			self.buffer[:pending] = self.buffer[self.start:self.end]
+			self.start, self.end = 0, pending
+		received = self.socket.recv_into(self.view[self.end:])
+		self.end += received
+		return received
+
+	def read(self, size):
+		if size > len(self.buffer):
+			# Larger than any infection response (statistics): a larger buffer from now on
+			pending = self.end - self.start
+			self.buffer = self.buffer[self.start:self.end] + bytearray(size - pending)
+			self.view = memoryview(self.buffer)
+			self.start, self.end = 0, pending
+		while self.end - self.start < size:
+			if not self.receive():
+				raise Exception("Connection closed by the server.")
+		offset = self.start
+		self.start += size
+		return offset
+
+	def read_string(self, size):
+		offset = self.read(size)
+		return str(self.buffer[offset:offset + size])
+
 class VirusGameClient(object):
 
-	def __init__(self, ip, player_id):
+	def __init__(self, ip, player_id, port=5481, room=DEFAULT_ROOM):
 		TCP_SERVER_IP = ip
-		TCP_PORT = 5481
+		TCP_PORT = port
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket.connect((TCP_SERVER_IP, TCP_PORT))
+		self.reader = FrameReader(self.socket)
+		self.room = room
+		# (kind, computer id or count, player id) of the notifications received and not polled yet, and the last score they carried
+		self.notifications = collections.deque()
+		self.notified_score = None
 
-		packet_auth = struct.pack('!BH', ClientOpcode.AUTH, player_id)
+		if room == DEFAULT_ROOM:
+			packet_auth = struct.pack('!BH', ClientOpcode.AUTH, player_id)
+		else:
+			packet_auth = struct.pack('!BHH', ClientOpcode.AUTH_ROOM, player_id, room)
 		self.socket.sendall(packet_auth)
 
-		opcode, = struct.unpack('!B', self.socket.recv(1))
+		opcode = self.reader.buffer[self.reader.read(1)]
 		if opcode == ServerOpcode.NETWORK_SIZE_ANNOUNCEMENT:
-			self.net_size, = struct.unpack('!I', self.socket.recv(4))
+			self.net_size, = struct.unpack_from('!I', self.reader.buffer, self.reader.read(4))
 		else:
 			raise Exception("Unk opcode: {op}!".format(op=opcode))
 
+	def read_opcode(self):
+		"""
+		Opcode of the next response, the notifications pushed before it being read into self.notifications.
+		"""
+		while True:
+			opcode = self.reader.buffer[self.reader.read(1)]
+			if opcode != ServerOpcode.NOTIFICATION:
+				return opcode
+			self.read_notification()
+
+	def read_notification(self):
+		self.notified_score, count = struct.unpack_from(NOTIFICATION_HEADER.format, self.reader.buffer, self.reader.read(NOTIFICATION_HEADER.size))
+		offset = self.reader.read(count * NOTIFICATION_RECORD.size)
+		for idx in range(count):
+			kind, value, player_id = NOTIFICATION_RECORD.unpack_from(self.reader.buffer, offset + idx * NOTIFICATION_RECORD.size)
+			self.notifications.append((NotificationKind(kind), value, player_id))
+
+	def subscribe(self, flags=Subscription.ALL):
+		# Notifications arrive between the responses, read with them or with poll_notifications
+		self.socket.sendall(struct.pack('!BB', ClientOpcode.SUBSCRIBE, flags))
+
+	def poll_notifications(self, timeout=0):
+		"""
+		Returns the notifications received, waiting at most timeout seconds when there is none.
+		Only between two requests: nothing else than notifications is expected from the server.
+		"""
+		waiting = self.notifications or self.reader.available()
+		readable, writable, errored = select.select([self.socket], [], [], 0 if waiting else timeout)
+		if readable and not self.reader.receive():
+			raise Exception("Connection closed by the server.")
+		while self.reader.available():
+			opcode = self.reader.buffer[self.reader.read(1)]
+			if opcode != ServerOpcode.NOTIFICATION:
+				raise Exception("Unk opcode: {op}!".format(op=opcode))
+			self.read_notification()
+		notifications = list(self.notifications)
+		self.notifications.clear()
+		return notifications
+
 	def send_infection(self, code):
 		packet_code = struct.pack('!B8s', ClientOpcode.INFECTION, code)
 		self.socket.sendall(packet_code)
 
-		data = self.socket.recv(1)
-		if data == '':
+		if not self.reader.available() and not self.reader.receive():
 			print "Failed to infect."
 			return None
 
-		opcode, = struct.unpack('!B', data)
+		opcode = self.read_opcode()
 		if opcode == ServerOpcode.RESULT_INFECTION:
-			result = struct.unpack('!II', self.socket.recv(8))
+			result = struct.unpack_from('!II', self.reader.buffer, self.reader.read(8))
 			return InfectionResult.PLAIN, result
 		elif opcode == ServerOpcode.MAXIMUM_INFECTION:
-			result, = struct.unpack('!I', self.socket.recv(4))
+			result, = struct.unpack_from('!I', self.reader.buffer, self.reader.read(4))
 			return InfectionResult.MAXIMUM_REACHED, result
 		else:
 			return None
 
+	def send_infection_batch(self, codes):
+		assert 0 < len(codes) <= MAXIMUM_INFECTION_BATCH
+		packet_codes = struct.pack('!BH' + '8s' * len(codes), ClientOpcode.INFECTION_BATCH, len(codes), *codes)
+		self.socket.sendall(packet_codes)
+
+		if not self.reader.available() and not self.reader.receive():
+			print "Failed to infect."
+			return None
+
+		opcode = self.read_opcode()
+		received = self.reader.buffer
+		if opcode == ServerOpcode.RESULT_INFECTION_BATCH:
+			score, count = struct.unpack_from('!IH', received, self.reader.read(6))
+			offset = self.reader.read((count + 7) // 8)
+			results = [bool(received[offset + (idx >> 3)] & (1 << (idx & 7))) for idx in range(count)]
+			return InfectionResult.PLAIN, (score, results)
+		elif opcode == ServerOpcode.MAXIMUM_INFECTION:
+			result, = struct.unpack_from('!I', received, self.reader.read(4))
+			return InfectionResult.MAXIMUM_REACHED, result
+		else:
+			return None
+
+	def send_stats(self):
+		# Only answered to the clients connected from a local address
+		self.socket.sendall(struct.pack('!B', ClientOpcode.STATS))
+		opcode = self.read_opcode()
+		if opcode != ServerOpcode.STATS:
+			raise Exception("Unk opcode: {op}!".format(op=opcode))
+		length, = struct.unpack_from('!I', self.reader.buffer, self.reader.read(4))
+		return json.loads(self.reader.read_string(length))
+
+	def send_create_room(self, room, net_size):
+		# Only answered to the clients connected from a local address, returns a RoomStatus
+		self.socket.sendall(struct.pack('!BHI', ClientOpcode.CREATE_ROOM, room, net_size))
+		opcode = self.read_opcode()
+		if opcode != ServerOpcode.ROOM_CREATED:
+			raise Exception("Unk opcode: {op}!".format(op=opcode))
+		created_room, status = struct.unpack_from('!HB', self.reader.buffer, self.reader.read(3))
+		return RoomStatus(status)
+
+	def send_leaderboard(self, count):
+		"""
+		Returns the rank and the score of the player, then the (id, score, name) of the count best players.
+		"""
+		self.socket.sendall(struct.pack('!BH', ClientOpcode.LEADERBOARD, count))
+		opcode = self.read_opcode()
+		if opcode != ServerOpcode.LEADERBOARD:
+			raise Exception("Unk opcode: {op}!".format(op=opcode))
+		rank, score, listed = struct.unpack_from('!IIH', self.reader.buffer, self.reader.read(10))
+		offset = self.reader.read(listed * LEADERBOARD_RECORD.size)
+		players = [LEADERBOARD_RECORD.unpack_from(self.reader.buffer, offset + idx * LEADERBOARD_RECORD.size) for idx in range(listed)]
+		return rank, score, [(player_id, player_score, name.rstrip('\0')) for player_id, player_score, name in players]
+
 	def send_end(self):
 		packet_end = struct.pack('!B', ClientOpcode.DISCONNECTION)
 		self.socket.sendall(packet_end)
 
 
+class PipelinedVirusGameClient(VirusGameClient):
+	"""
+	Non-blocking client keeping up to depth infection requests in flight: new patterns are sent
+	without waiting for the previous results, which the server sends back in order.
+	The socket is driven by the caller (select, poll...) through on_writable and on_readable.
+	The codes come from the mutation strategy, which gets every result back.
+	Notifications pushed between the results are kept in self.notifications.
+	"""
+
+	def __init__(self, ip, player_id, depth, port=5481, mutation=None, room=DEFAULT_ROOM):
+		VirusGameClient.__init__(self, ip, player_id, port, room)
+		self.depth = depth
+		self.mutation = mutation or RandomMutation()
+		self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.socket.setblocking(0)
+		self.write_buffer = bytearray()
+		self.sent_at = collections.deque()
+		self.sent_codes = collections.deque()
+		self.running = True
+
+	def fileno(self):
+		return self.socket.fileno()
+
+	def fill(self, now):
+		while self.running and len(self.sent_at) < self.depth:
+			code = self.mutation.next_code()
+			self.write_buffer += struct.pack('!B8s', ClientOpcode.INFECTION, code)
+			self.sent_at.append(now)
+			self.sent_codes.append(code)
+
+	def wants_write(self):
+		return len(self.write_buffer) > 0
+
+	def on_writable(self):
+		sent = self.socket.send(self.write_buffer)
+		del self.write_buffer[:sent]
+
+	def on_readable(self, now):
+		"""
+		Returns the (latency, result type, result) of every complete answer received.
+		"""
+		if not self.reader.receive():
+			raise Exception("Connection closed by the server.")
+
+		received = self.reader.buffer
+		results = []
+		while self.reader.available():
+			opcode = received[self.reader.start]
+			if opcode == ServerOpcode.NOTIFICATION:
+				if self.reader.available() < 1 + NOTIFICATION_HEADER.size:
+					break
+				count, = struct.unpack_from('!H', received, self.reader.start + 5)
+				if self.reader.available() < 1 + NOTIFICATION_HEADER.size + count * NOTIFICATION_RECORD.size:
+					break
+				self.reader.read(1)
+				self.read_notification()
+				continue
+			elif opcode == ServerOpcode.RESULT_INFECTION:
+				size = 9
+			elif opcode == ServerOpcode.MAXIMUM_INFECTION:
+				size = 5
+			else:
+				raise Exception("Unk opcode: {op}!".format(op=opcode))
+			if self.reader.available() < size:
+				break
+
+			offset = self.reader.read(size)
+			latency = now - self.sent_at.popleft()
+			code = self.sent_codes.popleft()
+			if opcode == ServerOpcode.RESULT_INFECTION:
+				result = struct.unpack_from('!II', received, offset + 1)
+				self.mutation.record(code, result[1])
+				results.append((latency, InfectionResult.PLAIN, result))
+			else:
+				results.append((latency, InfectionResult.MAXIMUM_REACHED, struct.unpack_from('!I', received, offset + 1)[0]))
+		return results
+
+	def stop(self):
+		self.running = False
+
+	def finished(self):
+		return not self.running and not self.sent_at
+
+	def send_end(self):
+		self.socket.setblocking(1)
+		VirusGameClient.send_end(self)
+
+
 def main():
 	player_id = int(sys.argv[1])
 	ip = "80.112.131.85" # Default server
 	nb_tentatives = 1
+	taille_lot = 1
+	strategie = 'adaptative'
+	salle = DEFAULT_ROOM
 	if len(sys.argv) > 2:
 		ip = sys.argv[2]
 	if len(sys.argv) > 3:
 		nb_tentatives = int(sys.argv[3])
+	if len(sys.argv) > 4:
+		taille_lot = min(int(sys.argv[4]), MAXIMUM_INFECTION_BATCH)
+	if len(sys.argv) > 5:
+		strategie = sys.argv[5]
+	if len(sys.argv) > 6:
+		salle = int(sys.argv[6])
+	mutation = MUTATION_STRATEGIES[strategie]()
 
-	generation_i = 0
-
-	Running = True
-
-	client = VirusGameClient(ip, player_id)
-	print "Processus d'infection démarré!"
-	for tentative_i in range(nb_tentatives*client.net_size):
-		code_genetique = generer_mutation(generation_i)
-		type_resultat, resultat = client.send_infection(code_genetique)
-		if resultat is not None:
-			if type_resultat == InfectionResult.PLAIN:
-				print """
+	client = VirusGameClient(ip, player_id, room=salle)
+	print "Processus d'infection démarré dans la salle {salle}!".format(salle=salle)
+	if taille_lot > 1:
+		nb_total = nb_tentatives*client.net_size
+		for debut_lot in range(0, nb_total, taille_lot):
+			codes_genetiques = [mutation.next_code() for x in range(min(taille_lot, nb_total - debut_lot))]
+			type_resultat, resultat = client.send_infection_batch(codes_genetiques)
+			if resultat is not None:
+				if type_resultat == InfectionResult.PLAIN:
+					for code_genetique, reussite in zip(codes_genetiques, resultat[1]):
+						mutation.record(code_genetique, reussite)
+					print """
+				Résultat des générations {gi} à {gf} ({cur}/{max}) : {ok} infection(s) réussie(s) sur {nb}
+				""".format(gi=debut_lot+1, gf=debut_lot+len(codes_genetiques), cur=resultat[0], max=client.net_size,
+						ok=sum(resultat[1]), nb=len(codes_genetiques))
+				elif type_resultat == InfectionResult.MAXIMUM_REACHED:
+					print 'Resultat de la génération {}:\n\tTous les ordinateurs ont été infecté avec succès : {}.'.format(debut_lot, resultat)
+					break
+	else:
+		for tentative_i in range(nb_tentatives*client.net_size):
+			code_genetique = mutation.next_code()
+			type_resultat, resultat = client.send_infection(code_genetique)
+			if resultat is not None:
+				if type_resultat == InfectionResult.PLAIN:
+					mutation.record(code_genetique, resultat[1])
+					print """
 				Résultat de la génération {gi} ({cur}/{max}) : infection {msg}
 				""".format(gi=tentative_i+1, cur=resultat[0], max=client.net_size, msg=("Réussie" if resultat[1] else "Ratée"))
-			elif type_resultat == InfectionResult.MAXIMUM_REACHED:
-				print 'Resultat de la génération {}:\n\tTous les ordinateurs ont été infecté avec succès : {}.'.format(tentative_i, resultat)
+				elif type_resultat == InfectionResult.MAXIMUM_REACHED:
+					print 'Resultat de la génération {}:\n\tTous les ordinateurs ont été infecté avec succès : {}.'.format(tentative_i, resultat)
 	print "Processus d'infection terminé!"
+	print "Taux de réussite (stratégie {strategie}, par tranche de {fenetre} tentatives) :".format(strategie=strategie, fenetre=mutation.window)
+	for ligne in mutation.success_curve():
+		print "\t" + ligne
+	rang, score, meilleurs = client.send_leaderboard(5)
+	print "Classement : {rang}e avec {score} ordinateur(s).".format(rang=rang, score=score)
+	for position, (joueur_id, score_joueur, nom) in enumerate(meilleurs):
+		print "\t{position}. {nom} (id: {joueur_id}) : {score}".format(position=position + 1, nom=nom, joueur_id=joueur_id, score=score_joueur)
 	client.send_end()
 
 if __name__ == '__main__':
@@ -0,0 +1,354 @@
+"""
+Append-only archive of the infections of a game, for the analysis once the game is over.
+
+Every infection attempt (successful or not) and every computer lost is a fixed-width record stored
+in columns: a segment file holds SEGMENT_CAPACITY records, one column after the other, so a query
+maps the segments and reads only the columns it needs (as numpy arrays when numpy is installed).
+Each process writes its own segments, named after it, and several games may share a directory:
+the queries are about one game, the last one by default. A record takes 23 bytes (a segment 1.5 MB):
+a writer given a limit deletes its oldest segments beyond it.
+
+Usage: python event_archive.py <directory> scores <bucket> | prefixes <length> | games
+"""
+import argparse
+import collections
+import glob
+import itertools
+import logging
+import mmap
+import os
+import struct
+from array import array
+from threading import Thread, Event, Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+game_events = logging.getLogger('Game Events')
+
+# Kind of every record: a failed or successful infection attempt, or a computer lost by its owner
+ARCHIVE_FAILURE = 0
+ARCHIVE_INFECTION = 1
+ARCHIVE_LOSS = 2
+
+# Codes of the patterns, as encoded by the server (base 4 number, first letter first), -1 for an invalid pattern
+PATTERN_ALPHABET = "UGCA"
+PATTERN_LENGTH = 8
+NO_PATTERN = -1
+
+# Segment file: a header padded to SEGMENT_HEADER_SIZE then the columns, each one aligned on the width of its values.
+# The number of records is written after the records: a record beyond it is not complete.
+SEGMENT_MAGIC = 'VGARCH'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct('=6sBxIdI')     # magic, version, number of records, game start time, capacity
+SEGMENT_HEADER_SIZE = 64
+SEGMENT_EXTENSION = '.seg'
+SEGMENT_CAPACITY = 2**16
+# Columns in the order of the fields of a record, stored widest first
+ARCHIVE_COLUMNS = [('timestamp', 'd'), ('player', 'H'), ('computer', 'I'), ('score', 'I'), ('pattern', 'i'), ('kind', 'B')]
+SEGMENT_LAYOUT = sorted(ARCHIVE_COLUMNS, key=lambda column: -array(column[1]).itemsize)
+ARCHIVE_FLUSH_INTERVAL = 0.5
+
+
+def column_offset(name, capacity):
+    offset = SEGMENT_HEADER_SIZE
+    for column, typecode in SEGMENT_LAYOUT:
+        if column == name:
+            return offset
+        offset += array(typecode).itemsize * capacity
+    raise KeyError(name)
+
+
+def segment_size(capacity):
+    return SEGMENT_HEADER_SIZE + sum(array(typecode).itemsize for column, typecode in ARCHIVE_COLUMNS) * capacity
+
+
+def decode_prefix(code, length):
+    letters = []
+    for idx in range(length):
+        code, digit = divmod(code, len(PATTERN_ALPHABET))
+        letters.append(PATTERN_ALPHABET[digit])
+    return ''.join(reversed(letters))
+
+
+class EventArchive(object):
+    """
+    Writer of the archive of one game. The game only queues (timestamp, player id, computer id, score,
+    pattern, kind) records, a background thread encodes the patterns with encode (None and invalid patterns
+    as NO_PATTERN) and appends the records to the segment every interval seconds.
+    At most limit bytes of segments of this writer are kept (0: no limit), the oldest ones being deleted first.
+    """
+
+    def __init__(self, directory, start_time, encode, capacity=SEGMENT_CAPACITY, interval=ARCHIVE_FLUSH_INTERVAL, limit=0):
+        self.directory = directory
+        self.start_time = start_time
+        self.encode = encode
+        self.capacity = capacity
+        self.interval = interval
+        self.limit = limit
+        self.writer = None
+        self.pending = collections.deque()
+        self.lock = Lock()
+        self.file = None
+        self.mapping = None
+        self.count = 0
+        self.stopped = None
+        self.thread = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self, writer='main'):
+        # Also called again in forked worker processes, with a name of their own: the segment of the parent is left to it
+        self.writer = writer
+        self.pending = collections.deque()
+        self.lock = Lock()
+        self.file = None
+        self.mapping = None
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name="Event archive")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, record):
+        self.pending.append(record)
+
+    def extend(self, records):
+        self.pending.extend(records)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                game_events.exception("Failed to archive a batch of events.")
+
+    def flush(self):
+        with self.lock:
+            records = [self.pending.popleft() for idx in xrange(len(self.pending))]
+            written = 0
+            while written < len(records):
+                if self.mapping is None or self.count == self.capacity:
+                    self.open_segment()
+                chunk = records[written:written + self.capacity - self.count]
+                self.write(chunk)
+                written += len(chunk)
+
+    def write(self, records):
+        for (name, typecode), values in itertools.izip(ARCHIVE_COLUMNS, itertools.izip(*records)):
+            if name == 'pattern':
+                values = [NO_PATTERN if code is None else code for code in itertools.imap(self.encode, values)]
+            data = array(typecode, values).tostring()
+            offset = column_offset(name, self.capacity) + self.count * array(typecode).itemsize
+            self.mapping[offset:offset + len(data)] = data
+        self.count += len(records)
+        SEGMENT_HEADER.pack_into(self.mapping, 0, SEGMENT_MAGIC, SEGMENT_VERSION, self.count, self.start_time, self.capacity)
+
+    def open_segment(self):
+        self.close_segment()
+        segments = sorted((int(os.path.basename(filename)[len(self.writer) + 1:-len(SEGMENT_EXTENSION)]), filename)
+            for filename in glob.glob(os.path.join(self.directory, self.writer + '-*' + SEGMENT_EXTENSION)))
+        if self.limit:
+            # Room for the new segment
+            kept = max(0, self.limit // segment_size(self.capacity) - 1)
+            for sequence, filename in segments[:max(0, len(segments) - kept)]:
+                os.remove(filename)
+        filename = os.path.join(self.directory, '{writer}-{sequence:06d}{extension}'.format(writer=self.writer,
+            sequence=segments[-1][0] + 1 if segments else 1, extension=SEGMENT_EXTENSION))
+        self.file = open(filename, 'w+b')
+        self.file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, 0, self.start_time, self.capacity))
+        # Sparse until written
+        self.file.truncate(segment_size(self.capacity))
+        self.mapping = mmap.mmap(self.file.fileno(), 0)
+        self.count = 0
+
+    def close_segment(self):
+        if self.mapping is not None:
+            self.mapping.flush()
+            self.mapping.close()
+            self.file.close()
+            self.mapping = None
+            self.file = None
+
+    def close(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        with self.lock:
+            self.close_segment()
+
+
+class Segment(object):
+    """
+    A segment file mapped read-only, its columns being the records written so far.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.start_time, self.capacity = SEGMENT_HEADER.unpack_from(self.mapping, 0)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise Exception("{filename} is not an archive segment!".format(filename=filename))
+
+    def column(self, name):
+        typecode = dict(ARCHIVE_COLUMNS)[name]
+        offset = column_offset(name, self.capacity)
+        if numpy is not None:
+            return numpy.frombuffer(self.mapping, dtype=numpy.dtype(typecode), count=self.count, offset=offset)
+        values = array(typecode)
+        values.fromstring(self.mapping[offset:offset + self.count * values.itemsize])
+        return values
+
+    def close(self):
+        self.mapping.close()
+        self.file.close()
+
+
+class ArchiveReader(object):
+    """
+    Queries over the segments of an archive directory, one segment mapped at a time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def games(self):
+        # Start times of the games archived, in order
+        return sorted(set(start_time for start_time, filename in self.headers()))
+
+    def headers(self):
+        for filename in sorted(glob.glob(os.path.join(self.directory, '*' + SEGMENT_EXTENSION))):
+            try:
+                with open(filename, 'rb') as f:
+                    magic, version, count, start_time, capacity = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+            except IOError:
+                # Deleted by its writer, beyond its limit
+                continue
+            if magic == SEGMENT_MAGIC and version == SEGMENT_VERSION and count:
+                yield start_time, filename
+
+    def segments(self, start_time=None):
+        """
+        Segments of the game started at start_time (the last one by default).
+        """
+        headers = list(self.headers())
+        if start_time is None and headers:
+            start_time = max(game for game, filename in headers)
+        for game, filename in headers:
+            if game == start_time:
+                segment = Segment(filename)
+                try:
+                    yield segment
+                finally:
+                    segment.close()
+
+    def scores_per_bucket(self, bucket, start_time=None):
+        """
+        Score of every player at the end of every bucket of time of the game (buckets of bucket clock units
+        from the start of the game) as {player id: [(timestamp, score), ...]}, the timestamp being that of
+        the last record of the player in the bucket.
+        """
+        last = {}
+        for segment in self.segments(start_time):
+            timestamps, players, scores = segment.column('timestamp'), segment.column('player'), segment.column('score')
+            if numpy is not None:
+                buckets = ((timestamps - segment.start_time) // bucket).astype(numpy.int64)
+                keys = (players.astype(numpy.int64) << 32) | buckets
+                # Sorted by key then by timestamp: the last record of every key ends its run
+                order = numpy.lexsort((timestamps, keys))
+                ends = order[numpy.append(keys[order][1:] != keys[order][:-1], True)]
+                found = itertools.izip(keys[ends].tolist(), timestamps[ends].tolist(), scores[ends].tolist())
+            else:
+                found = {}
+                for timestamp, player_id, score in itertools.izip(timestamps, players, scores):
+                    key = (player_id << 32) | int((timestamp - segment.start_time) // bucket)
+                    if key not in found or found[key][0] <= timestamp:
+                        found[key] = (timestamp, score)
+                found = ((key, timestamp, score) for key, (timestamp, score) in found.iteritems())
+            for key, timestamp, score in found:
+                if key not in last or last[key][0] <= timestamp:
+                    last[key] = (timestamp, score)
+
+        per_player = {}
+        for key in sorted(last):
+            per_player.setdefault(key >> 32, []).append(last[key])
+        return per_player
+
+    def success_rate_per_prefix(self, length, start_time=None):
+        """
+        Number of attempts and of successful infections of the patterns of every prefix of length letters,
+        as {prefix: (attempts, successes)} for the prefixes tried at least once.
+        """
+        divisor = len(PATTERN_ALPHABET) ** (PATTERN_LENGTH - length)
+        prefixes = len(PATTERN_ALPHABET) ** length
+        attempts = [0] * prefixes
+        successes = [0] * prefixes
+        for segment in self.segments(start_time):
+            patterns, kinds = segment.column('pattern'), segment.column('kind')
+            if numpy is not None:
+                tried = (patterns >= 0) & (kinds != ARCHIVE_LOSS)
+                codes = patterns[tried] // divisor
+                attempts = numpy.bincount(codes, minlength=prefixes) + attempts
+                successes = numpy.bincount(codes[kinds[tried] == ARCHIVE_INFECTION], minlength=prefixes) + successes
+            else:
+                for pattern, kind in itertools.izip(patterns, kinds):
+                    if pattern >= 0 and kind != ARCHIVE_LOSS:
+                        attempts[pattern // divisor] += 1
+                        successes[pattern // divisor] += kind == ARCHIVE_INFECTION
+        return dict((decode_prefix(code, length), (int(attempts[code]), int(successes[code])))
+            for code in xrange(prefixes) if attempts[code])
+
+    def last_timestamp(self, start_time=None):
+        last = None
+        for segment in self.segments(start_time):
+            timestamps = segment.column('timestamp')
+            segment_last = timestamps.max() if numpy is not None else max(timestamps)
+            last = segment_last if last is None else max(last, segment_last)
+        return last
+
+    def chart_history(self, history_length, start_time=None):
+        """
+        Points of the realtime chart of the last game (elapsed time, score), at most history_length per player,
+        returned with the start time of the game. None when nothing is archived.
+        """
+        games = self.games()
+        if not games:
+            return None
+        start_time = start_time or games[-1]
+        bucket = max(1, (self.last_timestamp(start_time) - start_time) // history_length + 1)
+        points = {}
+        for player_id, scores in self.scores_per_bucket(bucket, start_time).iteritems():
+            points[player_id] = [[int(timestamp) - int(start_time), score] for timestamp, score in scores[-history_length:]]
+        return start_time, points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queries over an event archive (archive directory of a room).")
+    parser.add_argument('directory')
+    parser.add_argument('--game', type=float, default=None, help="start time of the game (the last one by default)")
+    subparsers = parser.add_subparsers(dest='query')
+    scores = subparsers.add_parser('scores', help="score of every player per time bucket")
+    scores.add_argument('bucket', type=float, help="bucket width in game clock units")
+    prefixes = subparsers.add_parser('prefixes', help="success rate per pattern prefix")
+    prefixes.add_argument('length', type=int, choices=range(1, PATTERN_LENGTH + 1))
+    subparsers.add_parser('games', help="start times of the games archived")
+    args = parser.parse_args()
+
+    reader = ArchiveReader(args.directory)
+    if args.query == 'games':
+        for start_time in reader.games():
+            print "{start_time:.3f}".format(start_time=start_time)
+    elif args.query == 'scores':
+        for player_id, scores in sorted(reader.scores_per_bucket(args.bucket, args.game).iteritems()):
+            print "{player_id}: {scores}".format(player_id=player_id, scores=" ".join(str(score) for timestamp, score in scores))
+    elif args.query == 'prefixes':
+        for prefix, (attempts, successes) in sorted(reader.success_rate_per_prefix(args.length, args.game).iteritems()):
+            print "{prefix}  {successes:>8}/{attempts:<8} {rate:.1%}".format(prefix=prefix, successes=successes, attempts=attempts,
+                rate=float(successes) / attempts)
+
+if __name__ == '__main__':
+    main()
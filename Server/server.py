@@ -5,16 +5,34 @@ import time
 # Network
 import zmq
 import SocketServer
+import socket
+import select
+import errno
 
 # Serialization
 import struct
+import json
 
 # Utils
+from array import array
+import ctypes
+import mmap
+import binascii
+import multiprocessing
 from functools import partial
+import itertools
+import operator
 import dis
-from threading import Thread, Timer, RLock
+from threading import Thread, Event, Lock, RLock, local, current_thread
+import collections
+import heapq
 import os
+import sys
+import signal
+import Queue
+from multiprocessing import reduction
 from enum import IntEnum
+from event_archive import EventArchive, ARCHIVE_FAILURE, ARCHIVE_INFECTION, ARCHIVE_LOSS
 
 # Logging utils
 import logging
@@ -27,6 +45,12 @@ class ClientOpcode(IntEnum):
     AUTH = 1
     INFECTION = 2
     DISCONNECTION = 3
+    INFECTION_BATCH = 4
+    STATS = 5
+    LEADERBOARD = 6
+    AUTH_ROOM = 7
+    CREATE_ROOM = 8
+    SUBSCRIBE = 9
 
 class ServerOpcode(IntEnum):
     RESULT_INFECTION = 1
@@ -35,6 +59,46 @@ class ServerOpcode(IntEnum):
     INFECTION_OCCURRED = 4
     PLAYER_DISCONNECTED = 5
     NETWORK_SIZE_ANNOUNCEMENT = 6
+    RESULT_INFECTION_BATCH = 7
+    STATS = 8
+    LEADERBOARD = 9
+    ROOM_CREATED = 10
+    NOTIFICATION = 11
+
+# Maximum number of patterns accepted in one INFECTION_BATCH frame
+MAXIMUM_INFECTION_BATCH = 1024
+# Receive buffer of a connection, larger than any frame
+FRAME_BUFFER_SIZE = 65536
+
+# Answer to CREATE_ROOM
+class RoomStatus(IntEnum):
+    CREATED = 0
+    EXISTS = 1
+    LIMIT_REACHED = 2
+    INVALID = 3
+
+# Flags of SUBSCRIBE: what is pushed to the player in NOTIFICATION frames (0 stops the notifications)
+class Subscription(object):
+    COMPUTERS_LOST = 1
+    WORLD_EVENTS = 2
+    ALL = COMPUTERS_LOST | WORLD_EVENTS
+
+# Records of a NOTIFICATION frame, after its header (score of the player, number of records)
+class NotificationKind(IntEnum):
+    COMPUTER_INFECTED = 1       # computer id, id of the player who took it
+    COMPUTER_DETECTED = 2       # computer id, freed by an AV detection
+    RANDOMIZATION_STARTED = 3
+    RANDOMIZATION_ENDED = 4     # computers lost by all the players during the randomization
+    DROPPED = 5                 # records dropped since the previous frame, NOTIFICATION_QUEUE_LIMIT were already waiting
+
+NOTIFICATION_HEADER = struct.Struct('!BIH')     # opcode, score, number of records
+NOTIFICATION_RECORD = struct.Struct('!BIH')     # kind, computer id or count, player id
+# Records per NOTIFICATION frame, records waiting per player, and seconds between two batches
+MAXIMUM_NOTIFICATIONS = 1024
+NOTIFICATION_QUEUE_LIMIT = 4096
+NOTIFICATION_INTERVAL = 0.05
+# Bytes of notifications waiting for a connection of the threaded engine which does not read them, frames pushed beyond are dropped
+NOTIFICATION_BACKLOG_LIMIT = 2**16
 
 
 # GAME CONSTANTS
@@ -52,64 +116,368 @@ GAME_PREDICAT_LEVEL = [ [lambda x: x[0] == 'G',
                         lambda x: x.endswith("CCC")] ]
 GAME_DIFFICULTY = 1
 
+# LOCKING
+# Lock order, outermost first:
+#   1. the game lock (GameState.rlock, one per room) for authentication and online flags,
+#   2. one network shard lock (Network.shard_lock), held while a computer changes owner,
+#   3. one score lock (PlayerManager.score_lock), never two at once: when an infection takes
+#      a computer from another player, their score is updated and released before ours is taken.
+#      It also guards the list of the computers owned by the player (Network.owned),
+#   4. the leaderboard lock, alone: a score change only marks the player, ranked again when the leaderboard is read,
+#   5. the event publisher lock, only around the ZeroMQ send (from the event publisher thread when events are coalesced).
+# The checkpointer alone takes every shard lock at once, in index order, for the time of a memory copy.
+NETWORK_LOCK_SHARDS = 64
+SCORE_LOCK_STRIPES = 64
+
+# World events: chance of an AV detection on each computer during a network randomization,
+# done in slices of WORLD_SLICE_SIZE computers every WORLD_SLICE_INTERVAL seconds
+AV_DETECTION_CHANCE = 0.5
+WORLD_SLICE_SIZE = 1024
+WORLD_SLICE_INTERVAL = 0.01
+
+# Patterns sent by the players: GAME_PATTERN_LENGTH letters of GAME_PATTERN_ALPHABET
+GAME_PATTERN_ALPHABET = "UGCA"
+GAME_PATTERN_LENGTH = 8
+GAME_PATTERN_SPACE = len(GAME_PATTERN_ALPHABET) ** GAME_PATTERN_LENGTH
+
+# Player ids are 16 bits
+PLAYER_ID_SPACE = 2**16
+# End of the lists of owned computers
+NO_COMPUTER = -1
+# Most players listed in one LEADERBOARD reply, each one as a record
+MAXIMUM_LEADERBOARD = 1024
+LEADERBOARD_RECORD = struct.Struct('!HI32s')    # player id, score, name
+# Rooms: AUTH joins the default room, AUTH_ROOM any room id below MAXIMUM_ROOMS
+DEFAULT_ROOM = 0
+MAXIMUM_ROOMS = 256
+# Regions changed since the last checkpoint are tracked per block of computers (a page of owners) and per block of player ids
+CHECKPOINT_BLOCK_SHIFT = 11
+CHECKPOINT_SCORE_BLOCK_SHIFT = 10
+# Network construction: eager (one random draw per predicat), bulk (seeded chunks of NETWORK_CHUNK_SIZE computers,
+# optionally in a pool of processes) or lazy (the predicats of a computer drawn from the seed on its first use, LAZY_PREDICAT until then)
+NETWORK_CONSTRUCTIONS = ('eager', 'bulk', 'lazy')
+NETWORK_CHUNK_SIZE = 2**20
+LAZY_PREDICAT = 0xFF
+
 # LOGGERS
 network_events = logging.getLogger('Network Events')
 game_events = logging.getLogger('Game Events')
 api_events = logging.getLogger('API Events')
 
+
+class LogMessage(object):
+    """
+    Message formatted with str.format when a handler emits the record, not when it is logged:
+    a dropped record costs the creation of this object only.
+    """
+    __slots__ = ('fmt', 'kwargs')
+
+    def __init__(self, fmt, **kwargs):
+        self.fmt = fmt
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return self.fmt.format(**self.kwargs)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts the records in the queue of a LogWriter (logging.handlers has no QueueHandler before Python 3.2).
+    """
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            self.writer.records.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(object):
+    """
+    Background thread formatting and writing the records of the loggers attached to it,
+    so the threads serving players never do disk I/O, especially while holding a game lock.
+    """
+
+    def __init__(self):
+        self.records = Queue.Queue()
+        self.handlers = {}
+        self.thread = None
+
+    def attach(self, logger, handlers):
+        self.handlers[logger.name] = handlers
+        logger.addHandler(QueueHandler(self))
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="Log writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def restart_after_fork(self):
+        # The writer thread of the parent does not exist in a forked process
+        if self.thread is not None:
+            self.records = Queue.Queue()
+            self.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            record = self.records.get()
+            if record is None:
+                return
+            for handler in self.handlers[record.name]:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+log_writer = LogWriter()
+
 # NETWORK ZMQ CONTEXT
 context = zmq.Context()
 
-class PredicatSystem:
-    class PredicatSystemEval:
-        def __init__(self, system, arg):
-            self.system = system
-            self.arg = arg
+# Every pattern of the space, indexed by its code (base 4 number, one digit per letter)
+GAME_PATTERNS = [''.join(letters) for letters in itertools.product(GAME_PATTERN_ALPHABET, repeat=GAME_PATTERN_LENGTH)]
+_PATTERN_CODES = dict(itertools.izip(GAME_PATTERNS, itertools.count()))
+
+def encode_pattern(pattern):
+    """
+    Code of a pattern in the pattern space, or None if it is not GAME_PATTERN_LENGTH letters of the alphabet.
+    """
+    return _PATTERN_CODES.get(pattern)
+
+def decode_pattern(code):
+    return GAME_PATTERNS[code]
+
+
+class CompiledPredicatSystem(object):
+    """
+    Acceptance table of a system of predicats: one byte per pattern of the pattern space.
+    Every predicat is evaluated once over the whole space, then systems are the AND of their predicats.
+    Compiled systems are shared, there is at most one per distinct combination of predicats.
+    """
+    _predicat_tables = {}
+    _systems = {}
+
+    @classmethod
+    def get(cls, system):
+        key = tuple(system)
+        compiled = cls._systems.get(key)
+        if compiled is None:
+            compiled = cls._systems.setdefault(key, cls(key))
+        return compiled
+
+    @classmethod
+    def predicat_table(cls, predicat):
+        table = cls._predicat_tables.get(predicat)
+        if table is None:
+            table = bytearray(bool(predicat(pattern)) for pattern in GAME_PATTERNS)
+            cls._predicat_tables[predicat] = table
+        return table
+
+    def __init__(self, system):
+        self.system = system
+        self.table = bytearray([1]) * GAME_PATTERN_SPACE
+        for predicat in system:
+            if predicat is not PredicatSystem.always_true:
+                self.table = bytearray(itertools.imap(operator.and_, self.table, self.predicat_table(predicat)))
+
+    def eval_code(self, code):
+        return self.table[code] == 1
 
-        def __nonzero__(self):
-            val = True
-            for pred in self.system:
-                val = val and pred(self.arg)
-            return val
+    def eval_system(self, arg):
+        code = _PATTERN_CODES.get(arg)
+        if code is None:
+            # Not a pattern of the space, only the predicats themselves know the answer
+            return all(pred(arg) for pred in self.system)
+        return self.table[code] == 1
+
+# Stands for a computer whose predicats are not drawn yet in a batch evaluated without the shard locks
+UNDRAWN_SYSTEM = CompiledPredicatSystem.get(())
 
-        def __repr__(self):
-            return "<Eval: (system={syst}, arg={arg})>".format(syst=self.system, arg=self.arg)
 
+class PredicatSystem:
 
+    @staticmethod
     def always_true(arg):
         return True
 
+    @staticmethod
+    def eval_many(systems, patterns):
+        """
+        Evaluate patterns[i] against systems[i] (compiled systems or predicat systems)
+        and return a bytearray of results. Batch infections and simulations use this.
+        """
+        codes = map(_PATTERN_CODES.get, patterns)
+        if None not in codes:
+            return PredicatSystem.eval_codes(systems, codes)
+        return bytearray([system.eval_system(pattern) for system, pattern in itertools.izip(systems, patterns)])
+
+    @staticmethod
+    def eval_codes(systems, codes):
+        return bytearray([system.table[code] for system, code in itertools.izip(systems, codes)])
+
     def __init__(self, difficulty):
         self.difficulty = difficulty
         self.system = [PredicatSystem.always_true] * self.difficulty
+        self.compiled = CompiledPredicatSystem.get(self.system)
+
+    @property
+    def table(self):
+        return self.compiled.table
 
     def set_difficulty(self, new_difficulty):
         self.system = [PredicatSystem.always_true] * new_difficulty
         self.difficulty = new_difficulty
+        self.compiled = CompiledPredicatSystem.get(self.system)
 
     def construct_random_system(self, predicats_available_level):
-        game_events.debug("Constructing random system of predicats with difficulty of {diff}...".format(diff=self.difficulty))
+        game_events.debug(LogMessage("Constructing random system of predicats with difficulty of {diff}...", diff=self.difficulty))
         for level_idx in range(self.difficulty):
             predicats_available = predicats_available_level[level_idx]
             self.system[level_idx] = random.choice(predicats_available)
+        self.compiled = CompiledPredicatSystem.get(self.system)
 
     def eval_system(self, arg):
-        return self.PredicatSystemEval(self.system, arg)
+        code = _PATTERN_CODES.get(arg)
+        if code is None:
+            return self.compiled.eval_system(arg)
+        return self.compiled.table[code] == 1
+
+
+class OwnershipIndex(object):
+    """
+    Computers owned by every player, as doubly linked lists threaded through arrays of the network size:
+    a computer is added or removed in O(1) and the computers of a player are listed in O(owned computers).
+    The list of a player is only changed under their score lock, with the shard lock of a computer held.
+    The blocks of computers whose links changed are tracked for the checkpoints (the heads are written
+    with the scores of the same player ids).
+    """
+
+    def __init__(self, size):
+        self.next = array('i', [NO_COMPUTER]) * size
+        self.previous = array('i', [NO_COMPUTER]) * size
+        self.head = array('i', [NO_COMPUTER]) * PLAYER_ID_SPACE
+        self.dirty = bytearray((size + (1 << CHECKPOINT_BLOCK_SHIFT) - 1) >> CHECKPOINT_BLOCK_SHIFT)
+
+    def add(self, player_id, c_id):
+        head = self.head[player_id]
+        self.next[c_id] = head
+        self.previous[c_id] = NO_COMPUTER
+        self.dirty[c_id >> CHECKPOINT_BLOCK_SHIFT] = 1
+        if head != NO_COMPUTER:
+            self.previous[head] = c_id
+            self.dirty[head >> CHECKPOINT_BLOCK_SHIFT] = 1
+        self.head[player_id] = c_id
+
+    def remove(self, player_id, c_id):
+        previous, next_c_id = self.previous[c_id], self.next[c_id]
+        if previous != NO_COMPUTER:
+            self.next[previous] = next_c_id
+            self.dirty[previous >> CHECKPOINT_BLOCK_SHIFT] = 1
+        else:
+            self.head[player_id] = next_c_id
+        if next_c_id != NO_COMPUTER:
+            self.previous[next_c_id] = previous
+            self.dirty[next_c_id >> CHECKPOINT_BLOCK_SHIFT] = 1
+        self.next[c_id] = self.previous[c_id] = NO_COMPUTER
+        self.dirty[c_id >> CHECKPOINT_BLOCK_SHIFT] = 1
+
+    def clear(self, player_id):
+        # Unlink every computer of the player at once
+        for c_id in list(self.computers(player_id)):
+            self.next[c_id] = self.previous[c_id] = NO_COMPUTER
+            self.dirty[c_id >> CHECKPOINT_BLOCK_SHIFT] = 1
+        self.head[player_id] = NO_COMPUTER
+
+    def computers(self, player_id):
+        c_id = self.head[player_id]
+        while c_id != NO_COMPUTER:
+            yield c_id
+            c_id = self.next[c_id]
+
+    def rebuild(self, state):
+        for c_id, owner in enumerate(state):
+            if owner != NetworkValueState.COMPUTER_ALIVE:
+                self.add(owner, c_id)
+
+    def share_memory(self):
+        shared = []
+        for values in (self.next, self.previous, self.head):
+            shared_values = multiprocessing.RawArray('i', len(values))
+            ctypes.memmove(shared_values, array_address(values), len(values) * values.itemsize)
+            shared.append(shared_values)
+        self.next, self.previous, self.head = shared
+        shared_dirty = multiprocessing.RawArray('b', len(self.dirty))
+        ctypes.memmove(shared_dirty, str(self.dirty), len(self.dirty))
+        self.dirty = shared_dirty
+
+
+def generate_predicats(chunk):
+    """
+    Predicat records of a chunk of computers, as a string of count * len(level_sizes) bytes, from a generator seeded
+    with the network seed and the chunk index: the same network whatever the number of processes generating it.
+    Random bytes are mapped to the predicats of each level by a translation table (exactly uniform when the
+    number of predicats divides 256, like the 4 of every level).
+    """
+    seed, chunk_idx, count, level_sizes = chunk
+    rng = random.Random((seed << 32) | chunk_idx)
+    records = array('B', [0]) * (count * len(level_sizes))
+    for level_idx, predicats_available in enumerate(level_sizes):
+        table = ''.join(chr(byte * predicats_available >> 8) for byte in range(256))
+        data = binascii.unhexlify('%0*x' % (count * 2, rng.getrandbits(count * 8))).translate(table)
+        records[level_idx::len(level_sizes)] = array('B', data)
+    return records.tostring()
+
+def computer_hash(seed, index):
+    # SplitMix64 of the network seed and the computer index
+    z = (seed + (index + 1) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return z ^ (z >> 31)
 
 
 class Network:
+    """
+    Computers of the game world, stored in flat typed arrays:
+    state holds the owner of every computer (a player id, or COMPUTER_ALIVE when nobody owns it),
+    predicats holds the system of every computer as a record of one byte per difficulty level,
+    each byte being the index of the chosen predicat in GAME_PREDICAT_LEVEL (LAZY_PREDICAT for a computer
+    of a lazy network never used yet).
+    """
+
     def always_true(arg):
         return True
 
     def _init(self, size):
         self.size = size
-        self.state = [NetworkValueState.COMPUTER_ALIVE] * size
-        self.predicat_system = [PredicatSystem(GAME_DIFFICULTY)] * size
-
-    def __init__(self, size, game, rlock):
+        self.state = array('H', [NetworkValueState.COMPUTER_ALIVE]) * size
+        self.predicats = array('B', [0]) * (size * self.difficulty)
+        self.systems = {}
+        # Blocks of computers whose owner or predicats changed since the last checkpoint
+        self.dirty = bytearray((size + (1 << CHECKPOINT_BLOCK_SHIFT) - 1) >> CHECKPOINT_BLOCK_SHIFT)
+        self.dirty_predicats = bytearray(len(self.dirty))
+        # Computers owned by every player
+        self.owned = OwnershipIndex(size)
+        # Computers are split in contiguous shards, each one with its own lock
+        self.shard_size = max(1, -(-size // self.shards))
+        self.shard_locks = [Lock() for x in range(-(-size // self.shard_size))]
+
+    def __init__(self, size, game, rlock, shards=NETWORK_LOCK_SHARDS, seed=None, difficulty=None):
+        self.shards = shards
+        # Levels of predicats of every computer, GAME_DIFFICULTY by default
+        self.difficulty = difficulty if difficulty is not None else GAME_DIFFICULTY
         self._init(size)
         self.game = game
         self.rlock = rlock
+        # Seed of the bulk and lazy constructions
+        self.seed = seed if seed is not None else random.randrange(2**32)
 
     def set_new_size(self, size):
         self._init(size)
@@ -117,44 +485,517 @@ class Network:
     def set_state(self, c_id, new_state):
         assert c_id >= 0 and c_id < self.size
         self.state[c_id] = new_state
+        self.dirty[c_id >> CHECKPOINT_BLOCK_SHIFT] = 1
+
+    def shard_lock(self, c_id):
+        return self.shard_locks[c_id // self.shard_size]
+
+    def predicat_system(self, index):
+        # Called with the shard lock of the computer held: a lazy computer is drawn now
+        start = index * self.difficulty
+        if self.predicats[start] == LAZY_PREDICAT:
+            self.construct_lazy_computer(index)
+        return self._compiled_system(start)
+
+    def drawn_system(self, index, default=None):
+        # Without the shard lock: the system of the computer if its predicats are drawn, default otherwise
+        start = index * self.difficulty
+        if self.predicats[start] == LAZY_PREDICAT:
+            return default
+        return self._compiled_system(start)
+
+    def _compiled_system(self, start):
+        record = tuple(self.predicats[start:start + self.difficulty])
+        compiled = self.systems.get(record)
+        if compiled is None:
+            system = [GAME_PREDICAT_LEVEL[level_idx][predicat_idx] for level_idx, predicat_idx in enumerate(record)]
+            compiled = self.systems.setdefault(record, CompiledPredicatSystem.get(system))
+        return compiled
+
+    def construct_random_computer(self, index):
+        # The first level is written last, as in construct_lazy_computer: readers without the lock see a complete record
+        start = index * self.difficulty
+        for level_idx in reversed(range(self.difficulty)):
+            self.predicats[start + level_idx] = random.randrange(len(GAME_PREDICAT_LEVEL[level_idx]))
+        self.dirty_predicats[index >> CHECKPOINT_BLOCK_SHIFT] = 1
+
+    def construct_lazy_computer(self, index):
+        # Always the same predicats for a computer of a given seed: threads or processes drawing them at once write the same bytes.
+        # The first level, checked against LAZY_PREDICAT, is written last.
+        value = computer_hash(self.seed, index)
+        start = index * self.difficulty
+        for level_idx in reversed(range(self.difficulty)):
+            predicats_available = len(GAME_PREDICAT_LEVEL[level_idx])
+            self.predicats[start + level_idx] = (value >> (8 * level_idx)) % predicats_available
+        self.dirty_predicats[index >> CHECKPOINT_BLOCK_SHIFT] = 1
+
+    def construct_network(self, construction='eager', processes=0):
+        if construction == 'eager':
+            self.construct_random_network(random.Random(self.seed))
+        elif construction == 'bulk':
+            self.construct_bulk_network(processes)
+        elif construction == 'lazy':
+            self.construct_lazy_network()
+        else:
+            raise Exception("Unknown network construction {construction}!".format(construction=construction))
+
+    def construct_bulk_network(self, processes=0):
+        """
+        Generate the predicats from the seed in chunks of NETWORK_CHUNK_SIZE computers, in a pool of processes when processes > 1.
+        """
+        game_events.debug(LogMessage("Constructing a network (size {network_size}) in chunks of {chunk_size} computers...", network_size=self.size,
+            chunk_size=NETWORK_CHUNK_SIZE))
+        level_sizes = [len(GAME_PREDICAT_LEVEL[level_idx]) for level_idx in range(self.difficulty)]
+        assert max(level_sizes) < LAZY_PREDICAT
+        chunks = [(self.seed, chunk_idx, int(min(NETWORK_CHUNK_SIZE, self.size - start)), level_sizes)
+            for chunk_idx, start in enumerate(xrange(0, self.size, NETWORK_CHUNK_SIZE))]
+        pool = multiprocessing.Pool(processes) if processes > 1 and len(chunks) > 1 else None
+        try:
+            generated = pool.imap(generate_predicats, chunks) if pool is not None else itertools.imap(generate_predicats, chunks)
+            for chunk_idx, records in enumerate(generated):
+                start = chunk_idx * NETWORK_CHUNK_SIZE * self.difficulty
+                self.predicats[start:start + len(records)] = array('B', records)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.dirty[:] = '\x01' * len(self.dirty)
+        self.dirty_predicats[:] = '\x01' * len(self.dirty_predicats)
+        self.compile_systems()
+        game_events.debug("Network constructed.")
 
-    def construct_random_network(self):
-        game_events.debug("Constructing a random network (size {network_size}) with a system of predicats...".format(network_size=self.size))
-        for x in range(self.size):
-            self.predicat_system[x].construct_random_system(GAME_PREDICAT_LEVEL)
+    def construct_lazy_network(self):
+        # Nothing is drawn now: predicat_system draws the predicats of a computer from the seed on its first use
+        game_events.debug(LogMessage("Network (size {network_size}) will be constructed on first use of every computer.", network_size=self.size))
+        self.predicats = array('B', [LAZY_PREDICAT]) * (self.size * self.difficulty)
+        self.dirty[:] = '\x01' * len(self.dirty)
+        self.dirty_predicats[:] = '\x01' * len(self.dirty_predicats)
+        self.compile_systems()
+
+    def construct_random_network(self, rng=random):
+        """
+        Draw the predicats of every computer, from rng (the random module by default, a seeded random.Random for reproducible networks).
+        """
+        game_events.debug(LogMessage("Constructing a random network (size {network_size}) with a system of predicats...", network_size=self.size))
+        for level_idx in range(self.difficulty):
+            predicats_available = len(GAME_PREDICAT_LEVEL[level_idx])
+            assert predicats_available <= 256
+            uniform = rng.random
+            for x in xrange(level_idx, self.size * self.difficulty, self.difficulty):
+                self.predicats[x] = int(uniform() * predicats_available)
+        for block_idx in range(len(self.dirty)):
+            self.dirty[block_idx] = 1
+            self.dirty_predicats[block_idx] = 1
+        self.compile_systems()
         game_events.debug("Network constructed.")
 
-    def randomize_network(self):
-        game_events.info("Network randomization procedure has been started.")
-        for x in range(self.size):
-            chance_av_detection_trigger = 50.0/100.0 # 50% of chance
-            triggered = random.uniform(0, 1) >= chance_av_detection_trigger
-            if triggered:
-                game_events.info("AV detection on {network_id} caused {player_name} lost the computer.".format(network_id=x,
-                    player_name=self.game.player_manager.name(self.network_state[x])))
-                self.predicat_system[x].construct_random_system(GAME_PREDICAT_LEVEL)
-                self.make_alive(x)
-        game_events.info("Network randomization has ended.")
+    def compile_systems(self):
+        # Compile every possible system now rather than on the first infections
+        for record in itertools.product(*[range(len(GAME_PREDICAT_LEVEL[level_idx])) for level_idx in range(self.difficulty)]):
+            self.systems[record] = CompiledPredicatSystem.get([GAME_PREDICAT_LEVEL[level_idx][predicat_idx] for level_idx, predicat_idx in enumerate(record)])
+
+    def share_memory(self):
+        """
+        Move the arrays and the shard locks to shared memory, so that worker processes
+        forked afterwards all work on the same computers.
+        """
+        shared_state = multiprocessing.RawArray('H', self.size)
+        ctypes.memmove(shared_state, self.state.buffer_info()[0], self.size * self.state.itemsize)
+        shared_predicats = multiprocessing.RawArray('B', len(self.predicats))
+        ctypes.memmove(shared_predicats, self.predicats.buffer_info()[0], len(self.predicats) * self.predicats.itemsize)
+
+        shared_dirty = multiprocessing.RawArray('b', len(self.dirty))
+        ctypes.memmove(shared_dirty, str(self.dirty), len(self.dirty))
+        shared_dirty_predicats = multiprocessing.RawArray('b', len(self.dirty_predicats))
+        ctypes.memmove(shared_dirty_predicats, str(self.dirty_predicats), len(self.dirty_predicats))
+
+        self.state = shared_state
+        self.predicats = shared_predicats
+        self.dirty = shared_dirty
+        self.dirty_predicats = shared_dirty_predicats
+        self.owned.share_memory()
+        self.shard_locks = [multiprocessing.Lock() for lock in self.shard_locks]
+
+    def randomize_network(self, start=0, end=None, chance=AV_DETECTION_CHANCE):
+        """
+        AV detection over the computers start to end: each one is triggered with the given chance,
+        gets new predicats and is freed. Only one shard lock is held at a time.
+        Returns the (player id, computer id, score) of every computer a player lost.
+        """
+        end = self.size if end is None else min(end, self.size)
+        lost = []
+        while start < end:
+            shard_end = min(end, (start // self.shard_size + 1) * self.shard_size)
+            with self.shard_lock(start):
+                for x in xrange(start, shard_end):
+                    if random.random() < chance:
+                        owner = self.state[x]
+                        self.construct_random_computer(x)
+                        score = self.detect(x)
+                        if score is not None:
+                            lost.append((owner, x, score))
+                            if game_events.isEnabledFor(logging.DEBUG):
+                                game_events.debug(LogMessage("AV detection on {network_id} caused {player_name} lost the computer.", network_id=x,
+                                    player_name=self.game.player_manager.name(owner)))
+            start = shard_end
+        return lost
+
+    def detect(self, index):
+        # AV detection of a computer which got new predicats, called with its shard lock held: it is freed,
+        # returns the new score of the player who owned it (None if it was free)
+        owner = self.state[index]
+        self.make_alive(index)
+        if owner != NetworkValueState.COMPUTER_ALIVE:
+            return self.game.player_manager.lose_computer(owner, index)
+        return None
 
     def make_alive(self, index):
         self.state[index] = NetworkValueState.COMPUTER_ALIVE
+        self.dirty[index >> CHECKPOINT_BLOCK_SHIFT] = 1
+
+    def release_computers(self, player_id):
+        # Every computer of the player becomes free: the list is read first, the shard locks being outer
+        with self.game.player_manager.score_lock(player_id):
+            computers = list(self.owned.computers(player_id))
+        for c_id in computers:
+            with self.shard_lock(c_id):
+                # Taken by another player in between otherwise
+                if self.state[c_id] == player_id:
+                    self.make_alive(c_id)
+                    self.game.player_manager.lose_computer(player_id, c_id)
+
+    def random_index(self):
+        return int(random.random() * self.size)
 
     def random_computer(self):
-        idx = random.randint(0, self.size - 1)
-        return (idx, self.state[idx], self.predicat_system[idx])
+        idx = int(random.random() * self.size)
+        with self.shard_lock(idx):
+            return (idx, self.state[idx], self.predicat_system(idx))
+
+    def __iter__(self):
+        # Each shard is copied under its lock, then yielded without holding anything
+        for shard_idx, lock in enumerate(self.shard_locks):
+            start = shard_idx * self.shard_size
+            end = min(start + self.shard_size, self.size)
+            with lock:
+                states = self.state[start:end]
+                systems = [self.predicat_system(idx) for idx in xrange(start, end)]
+            for value, system in itertools.izip(states, systems):
+                yield (value, system)
+
+class PlayerTable(object):
+    """
+    Dict-like table of values indexed by player id, over an array of the whole id space
+    (moved to shared memory for worker processes). The players are those of the player store.
+    """
+
+    def __init__(self, values, players):
+        self.values = values
+        self.players = players
+
+    def __contains__(self, player_id):
+        return player_id in self.players
+
+    def __getitem__(self, player_id):
+        if player_id not in self.players:
+            raise KeyError(player_id)
+        return self.values[player_id]
+
+    def __setitem__(self, player_id, value):
+        self.values[player_id] = value
+
+    def __delitem__(self, player_id):
+        self.values[player_id] = 0
+
+    def get(self, player_id, default=None):
+        return self.values[player_id] if player_id in self.players else default
+
+    def items(self):
+        return [(player_id, self.values[player_id]) for player_id in self.players]
+
+
+# Player store file: a header, an index of the whole id space (record number + 1, 0 for no player)
+# then fixed-width records in creation order. A deleted player leaves a tombstone record.
+PLAYER_STORE_MAGIC = 'VGPLYR'
+PLAYER_STORE_VERSION = 1
+PLAYER_STORE_HEADER = struct.Struct('=6sBxI')   # magic, version, number of records
+PLAYER_STORE_INDEX = struct.Struct('=I')
+PLAYER_RECORD = struct.Struct('=HB32s')         # player id, alive (0 for a tombstone), name
+PLAYER_NAME_LENGTH = 32
+PLAYER_STORE_INDEX_OFFSET = PLAYER_STORE_HEADER.size
+PLAYER_STORE_RECORDS_OFFSET = PLAYER_STORE_INDEX_OFFSET + PLAYER_ID_SPACE * PLAYER_STORE_INDEX.size
+
+
+class PlayerStore(object):
+    """
+    Binary player database, memory-mapped and read lazily: opening it costs the same
+    whatever the number of players, a lookup is one index entry and one record.
+    Added players are appended and flushed to disk before being indexed, deleted ones are tombstoned.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        # Names by record number: records never change once written
+        self.names = {}
+        self.file = open(filename, 'r+b')
+        self.mapping = mmap.mmap(self.file.fileno(), 0)
+        magic, version, self.records = PLAYER_STORE_HEADER.unpack_from(self.mapping, 0)
+        if magic != PLAYER_STORE_MAGIC or version != PLAYER_STORE_VERSION:
+            raise Exception("{filename} is not a player store!".format(filename=filename))
+        self.recover()
+
+    @staticmethod
+    def create(filename):
+        with open(filename, 'wb') as f:
+            f.write(PLAYER_STORE_HEADER.pack(PLAYER_STORE_MAGIC, PLAYER_STORE_VERSION, 0))
+            f.write('\0' * (PLAYER_STORE_RECORDS_OFFSET - PLAYER_STORE_INDEX_OFFSET))
+            f.flush()
+            os.fsync(f.fileno())
+        return PlayerStore(filename)
+
+    @staticmethod
+    def import_text(text_filename, filename):
+        """
+        One-shot import of the former text database, one "id:name" line per player.
+        """
+        store = PlayerStore.create(filename)
+        with open(text_filename, 'r') as f:
+            for line in f:
+                if line.strip():
+                    player_id, player_name = map(str.strip, line.split(":"))
+                    store.add(int(player_id), player_name, sync=False)
+        store.sync()
+        return store
+
+    def recover(self):
+        # Records written by an add interrupted before the index update are indexed now
+        on_disk = (len(self.mapping) - PLAYER_STORE_RECORDS_OFFSET) // PLAYER_RECORD.size
+        if on_disk == self.records:
+            return
+        for number in range(self.records + 1, on_disk + 1):
+            player_id, alive, player_name = PLAYER_RECORD.unpack_from(self.mapping, self.record_offset(number))
+            if alive:
+                PLAYER_STORE_INDEX.pack_into(self.mapping, PLAYER_STORE_INDEX_OFFSET + player_id * PLAYER_STORE_INDEX.size, number)
+        self.records = on_disk
+        PLAYER_STORE_HEADER.pack_into(self.mapping, 0, PLAYER_STORE_MAGIC, PLAYER_STORE_VERSION, self.records)
+        self.sync()
+
+    def record_offset(self, number):
+        return PLAYER_STORE_RECORDS_OFFSET + (number - 1) * PLAYER_RECORD.size
+
+    def record_number(self, player_id):
+        if not 0 <= player_id < PLAYER_ID_SPACE:
+            return 0
+        return PLAYER_STORE_INDEX.unpack_from(self.mapping, PLAYER_STORE_INDEX_OFFSET + player_id * PLAYER_STORE_INDEX.size)[0]
+
+    def __contains__(self, player_id):
+        return self.record_number(player_id) != 0
+
+    def __getitem__(self, player_id):
+        number = self.record_number(player_id)
+        if not number:
+            raise KeyError(player_id)
+        player_name = self.names.get(number)
+        if player_name is None:
+            offset = self.record_offset(number)
+            if offset + PLAYER_RECORD.size > len(self.mapping):
+                # Appended by another process since this one mapped the file
+                self.mapping = mmap.mmap(self.file.fileno(), 0)
+            player_name = PLAYER_RECORD.unpack_from(self.mapping, offset)[2].rstrip('\0')
+            self.names[number] = player_name
+        return player_name
+
+    def __iter__(self):
+        index = array('I')
+        index.fromstring(self.mapping[PLAYER_STORE_INDEX_OFFSET:PLAYER_STORE_RECORDS_OFFSET])
+        return (player_id for player_id, number in enumerate(index) if number)
+
+    def __len__(self):
+        return sum(1 for player_id in self)
+
+    def add(self, player_id, player_name, sync=True):
+        if len(player_name) > PLAYER_NAME_LENGTH:
+            raise ValueError("Player names are at most {length} bytes long.".format(length=PLAYER_NAME_LENGTH))
+        with self.lock:
+            if player_id in self:
+                raise KeyError(player_id)
+            number = self.records + 1
+            offset = self.record_offset(number)
+            self.mapping.resize(offset + PLAYER_RECORD.size)
+            PLAYER_RECORD.pack_into(self.mapping, offset, player_id, 1, player_name)
+            if sync:
+                self.sync()
+            # Indexed only once the record is on disk
+            PLAYER_STORE_INDEX.pack_into(self.mapping, PLAYER_STORE_INDEX_OFFSET + player_id * PLAYER_STORE_INDEX.size, number)
+            self.records = number
+            PLAYER_STORE_HEADER.pack_into(self.mapping, 0, PLAYER_STORE_MAGIC, PLAYER_STORE_VERSION, self.records)
+            if sync:
+                self.sync()
+
+    def remove(self, player_id):
+        with self.lock:
+            number = self.record_number(player_id)
+            if not number:
+                raise KeyError(player_id)
+            # Tombstone: the record is kept, marked as not alive, and left out of the index
+            struct.pack_into('=B', self.mapping, self.record_offset(number) + 2, 0)
+            PLAYER_STORE_INDEX.pack_into(self.mapping, PLAYER_STORE_INDEX_OFFSET + player_id * PLAYER_STORE_INDEX.size, 0)
+            self.sync()
+
+    def sync(self):
+        self.mapping.flush()
+
+    def close(self):
+        self.mapping.close()
+        self.file.close()
+
+
+class SharedClock(object):
+    """
+    Game clock shared by worker processes, iterated like itertools.count.
+    """
+
+    def __init__(self, start):
+        self.value = multiprocessing.Value('d', start - 1)
 
     def __iter__(self):
-        for idx, value in enumerate(self.state):
-            with self.rlock:
-                yield (value, self.predicat_system[idx])
+        return self
+
+    def next(self):
+        with self.value.get_lock():
+            self.value.value += 1
+            return self.value.value
+
+
+class Leaderboard(object):
+    """
+    Players ranked by score, best first. Players of the same score are contiguous: a score going up
+    (or down) by one swaps the player with the first (or last) one of their score block, which then
+    moves to the next block. An update is O(1) per step and the top players are a slice of the ranking.
+    Infections only mark the players whose score changed, without any lock: they are ranked again
+    with their current score by refresh, before the leaderboard is read.
+    """
+
+    def __init__(self, max_score):
+        self.ranking = array('H', [0]) * PLAYER_ID_SPACE
+        self.position = array('i', [0]) * PLAYER_ID_SPACE
+        # First position and number of players of every score
+        self.first = array('i', [0]) * (max_score + 2)
+        self.count = array('i', [0]) * (max_score + 2)
+        self.length = array('i', [0])
+        # Score every player is ranked with, players whose score changed since
+        self.scores = array('i', [0]) * PLAYER_ID_SPACE
+        self.changed = array('b', [0]) * PLAYER_ID_SPACE
+        self.lock = Lock()
+
+    def rebuild(self, scores):
+        for position, (player_id, score) in enumerate(sorted(scores, key=operator.itemgetter(1), reverse=True)):
+            self.ranking[position] = player_id
+            self.position[player_id] = position
+            self.scores[player_id] = score
+            if not self.count[score]:
+                self.first[score] = position
+            self.count[score] += 1
+        self.length[0] = len(scores)
+
+    def _swap(self, position, other):
+        player_id, other_player_id = self.ranking[position], self.ranking[other]
+        self.ranking[position], self.ranking[other] = other_player_id, player_id
+        self.position[other_player_id], self.position[player_id] = position, other
+
+    def _increment(self, player_id, score):
+        first = self.first[score]
+        self._swap(self.position[player_id], first)
+        self.count[score] -= 1
+        self.first[score] = first + 1
+        if not self.count[score + 1]:
+            self.first[score + 1] = first
+        self.count[score + 1] += 1
+
+    def _decrement(self, player_id, score):
+        last = self.first[score] + self.count[score] - 1
+        self._swap(self.position[player_id], last)
+        self.count[score] -= 1
+        self.first[score - 1] = last
+        self.count[score - 1] += 1
+
+    def _move(self, player_id, new_score):
+        score = self.scores[player_id]
+        for step in xrange(score, new_score):
+            self._increment(player_id, step)
+        for step in xrange(score, new_score, -1):
+            self._decrement(player_id, step)
+        self.scores[player_id] = new_score
+
+    def mark(self, player_id):
+        self.changed[player_id] = 1
+
+    def refresh(self, scores):
+        # Rank the marked players with their score in scores (a player marked again meanwhile is ranked by the next refresh)
+        with self.lock:
+            changed = ctypes.string_at(array_address(self.changed), PLAYER_ID_SPACE)
+            player_id = changed.find('\x01')
+            while player_id != -1:
+                self.changed[player_id] = 0
+                self._move(player_id, scores[player_id])
+                player_id = changed.find('\x01', player_id + 1)
+
+    def add(self, player_id):
+        # New players have no computer: last of the ranking
+        with self.lock:
+            position = self.length[0]
+            self.ranking[position] = player_id
+            self.position[player_id] = position
+            self.scores[player_id] = 0
+            self.changed[player_id] = 0
+            if not self.count[0]:
+                self.first[0] = position
+            self.count[0] += 1
+            self.length[0] = position + 1
+
+    def remove(self, player_id):
+        with self.lock:
+            self.changed[player_id] = 0
+            self._move(player_id, 0)
+            last = self.length[0] - 1
+            self._swap(self.position[player_id], last)
+            self.count[0] -= 1
+            self.length[0] = last
+
+    def rank(self, score):
+        # Players of the same score share their rank
+        return self.first[score] + 1
+
+    def top(self, count):
+        with self.lock:
+            return [self.ranking[position] for position in xrange(min(count, self.length[0]))]
+
+    def share_memory(self):
+        shared = []
+        for values, typecode in ((self.ranking, 'H'), (self.position, 'i'), (self.first, 'i'), (self.count, 'i'), (self.length, 'i'),
+                (self.scores, 'i'), (self.changed, 'b')):
+            shared_values = multiprocessing.RawArray(typecode, len(values))
+            ctypes.memmove(shared_values, array_address(values), len(values) * values.itemsize)
+            shared.append(shared_values)
+        self.ranking, self.position, self.first, self.count, self.length, self.scores, self.changed = shared
+        self.lock = multiprocessing.Lock()
+
 
 class PlayerManager:
 
-    def __init__(self, game):
-        self.player_list = {}
-        self.player_score = {}
-        self.player_positions = {}
-        self.players_online = {}
+    def __init__(self, game, score_stripes=SCORE_LOCK_STRIPES):
+        # Set by load_players: the player store, then scores and online flags of the whole id space
+        self.player_list = None
+        self.player_score = None
+        self.players_online = None
+        # Number of players online, for the limit of players of a room
+        self.online_players = array('i', [0])
+        # Set by build_rankings, once the scores are known
+        self.leaderboard = None
+        self.score_locks = [Lock() for x in range(score_stripes)]
+        # Blocks of player ids whose score changed since the last checkpoint
+        self.dirty = bytearray(PLAYER_ID_SPACE >> CHECKPOINT_SCORE_BLOCK_SHIFT)
 
         self.game = game
 
@@ -173,99 +1014,1067 @@ class PlayerManager:
         assert player_id in self.players_online
         return self.players_online[player_id]
 
+    def online_count(self):
+        return self.online_players[0]
+
     def mark_as_online(self, player_id):
+        # Called with the game lock held, like mark_as_disconnected
         assert player_id in self.players_online
+        if not self.players_online[player_id]:
+            self.online_players[0] += 1
         self.players_online[player_id] = True
 
     def mark_as_disconnected(self, player_id):
         assert player_id in self.players_online
+        if self.players_online[player_id]:
+            self.online_players[0] -= 1
         self.players_online[player_id] = False
 
-    def load_players(self, filename='player_database.data'):
-        if not os.path.isfile(filename):
-            game_events.critical("Player database is not set. The game cannot start!")
-            raise Exception("Player database is not set. The game cannot start!")
+    def load_players(self, filename='player_database.db', store=None):
+        """
+        Open the player store, imported once from the text database of the same name (.data) when it does not exist yet.
+        The rooms share the store opened by the default room, given as store.
+        """
+        if store is None:
+            if not os.path.isfile(filename):
+                text_filename = os.path.splitext(filename)[0] + '.data'
+                if not os.path.isfile(text_filename):
+                    game_events.critical("Player database is not set. The game cannot start!")
+                    raise Exception("Player database is not set. The game cannot start!")
+                game_events.info(LogMessage("Importing the text player database {text_filename} in {filename}...", text_filename=text_filename,
+                    filename=filename))
+                PlayerStore.import_text(text_filename, filename).close()
 
-        with open(filename, "r") as f:
             game_events.info("Loading player database file...")
-            for line in f:
-                player_id, player_name = map(str.strip, line.split(":"))
-                player_id = int(player_id)
-
-                self.player_list[player_id] = player_name
-                self.player_score[player_id] = 0
-                self.players_online[player_id] = False
-
-                game_events.debug("{player_name} have id: {player_id}.".format(player_name=player_name, player_id=player_id))
-            game_events.info("Player database loaded.")
-
-    def add_score(self, player_id, value):
+            store = PlayerStore(filename)
+        self.player_list = store
+        self.player_score = PlayerTable(array('i', [0]) * PLAYER_ID_SPACE, self.player_list)
+        self.players_online = PlayerTable(array('b', [0]) * PLAYER_ID_SPACE, self.player_list)
+        game_events.info("Player database loaded.")
+
+    def share_memory(self):
+        shared_score = multiprocessing.RawArray('i', PLAYER_ID_SPACE)
+        ctypes.memmove(shared_score, array_address(self.player_score.values), PLAYER_ID_SPACE * ctypes.sizeof(ctypes.c_int))
+        shared_online = multiprocessing.RawArray('b', PLAYER_ID_SPACE)
+        ctypes.memmove(shared_online, array_address(self.players_online.values), PLAYER_ID_SPACE)
+        self.player_score = PlayerTable(shared_score, self.player_list)
+        self.players_online = PlayerTable(shared_online, self.player_list)
+        self.online_players = multiprocessing.RawArray('i', self.online_players)
+        self.score_locks = [multiprocessing.Lock() for lock in self.score_locks]
+        self.leaderboard.share_memory()
+        shared_dirty = multiprocessing.RawArray('b', len(self.dirty))
+        ctypes.memmove(shared_dirty, str(self.dirty), len(self.dirty))
+        self.dirty = shared_dirty
+
+    def scores_block(self, start, end):
+        # Scores of the player ids start to end as a native int array
+        return ctypes.string_at(array_address(self.player_score.values) + start * 4, (end - start) * 4)
+
+    def score_lock(self, player_id):
+        return self.score_locks[player_id % len(self.score_locks)]
+
+    def build_rankings(self, max_score):
+        self.leaderboard = Leaderboard(max_score)
+        self.leaderboard.rebuild(self.player_score.items())
+
+    def gain_computer(self, player_id, c_id):
+        # Called with the shard lock of c_id held, returns the new score
+        assert player_id in self.player_score
+        with self.score_lock(player_id):
+            score = self.player_score[player_id] + 1
+            self.player_score[player_id] = score
+            self.dirty[player_id >> CHECKPOINT_SCORE_BLOCK_SHIFT] = 1
+            self.game.network.owned.add(player_id, c_id)
+            self.leaderboard.mark(player_id)
+            return score
+
+    def lose_computer(self, player_id, c_id):
+        # Called with the shard lock of c_id held, returns the new score
         assert player_id in self.player_score
-        self.player_score[player_id] += value
+        with self.score_lock(player_id):
+            score = self.player_score[player_id] - 1
+            self.player_score[player_id] = score
+            self.dirty[player_id >> CHECKPOINT_SCORE_BLOCK_SHIFT] = 1
+            self.game.network.owned.remove(player_id, c_id)
+            self.leaderboard.mark(player_id)
+            return score
 
     def add_player(self, player_name):
         new_id = random.randint(1, 2**16 - 1)
         while new_id in self.player_list:
             new_id = random.randint(1, 2**16 - 1)
 
-        self.player_list[new_id] = player_name
+        self.player_list.add(new_id, player_name)
         self.player_score[new_id] = 0
+        self.players_online[new_id] = False
+        self.leaderboard.add(new_id)
 
-        game_events.info("Player {player_name} (id: {player_id}) has been successfully added in the system.".format(player_id=new_id, player_name=player_name))
+        game_events.info(LogMessage("Player {player_name} (id: {player_id}) has been successfully added in the system.", player_id=new_id, player_name=player_name))
 
         return new_id
 
     def del_player(self, player_id):
         if player_id in self.player_list:
-            pos = self.player_positions[player_id]
-            for i in pos:
-                self.game.network.make_alive(i)
+            player_name = self.name(player_id)
+            self.game.network.release_computers(player_id)
+            self.leaderboard.remove(player_id)
 
-            del self.player_list[player_id]
+            self.player_list.remove(player_id)
             del self.player_score[player_id]
-            del self.player_positions[player_id]
-            game_events.info("Player {player_name} (id: {player_id}) has been successfully removed from system.".format(player_id=player_id, player_name=player_name))
+            del self.players_online[player_id]
+            self.dirty[player_id >> CHECKPOINT_SCORE_BLOCK_SHIFT] = 1
+            game_events.info(LogMessage("Player {player_name} (id: {player_id}) has been successfully removed from system.", player_id=player_id, player_name=player_name))
+
+
+
+
+# CHECKPOINTS
+# Checkpoint file: a header, then the network state (one owner per computer), the predicat records,
+# the scores of the whole player id space and the ownership index (the head of every player id,
+# the next and previous links of every computer), all in native byte order.
+# The header is rewritten as incomplete before the blocks and complete after them:
+# an interrupted checkpoint is never resumed from.
+# Version 1 files have no ownership index: it is rebuilt from the owners when resuming from them.
+CHECKPOINT_MAGIC = 'VGCKPT'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_VERSIONS = (1, 2)
+CHECKPOINT_HEADER = struct.Struct('=6sBcIIQdd?')    # magic, version, byte order, size, difficulty, sequence, start time, saved at, complete
+
+
+def array_address(values):
+    # Address of the items of an array.array or of a ctypes array (shared memory)
+    if isinstance(values, array):
+        return values.buffer_info()[0]
+    return ctypes.addressof(values)
+
+
+class Checkpointer(object):
+    """
+    Periodic and incremental checkpoints of a game state in a memory-mapped file.
+
+    Only the blocks marked dirty since the previous checkpoint are copied: every network shard lock
+    is taken for the time of this memory copy (ownership and scores then agree), the copy is written
+    to the mapping and flushed afterwards without holding anything.
+    """
+
+    def __init__(self, state, filename, interval):
+        self.state = state
+        self.filename = filename
+        self.interval = interval
+        self.sequence = 0
+        self.mapping = None
+        self.stopped = Event()
+        self.thread = None
+
+    @staticmethod
+    def layout(size, difficulty, version=CHECKPOINT_VERSION):
+        state_offset = CHECKPOINT_HEADER.size
+        predicats_offset = state_offset + size * 2
+        scores_offset = predicats_offset + size * difficulty
+        heads_offset = scores_offset + PLAYER_ID_SPACE * 4
+        if version == 1:
+            return state_offset, predicats_offset, scores_offset, heads_offset
+        return state_offset, predicats_offset, scores_offset, heads_offset, heads_offset + PLAYER_ID_SPACE * 4, \
+            heads_offset + PLAYER_ID_SPACE * 4 + size * 4, heads_offset + PLAYER_ID_SPACE * 4 + size * 8
+
+    @staticmethod
+    def read_header(filename):
+        """
+        Return the header fields of a complete checkpoint, None when the file is absent, foreign or incomplete.
+        """
+        if not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            data = f.read(CHECKPOINT_HEADER.size)
+        if len(data) < CHECKPOINT_HEADER.size:
+            return None
+        header = CHECKPOINT_HEADER.unpack(data)
+        magic, version, byteorder, size, difficulty, sequence, start_time, saved_at, complete = header
+        if magic != CHECKPOINT_MAGIC or version not in CHECKPOINT_VERSIONS or byteorder != sys.byteorder[0] or not complete:
+            return None
+        if os.path.getsize(filename) != Checkpointer.layout(size, difficulty, version)[-1]:
+            return None
+        return header
+
+    def restore(self):
+        """
+        Load the network and the scores from the checkpoint file, return its start time (None if nothing was restored).
+        """
+        header = self.read_header(self.filename)
+        network = self.state.network
+        if header is None or header[3] != network.size or header[4] != network.difficulty:
+            return None
+
+        version = header[1]
+        offsets = self.layout(network.size, network.difficulty, version)
+        state_offset, predicats_offset, scores_offset, heads_offset = offsets[:4]
+        owned = network.owned
+        with open(self.filename, 'r+b') as f:
+            mapping = mmap.mmap(f.fileno(), offsets[-1])
+            try:
+                network.state = array('H')
+                network.state.fromstring(mapping[state_offset:predicats_offset])
+                network.predicats = array('B')
+                network.predicats.fromstring(mapping[predicats_offset:scores_offset])
+                scores = array('i')
+                scores.fromstring(mapping[scores_offset:heads_offset])
+                if version != 1:
+                    next_offset, previous_offset, end = offsets[4:]
+                    owned.head = array('i')
+                    owned.head.fromstring(mapping[heads_offset:next_offset])
+                    owned.next = array('i')
+                    owned.next.fromstring(mapping[next_offset:previous_offset])
+                    owned.previous = array('i')
+                    owned.previous.fromstring(mapping[previous_offset:end])
+            finally:
+                mapping.close()
+        if version == 1:
+            owned.rebuild(network.state)
+
+        player_manager = self.state.player_manager
+        for player_id in player_manager.player_list:
+            player_manager.player_score[player_id] = scores[player_id]
+        # Computers of the players removed from the database since the checkpoint are free again
+        removed = [player_id for player_id in xrange(PLAYER_ID_SPACE) if scores[player_id] and player_id not in player_manager.player_list]
+        for player_id in removed:
+            for c_id in owned.computers(player_id):
+                network.make_alive(c_id)
+            owned.clear(player_id)
+            player_manager.dirty[player_id >> CHECKPOINT_SCORE_BLOCK_SHIFT] = 1
+        self.sequence = header[5]
+        return header[6]
+
+    def open(self):
+        network = self.state.network
+        end = self.layout(network.size, network.difficulty)[-1]
+        header = self.read_header(self.filename)
+        # A file of a previous version is written again in the current one
+        resumed = header is not None and header[1] == CHECKPOINT_VERSION and header[3] == network.size and header[4] == network.difficulty
+        with open(self.filename, 'r+b' if resumed else 'w+b') as f:
+            if not resumed:
+                f.truncate(end)
+                # A new file: everything has to be written
+                for idx in range(len(network.dirty)):
+                    network.dirty[idx] = 1
+                    network.dirty_predicats[idx] = 1
+                    network.owned.dirty[idx] = 1
+                for idx in range(len(self.state.player_manager.dirty)):
+                    self.state.player_manager.dirty[idx] = 1
+            self.mapping = mmap.mmap(f.fileno(), end)
+
+    def write_header(self, complete):
+        network = self.state.network
+        self.mapping[0:CHECKPOINT_HEADER.size] = CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, sys.byteorder[0],
+            network.size, network.difficulty, self.sequence, self.state.start_time, time.time(), complete)
+
+    def checkpoint(self):
+        """
+        Write the dirty blocks, return the number of bytes written.
+        """
+        if self.mapping is None:
+            self.open()
+        network = self.state.network
+        player_manager = self.state.player_manager
+        owned = network.owned
+        state_offset, predicats_offset, scores_offset, heads_offset, next_offset, previous_offset, end = self.layout(network.size,
+            network.difficulty)
+        block = 1 << CHECKPOINT_BLOCK_SHIFT
+        score_block = 1 << CHECKPOINT_SCORE_BLOCK_SHIFT
+
+        copies = []
+        locks = network.shard_locks
+        for lock in locks:
+            lock.acquire()
+        try:
+            state_address = array_address(network.state)
+            predicats_address = array_address(network.predicats)
+            next_address, previous_address, head_address = array_address(owned.next), array_address(owned.previous), array_address(owned.head)
+            for block_idx in xrange(len(network.dirty)):
+                start = block_idx * block
+                count = min(block, network.size - start)
+                if network.dirty[block_idx]:
+                    network.dirty[block_idx] = 0
+                    copies.append((state_offset + start * 2, ctypes.string_at(state_address + start * 2, count * 2)))
+                if network.dirty_predicats[block_idx]:
+                    network.dirty_predicats[block_idx] = 0
+                    copies.append((predicats_offset + start * network.difficulty,
+                        ctypes.string_at(predicats_address + start * network.difficulty, count * network.difficulty)))
+                if owned.dirty[block_idx]:
+                    owned.dirty[block_idx] = 0
+                    copies.append((next_offset + start * 4, ctypes.string_at(next_address + start * 4, count * 4)))
+                    copies.append((previous_offset + start * 4, ctypes.string_at(previous_address + start * 4, count * 4)))
+            # The heads of a player change with their score
+            for block_idx in xrange(len(player_manager.dirty)):
+                if player_manager.dirty[block_idx]:
+                    player_manager.dirty[block_idx] = 0
+                    start = block_idx * score_block
+                    copies.append((scores_offset + start * 4, player_manager.scores_block(start, start + score_block)))
+                    copies.append((heads_offset + start * 4, ctypes.string_at(head_address + start * 4, score_block * 4)))
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+        if not copies:
+            return 0
+        self.sequence += 1
+        self.write_header(False)
+        self.mapping.flush()
+        for offset, data in copies:
+            self.mapping[offset:offset + len(data)] = data
+        self.mapping.flush()
+        self.write_header(True)
+        self.mapping.flush()
+        return sum(len(data) for offset, data in copies)
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="Checkpointer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                start = time.time()
+                written = self.checkpoint()
+                game_events.debug(LogMessage("Checkpoint {sequence} written ({size} bytes) in {elapsed:.3f} s.", sequence=self.sequence,
+                    size=written, elapsed=time.time() - start))
+            except Exception:
+                game_events.exception("Failed to write a checkpoint.")
+
+    def stop(self):
+        # A last checkpoint, so that a clean shutdown loses nothing
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.checkpoint()
+        self.mapping.close()
+        self.mapping = None
+
+
+# WORLD EVENTS
+class NetworkRandomization(object):
+    """
+    Periodic AV detection sweep over the whole network, one slice of computers per step.
+    The computers lost by the players are published in one batch per slice.
+    """
+    name = "Network randomization"
+
+    def __init__(self, game, period, chance=AV_DETECTION_CHANCE, slice_size=WORLD_SLICE_SIZE):
+        self.game = game
+        self.period = period
+        self.chance = chance
+        self.slice_size = slice_size
+        self.position = 0
+        self.lost = 0
+
+    def step(self):
+        """
+        Randomize the next slice, returns False once the sweep is complete.
+        """
+        network = self.game.network
+        if self.position == 0:
+            game_events.info("Network randomization procedure has been started.")
+            self.game.notifications.world_event(NotificationKind.RANDOMIZATION_STARTED)
+        lost = network.randomize_network(self.position, self.position + self.slice_size, self.chance)
+        self.game.on_computers_lost(lost)
+        self.lost += len(lost)
+        self.position += self.slice_size
+        if self.position < network.size:
+            return True
+        game_events.info(LogMessage("Network randomization has ended, {lost} computers have been lost by the players.", lost=self.lost))
+        self.game.notifications.world_event(NotificationKind.RANDOMIZATION_ENDED, self.lost)
+        self.position = 0
+        self.lost = 0
+        return False
+
+
+class WorldScheduler(object):
+    """
+    Runs the periodic world events in a background thread, from a heap of jobs ordered by their next run.
+    A job is done in steps, WORLD_SLICE_INTERVAL seconds apart: the network locks it takes are
+    released between two steps, so that infections are never stalled for a whole sweep.
+    A new run of a job starts period seconds after the start of the previous one.
+    """
+
+    def __init__(self, slice_interval=WORLD_SLICE_INTERVAL):
+        self.slice_interval = slice_interval
+        self.jobs = []
+        self.sequence = itertools.count()
+        self.stopped = Event()
+        self.thread = None
+
+    def add(self, job):
+        heapq.heappush(self.jobs, (time.time() + job.period, next(self.sequence), job, None))
+
+    def start(self):
+        if not self.jobs:
+            return
+        self.thread = Thread(target=self.run, name="World scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            due, sequence, job, started = self.jobs[0]
+            if self.stopped.wait(max(0, due - time.time())):
+                break
+            heapq.heappop(self.jobs)
+            started = started or time.time()
+            try:
+                more = job.step()
+            except Exception:
+                game_events.exception(LogMessage("World event {name} has failed.", name=job.name))
+                more = False
+            if more:
+                heapq.heappush(self.jobs, (time.time() + self.slice_interval, next(self.sequence), job, started))
+            else:
+                heapq.heappush(self.jobs, (max(time.time(), started + job.period), next(self.sequence), job, None))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+# EVENTS
+class EventTopic(object):
+    """
+    First byte of every binary event frame, subscribers can filter on it with zmq.SUBSCRIBE.
+    """
+    NETWORK_CONFIGURATION = 'C'
+    NEW_PLAYER = 'N'
+    PLAYER_DISCONNECTION = 'D'
+    INFECTION_OCCURRED = 'I'
+    COMPUTER_LOST = 'L'
+    # Frames of the rooms other than the default one start with this topic and the room id
+    ROOM = 'R'
+
+# Binary frames: a header (topic, format version, number of records) followed by fixed-width records
+EVENT_FORMAT_VERSION = 1
+EVENT_HEADER = struct.Struct('!cBH')
+EVENT_RECORDS = {
+    EventTopic.NETWORK_CONFIGURATION: struct.Struct('!Id'),     # network size, start time
+    EventTopic.NEW_PLAYER: struct.Struct('!H32s'),              # player id, player name
+    EventTopic.PLAYER_DISCONNECTION: struct.Struct('!H32s'),    # player id, player name
+    EventTopic.INFECTION_OCCURRED: struct.Struct('!HIdI8s'),    # player id, computer id, timestamp, score, pattern
+    EventTopic.COMPUTER_LOST: struct.Struct('!HIdI'),           # player id, computer id, timestamp, score
+}
+EVENT_FRAME_RECORDS = 2**16 - 1
+EVENT_ROOM_HEADER = struct.Struct('!cH')
+
+
+class TextEventFormat(object):
+    """
+    Space separated messages, one per event. Infection messages repeat the start time and the network size.
+    Messages of the rooms other than the default one start with ROOM and the room id.
+    """
+    configuration_period = None
 
+    def __init__(self, game):
+        self.game = game
 
+    @staticmethod
+    def room_prefix(room_id):
+        return "ROOM {room_id} ".format(room_id=room_id) if room_id != DEFAULT_ROOM else ''
+
+    def encode(self, topic, records):
+        if topic == EventTopic.INFECTION_OCCURRED:
+            return ["INFECTION_OCCURRED {player_id} {timestamp} {start_time} {score} {pattern} {net_size}".format(player_id=player_id,
+                timestamp=timestamp, start_time=self.game.start_time, score=score, pattern=pattern, net_size=self.game.network.size)
+                for player_id, computer_id, timestamp, score, pattern in records]
+        elif topic == EventTopic.NEW_PLAYER:
+            return ["NEW_PLAYER {player_id} {player_name}".format(player_id=player_id, player_name=player_name) for player_id, player_name in records]
+        elif topic == EventTopic.PLAYER_DISCONNECTION:
+            return ["PLAYER_DISCONNECTION {player_id} {player_name}".format(player_id=player_id, player_name=player_name) for player_id, player_name in records]
+        elif topic == EventTopic.NETWORK_CONFIGURATION:
+            return ["NETWORK_CONFIGURATION {net_size}".format(net_size=net_size) for net_size, start_time in records]
+        elif topic == EventTopic.COMPUTER_LOST:
+            return ["COMPUTER_LOST {player_id} {timestamp} {start_time} {score} {computer_id} {net_size}".format(player_id=player_id,
+                timestamp=timestamp, start_time=self.game.start_time, score=score, computer_id=computer_id, net_size=self.game.network.size)
+                for player_id, computer_id, timestamp, score in records]
+
+
+class BinaryEventFormat(object):
+    """
+    One frame per batch of events of the same topic. Infection records do not carry the start time
+    and the network size, the configuration is published again every configuration_period seconds instead.
+    """
+    configuration_period = 5.0
+
+    @staticmethod
+    def room_prefix(room_id):
+        return EVENT_ROOM_HEADER.pack(EventTopic.ROOM, room_id) if room_id != DEFAULT_ROOM else ''
+
+    def encode(self, topic, records):
+        record_struct = EVENT_RECORDS[topic]
+        frames = []
+        for start in xrange(0, len(records), EVENT_FRAME_RECORDS):
+            chunk = records[start:start + EVENT_FRAME_RECORDS]
+            frames.append(EVENT_HEADER.pack(topic, EVENT_FORMAT_VERSION, len(chunk)) + ''.join(record_struct.pack(*record) for record in chunk))
+        return frames
+
+
+class EventPublisher(object):
+    """
+    Encodes and sends every event as soon as it is published.
+    """
+
+    def __init__(self, send, event_format):
+        self.send = send
+        self.event_format = event_format
+        self.configuration = None
+        self.last_configuration = 0
+
+    def start(self):
+        pass
+
+    def set_configuration(self, net_size, start_time):
+        self.configuration = (net_size, start_time)
+        self.publish(EventTopic.NETWORK_CONFIGURATION, self.configuration)
+
+    def publish(self, topic, record):
+        self.send_records(topic, [record])
+
+    def publish_many(self, topic, records):
+        if records:
+            self.send_records(topic, records)
+
+    def send_records(self, topic, records):
+        now = time.time()
+        if topic == EventTopic.NETWORK_CONFIGURATION:
+            self.last_configuration = now
+        elif self.event_format.configuration_period is not None and now - self.last_configuration >= self.event_format.configuration_period:
+            self.last_configuration = now
+            for message in self.event_format.encode(EventTopic.NETWORK_CONFIGURATION, [self.configuration]):
+                self.send(message)
+
+        for message in self.event_format.encode(topic, records):
+            self.send(message)
+
+
+class CoalescingEventPublisher(EventPublisher):
+    """
+    Events are only queued by the game, a background thread encodes and sends them in batches
+    every interval seconds, or as soon as batch_size events are waiting.
+    Consecutive events of the same topic are sent together, the order of the events is kept.
+    """
+
+    def __init__(self, send, event_format, interval, batch_size):
+        EventPublisher.__init__(self, send, event_format)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = collections.deque()
+        self.wakeup = None
+
+    def start(self):
+        # Also called again in forked worker processes, which do not inherit the thread
+        self.wakeup = Event()
+        thread = Thread(target=self.run, name="Event publisher")
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, topic, record):
+        self.pending.append((topic, record))
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def publish_many(self, topic, records):
+        self.pending.extend((topic, record) for record in records)
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                api_events.exception("Failed to publish a batch of events.")
+
+    def flush(self):
+        topic, records = None, []
+        while self.pending:
+            event_topic, record = self.pending.popleft()
+            if event_topic != topic and records:
+                self.send_records(topic, records)
+                records = []
+            topic = event_topic
+            records.append(record)
+        if records:
+            self.send_records(topic, records)
+
+
+# NOTIFICATIONS
+class Notifications(object):
+    """
+    Pushes the computers they lost and the world events to the players who subscribed with SUBSCRIBE,
+    as NOTIFICATION frames sent in batches every interval seconds by a background thread, started with the first record.
+    The flags of every player are read without a lock by the producers: nothing is recorded for the others.
+    With the multiprocess engine the flags and the worker of every subscriber are in shared memory,
+    the records of a subscriber connected to another process are forwarded to it through the router.
+    """
+
+    def __init__(self, game, interval=NOTIFICATION_INTERVAL):
+        self.game = game
+        self.interval = interval
+        self.flags = array('B', [0]) * PLAYER_ID_SPACE
+        self.workers = array('b', [0]) * PLAYER_ID_SPACE
+        self.router = None
+
+    def start(self):
+        # Also called again in forked worker processes, which do not inherit the thread nor the subscribers of their parent
+        self.lock = Lock()
+        # Delivery callables of the subscribers connected to this process, records waiting per player
+        self.subscribers = {}
+        self.pending = {}
+        self.dropped = {}
+        self.stopped = Event()
+        self.thread = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def share_memory(self):
+        shared_flags = multiprocessing.RawArray('B', len(self.flags))
+        ctypes.memmove(shared_flags, array_address(self.flags), len(self.flags))
+        self.flags = shared_flags
+        self.workers = multiprocessing.RawArray('b', len(self.workers))
+
+    def use_router(self, router):
+        self.router = router
+
+    def subscribe(self, player_id, flags, deliver):
+        with self.lock:
+            if flags:
+                self.subscribers[player_id] = deliver
+                self.workers[player_id] = self.router.worker_idx if self.router is not None else 0
+            else:
+                self.subscribers.pop(player_id, None)
+                self.pending.pop(player_id, None)
+            self.flags[player_id] = flags
+
+    def unsubscribe(self, player_id):
+        if self.flags[player_id]:
+            self.subscribe(player_id, 0, None)
+
+    def computer_lost(self, player_id, kind, c_id, new_owner=0):
+        if self.flags[player_id] & Subscription.COMPUTERS_LOST:
+            self.add(player_id, NOTIFICATION_RECORD.pack(kind, c_id, new_owner))
+
+    def world_event(self, kind, value=0):
+        record = NOTIFICATION_RECORD.pack(kind, value, 0)
+        for player_id, flags in enumerate(self.flags):
+            if flags & Subscription.WORLD_EVENTS:
+                self.add(player_id, record)
+
+    def add(self, player_id, record):
+        with self.lock:
+            records = self.pending.setdefault(player_id, [])
+            if len(records) < NOTIFICATION_QUEUE_LIMIT:
+                records.append(record)
+            else:
+                self.dropped[player_id] = self.dropped.get(player_id, 0) + 1
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="Notifications")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                network_events.exception("Failed to push a batch of notifications.")
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            dropped, self.dropped = self.dropped, {}
+        forwarded = {}
+        for player_id, records in pending.iteritems():
+            if player_id in dropped:
+                records.append(NOTIFICATION_RECORD.pack(NotificationKind.DROPPED, dropped[player_id], 0))
+            deliver = self.subscribers.get(player_id)
+            if deliver is not None:
+                deliver(self.frames(player_id, records))
+            elif self.router is not None and self.flags[player_id] and self.workers[player_id] != self.router.worker_idx:
+                forwarded.setdefault(self.workers[player_id], []).append((player_id, records))
+        for worker_idx, batches in forwarded.iteritems():
+            self.router.send(worker_idx, batches)
+
+    def deliver_forwarded(self, batches):
+        for player_id, records in batches:
+            deliver = self.subscribers.get(player_id)
+            if deliver is not None:
+                deliver(self.frames(player_id, records))
+
+    def frames(self, player_id, records):
+        score = self.game.player_manager.score(player_id)
+        return ''.join(NOTIFICATION_HEADER.pack(ServerOpcode.NOTIFICATION, score, len(records[start:start + MAXIMUM_NOTIFICATIONS]))
+            + ''.join(records[start:start + MAXIMUM_NOTIFICATIONS]) for start in xrange(0, len(records), MAXIMUM_NOTIFICATIONS))
+
+
+class NotificationRouter(object):
+    """
+    Notifications of the subscribers of every worker process, forwarded by the process which produced them
+    over a pipe of that worker.
+    """
+
+    def __init__(self, workers):
+        self.pipes = [multiprocessing.Pipe(duplex=False) for worker_idx in range(workers)]
+        self.locks = [multiprocessing.Lock() for worker_idx in range(workers)]
+        self.worker_idx = None
+
+    def use_worker(self, worker_idx):
+        self.worker_idx = worker_idx
+
+    def fileno(self):
+        return self.pipes[self.worker_idx][0].fileno()
+
+    def send(self, worker_idx, batches):
+        with self.locks[worker_idx]:
+            self.pipes[worker_idx][1].send(batches)
+
+    def receive(self):
+        return self.pipes[self.worker_idx][0].recv()
+
+
+# METRICS
+class Metric(object):
+    """
+    Slots of the metric values. Counters and histograms are numbered separately,
+    the latency histogram of an opcode is OPCODE_LATENCY + opcode - 1.
+    """
+    INFECTIONS_SUCCESS = 0
+    INFECTIONS_FAILURE = 1
+    INFECTIONS_MAXIMUM_REACHED = 2
+    CONNECTIONS_OPENED = 3
+    CONNECTIONS_CLOSED = 4
+    BYTES_IN = 5
+    BYTES_OUT = 6
+    COUNTERS = ['infections_success', 'infections_failure', 'infections_maximum_reached', 'connections_opened', 'connections_closed',
+        'bytes_in', 'bytes_out']
+
+    GAME_LOCK_WAIT = 0
+    SHARD_LOCK_WAIT = 1
+    OPCODE_LATENCY = 2
+    HISTOGRAMS = ['game_lock_wait', 'shard_lock_wait'] + ['opcode_latency.' + opcode.name.lower() for opcode in sorted(ClientOpcode)]
+
+# Histogram bucket b counts the durations below 2**b microseconds (and above the previous bucket), the last one up to 8 s
+HISTOGRAM_BUCKETS = 24
+# Every histogram is stored as: count, sum of the durations (seconds), then its buckets
+HISTOGRAM_WIDTH = HISTOGRAM_BUCKETS + 2
+
+
+class MetricsShard(object):
+    """
+    Metric values written by a single thread (or worker process), so that recording needs no lock.
+    """
+
+    def __init__(self, counters=None, histograms=None):
+        self.counters = counters if counters is not None else array('d', [0]) * len(Metric.COUNTERS)
+        self.histograms = histograms if histograms is not None else array('d', [0]) * (len(Metric.HISTOGRAMS) * HISTOGRAM_WIDTH)
+        self.thread = None
+
+
+class TimedLock(object):
+    """
+    Context manager acquiring a lock and recording the time spent waiting for it.
+    """
+    __slots__ = ('metrics', 'lock', 'histogram')
+
+    def __init__(self, metrics, lock, histogram):
+        self.metrics = metrics
+        self.lock = lock
+        self.histogram = histogram
+
+    def __enter__(self):
+        start = time.time()
+        self.lock.acquire()
+        self.metrics.observe(self.histogram, time.time() - start)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms of the server, scraped with the STATS opcode.
+    Every thread records in its own shard, shards are only summed by snapshot().
+    """
+    enabled = True
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.local = local()
+        self.shards_lock = Lock()
+        self.shards = []
+        self.retired = MetricsShard()
+        self.shared_shards = []
+        self.process_shard = None
+
+    def shard(self):
+        if self.process_shard is not None:
+            return self.process_shard
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = MetricsShard()
+            shard.thread = current_thread()
+            with self.shards_lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+            return shard
+
+    def count(self, counter, value=1):
+        self.shard().counters[counter] += value
+
+    def observe(self, histogram, seconds):
+        values = self.shard().histograms
+        base = histogram * HISTOGRAM_WIDTH
+        values[base] += 1
+        values[base + 1] += seconds
+        values[base + 2 + min(int(seconds * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def observe_opcode(self, opcode, start):
+        if 0 < opcode <= len(Metric.HISTOGRAMS) - Metric.OPCODE_LATENCY:
+            self.observe(Metric.OPCODE_LATENCY + opcode - 1, time.time() - start)
+
+    def timed(self, lock, histogram):
+        return TimedLock(self, lock, histogram)
+
+    def share_memory(self, processes):
+        """
+        Allocate one shard per worker process in shared memory, any worker can then sum them all.
+        """
+        self.shared_shards = [MetricsShard(multiprocessing.RawArray('d', len(Metric.COUNTERS)),
+            multiprocessing.RawArray('d', len(Metric.HISTOGRAMS) * HISTOGRAM_WIDTH)) for x in range(processes)]
+
+    def use_shared_shard(self, index):
+        # Called in a forked worker: everything it records goes to its shared shard
+        self.local = local()
+        self.shards = []
+        self.process_shard = self.shared_shards[index]
+
+    def snapshot(self):
+        with self.shards_lock:
+            # Shards of the finished threads (one per connection with the threaded engine) are merged once
+            for shard in [shard for shard in self.shards if not shard.thread.is_alive()]:
+                self.shards.remove(shard)
+                for idx, value in enumerate(shard.counters):
+                    self.retired.counters[idx] += value
+                for idx, value in enumerate(shard.histograms):
+                    self.retired.histograms[idx] += value
+            shards = [self.retired] + self.shards + self.shared_shards
+
+        counters = [sum(values) for values in itertools.izip(*[shard.counters for shard in shards])]
+        histograms = [sum(values) for values in itertools.izip(*[shard.histograms for shard in shards])]
+
+        snapshot = {
+            'enabled': True,
+            'uptime': time.time() - self.start_time,
+            'counters': dict((name, int(counters[idx])) for idx, name in enumerate(Metric.COUNTERS)),
+            'gauges': {'active_connections': int(counters[Metric.CONNECTIONS_OPENED] - counters[Metric.CONNECTIONS_CLOSED])},
+            'histograms': {},
+        }
+        for idx, name in enumerate(Metric.HISTOGRAMS):
+            values = histograms[idx * HISTOGRAM_WIDTH:(idx + 1) * HISTOGRAM_WIDTH]
+            buckets = values[2:]
+            snapshot['histograms'][name] = {
+                'count': int(values[0]),
+                'sum': values[1],
+                'p50': histogram_percentile(buckets, values[0], 0.5),
+                'p99': histogram_percentile(buckets, values[0], 0.99),
+                # Upper bound of every non empty bucket (seconds) and its count
+                'buckets': [[2 ** bucket / 1000000.0, int(count)] for bucket, count in enumerate(buckets) if count],
+            }
+        return snapshot
+
+
+class NullMetrics(object):
+    """
+    Used when the metrics are disabled: recording does nothing and locks are acquired as they are.
+    """
+    enabled = False
+
+    def count(self, counter, value=1):
+        pass
+
+    def observe(self, histogram, seconds):
+        pass
+
+    def observe_opcode(self, opcode, start):
+        pass
+
+    def timed(self, lock, histogram):
+        return lock
+
+    def share_memory(self, processes):
+        pass
+
+    def use_shared_shard(self, index):
+        pass
+
+    def snapshot(self):
+        return {'enabled': False}
+
+
+def histogram_percentile(buckets, count, ratio):
+    # Upper bound of the bucket holding the percentile, in seconds
+    if not count:
+        return None
+    total = 0
+    for bucket, bucket_count in enumerate(buckets):
+        total += bucket_count
+        if total >= ratio * count:
+            return 2 ** bucket / 1000000.0
+    return 2 ** (len(buckets) - 1) / 1000000.0
+
+
+def pack_stats():
+    # STATS reply: the opcode, the length of the JSON snapshot, then the snapshot
+    data = json.dumps(metrics.snapshot(), sort_keys=True)
+    return struct.pack('!BI', ServerOpcode.STATS, len(data)) + data
+
+# Replaced by a Metrics instance at startup when enabled in config.conf
+metrics = NullMetrics()
 
 
 class GameState:
 
-    def __init__(self, rlock, network_size=2000, event_publisher_port=5488):
-        game_events.info("Game state is initializing...")
+    def __init__(self, rlock, network_size=2000, event_publisher_port=5488, shards=NETWORK_LOCK_SHARDS, players_filename='player_database.db',
+            event_format='text', event_batch_interval=0, event_batch_size=256, checkpoint_filename=None, checkpoint_interval=0,
+            randomization_period=0, randomization_chance=AV_DETECTION_CHANCE, world_slice_size=WORLD_SLICE_SIZE, world_slice_interval=WORLD_SLICE_INTERVAL,
+            room_id=DEFAULT_ROOM, player_store=None, event_sender=None, archive_directory=None, archive_limit=0, notification_interval=NOTIFICATION_INTERVAL,
+            network_construction='eager', network_seed=None, construction_processes=0, difficulty=None):
+        game_events.info(LogMessage("Game state of room {room_id} is initializing...", room_id=room_id))
         self.rlock = rlock
+        self.room_id = room_id
 
-        self.network = Network(network_size, self, rlock)
+        self.network = Network(network_size, self, rlock, shards, network_seed, difficulty)
         self.player_manager = PlayerManager(self)
 
         # Load players in the database
-        self.player_manager.load_players()
-
-        # Construct the network
-        self.network.construct_random_network()
-
-        self.event_publisher = context.socket(zmq.PUB)
-        self.event_publisher.connect('tcp://127.0.0.1:{port}'.format(port=event_publisher_port))
-        api_events.info("Event publisher is now running on tcp://127.0.0.1:{port}.".format(port=event_publisher_port))
-
-        self.event_publisher.send("NETWORK_CONFIGURATION {net_size}".format(net_size=self.network.size))
+        self.player_manager.load_players(players_filename, player_store)
+
+        # Resume the network and the scores from the last checkpoint, or construct a new network
+        self.checkpointer = Checkpointer(self, checkpoint_filename, checkpoint_interval) if checkpoint_filename else None
+        resumed_start_time = self.checkpointer.restore() if self.checkpointer is not None else None
+        if resumed_start_time is not None:
+            self.network.compile_systems()
+            game_events.info(LogMessage("Game resumed from checkpoint {sequence} of {filename}.", sequence=self.checkpointer.sequence,
+                filename=checkpoint_filename))
+        else:
+            # Every computer of a new network is free: nothing to index
+            self.network.construct_network(network_construction, construction_processes)
+            game_events.info(LogMessage("Network of room {room_id} constructed ({construction}, seed {seed}).", room_id=room_id,
+                construction=network_construction, seed=self.network.seed))
+        self.player_manager.build_rankings(self.network.size)
 
-        self.start_time = time.time()
+        self.start_time = resumed_start_time or time.time()
         self.last_time = time.time()
+        self.clock = itertools.count(self.last_time + 1)
+
+        # Every infection attempt and computer lost, kept for the analysis of the game
+        self.archive = None
+        if archive_directory is not None:
+            self.archive = EventArchive(os.path.join(archive_directory, "room{room_id}".format(room_id=room_id)), self.start_time, encode_pattern,
+                limit=archive_limit)
+            self.archive.start()
+
+        # The rooms send their events through the publisher of the default room
+        if event_sender is None:
+            self.event_publisher = context.socket(zmq.PUB)
+            self.event_publisher_lock = Lock()
+            self.event_publisher.connect('tcp://127.0.0.1:{port}'.format(port=event_publisher_port))
+            api_events.info(LogMessage("Event publisher is now running on tcp://127.0.0.1:{port}.", port=event_publisher_port))
+            event_sender = self.send_event
+        self.event_sender = event_sender
+
+        if event_format == 'text':
+            event_format = TextEventFormat(self)
+        elif event_format == 'binary':
+            event_format = BinaryEventFormat()
+        else:
+            raise Exception("Unknown event format {event_format}!".format(event_format=event_format))
+        self.event_prefix = event_format.room_prefix(room_id)
 
-        game_events.info("Game state ready. Start time is {start_time}.".format(start_time=self.start_time))
+        if event_batch_interval > 0:
+            self.events = CoalescingEventPublisher(self.publish, event_format, event_batch_interval / 1000.0, event_batch_size)
+        else:
+            self.events = EventPublisher(self.publish, event_format)
+        self.events.start()
+        self.events.set_configuration(self.network.size, self.start_time)
+
+        # Pushed to the players who subscribed on their connection
+        self.notifications = Notifications(self, notification_interval)
+        self.notifications.start()
+
+        if self.checkpointer is not None:
+            self.checkpointer.open()
+            if checkpoint_interval > 0:
+                self.checkpointer.start()
+
+        # Started by the server once it is ready: the multiprocess engine forks its workers first
+        self.scheduler = WorldScheduler(world_slice_interval)
+        if randomization_period > 0:
+            self.scheduler.add(NetworkRandomization(self, randomization_period, randomization_chance, world_slice_size))
+
+        game_events.info(LogMessage("Game state of room {room_id} ready. Start time is {start_time}.", room_id=room_id, start_time=self.start_time))
+
+    def stop(self):
+        self.scheduler.stop()
+        self.notifications.stop()
+        if self.archive is not None:
+            self.archive.close()
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            game_events.info(LogMessage("Checkpoint {sequence} of room {room_id} written.", sequence=self.checkpointer.sequence, room_id=self.room_id))
 
     def on_new_player_connected(self, player_id):
+        # Called with the game lock held, by the authentication
         player_name = self.player_manager.name(player_id)
         self.player_manager.mark_as_online(player_id)
 
-        self.event_publisher.send("NEW_PLAYER {player_id} {player_name}".format(player_id=player_id, player_name=player_name))
+        self.events.publish(EventTopic.NEW_PLAYER, (player_id, player_name))
 
     def on_player_disconnected(self, player_id):
         player_name = self.player_manager.name(player_id)
-        self.player_manager.mark_as_disconnected(player_id)
-
-        self.event_publisher.send("PLAYER_DISCONNECTION {player_id} {player_name}".format(player_id=player_id, player_name=player_name))
+        with self.rlock:
+            self.player_manager.mark_as_disconnected(player_id)
+        self.notifications.unsubscribe(player_id)
+
+        self.events.publish(EventTopic.PLAYER_DISCONNECTION, (player_id, player_name))
+
+    def on_computers_lost(self, lost):
+        records = []
+        for player_id, c_id, score in lost:
+            timestamp = next(self.clock)
+            records.append((player_id, c_id, timestamp, score))
+            self.last_time = timestamp
+            self.notifications.computer_lost(player_id, NotificationKind.COMPUTER_DETECTED, c_id)
+        self.events.publish_many(EventTopic.COMPUTER_LOST, records)
+        if self.archive is not None:
+            self.archive.extend((timestamp, player_id, c_id, score, None, ARCHIVE_LOSS) for player_id, c_id, timestamp, score in records)
+
+    def share_memory(self):
+        self.network.share_memory()
+        self.player_manager.share_memory()
+        self.notifications.share_memory()
+        self.clock = SharedClock(next(self.clock))
+
+    def publish(self, message):
+        # Sends an already encoded message, events go through self.events
+        if self.event_prefix:
+            message = self.event_prefix + message
+        self.event_sender(message)
+
+    def send_event(self, message):
+        with self.event_publisher_lock:
+            self.event_publisher.send(message)
 
     def on_dispatch_infection(self, player_id, pattern):
         current_taken = self.player_manager.score(player_id)
@@ -273,143 +2082,1102 @@ class GameState:
 
         # Got all computers, bitches
         if current_taken == self.network.size:
-            game_events.info("{player_name} has all computers of the network. We don't need to dispatch his virus.".format(player_name=player_name))
+            metrics.count(Metric.INFECTIONS_MAXIMUM_REACHED)
+            game_events.debug(LogMessage("{player_name} has all computers of the network. We don't need to dispatch his virus.", player_name=player_name))
             packet_max_computers_reached = struct.pack('!BI', ServerOpcode.MAXIMUM_INFECTION, current_taken)
             yield packet_max_computers_reached
-            network_events.info("Maximum computers reached packet has been sent to {player_name}.".format(player_name=player_name))
+            network_events.debug(LogMessage("Maximum computers reached packet has been sent to {player_name}.", player_name=player_name))
             raise StopIteration
 
-        game_events.info("{player_name} is dispatching his virus on the network...".format(player_name=player_name))
-        game_events.info("{player_name} has currently {taken} computers on the network.".format(player_name=player_name,
+        game_events.debug(LogMessage("{player_name} is dispatching his virus on the network...", player_name=player_name))
+        game_events.debug(LogMessage("{player_name} has currently {taken} computers on the network.", player_name=player_name,
             taken=current_taken))
 
-        c_id, state, predicat = self.network.random_computer()
+        result = self._try_infection(player_id, player_name, pattern)
+
+        game_events.debug(LogMessage("Infection result for {player_name} is: infection {result} ", player_name=player_name, result=("SUCCESS" if result else "FAILED")))
+        packet_result_infection = struct.pack('!BII', ServerOpcode.RESULT_INFECTION, current_taken, result)
+        if network_events.isEnabledFor(logging.DEBUG):
+            network_events.debug(LogMessage("Infection packet result is going to be sent: {raw_data}", raw_data=repr(packet_result_infection)))
+        yield packet_result_infection
+        network_events.debug(LogMessage("Infection packet result sent for {player_name}.", player_name=player_name))
+        raise StopIteration
 
-        result = predicat.eval_system(pattern)
-        timestamp = self.last_time + 1
+    def on_dispatch_infection_batch(self, player_id, patterns):
+        """
+        Dispatch several patterns at once, each one against a random computer,
+        answered with one RESULT_INFECTION_BATCH packet: the score after the batch,
+        the number of patterns and one success bit per pattern (LSB first).
+        Patterns are evaluated all together, then each ownership change is applied
+        under the lock of the shard of its computer, the pattern being evaluated again
+        when the computer got new predicats in between (a world event) or was not drawn yet
+        (lazy construction, only done under the shard lock).
+        """
+        current_taken = self.player_manager.score(player_id)
+        player_name = self.player_manager.name(player_id)
+
+        if current_taken == self.network.size:
+            metrics.count(Metric.INFECTIONS_MAXIMUM_REACHED, len(patterns))
+            game_events.debug(LogMessage("{player_name} has all computers of the network. We don't need to dispatch his virus.", player_name=player_name))
+            packet_max_computers_reached = struct.pack('!BI', ServerOpcode.MAXIMUM_INFECTION, current_taken)
+            yield packet_max_computers_reached
+            network_events.debug(LogMessage("Maximum computers reached packet has been sent to {player_name}.", player_name=player_name))
+            raise StopIteration
+
+        game_events.debug(LogMessage("{player_name} is dispatching a batch of {count} viruses on the network...", player_name=player_name,
+            count=len(patterns)))
+        computers = [self.network.random_index() for pattern in patterns]
+        systems = [self.network.drawn_system(c_id, UNDRAWN_SYSTEM) for c_id in computers]
+        successes = PredicatSystem.eval_many(systems, patterns)
+        results = bytearray((len(patterns) + 7) // 8)
+        for idx, pattern in enumerate(patterns):
+            c_id = computers[idx]
+            with metrics.timed(self.network.shard_lock(c_id), Metric.SHARD_LOCK_WAIT):
+                # Compiled systems are shared by every computer of the same predicats
+                system = self.network.predicat_system(c_id)
+                success = successes[idx] if system is systems[idx] else system.eval_system(pattern)
+                if self._apply_infection(player_id, player_name, pattern, c_id, self.network.state[c_id], success):
+                    results[idx >> 3] |= 1 << (idx & 7)
+        current_taken = self.player_manager.score(player_id)
+
+        packet_result_batch = struct.pack('!BIH', ServerOpcode.RESULT_INFECTION_BATCH, current_taken, len(patterns)) + str(results)
+        if network_events.isEnabledFor(logging.DEBUG):
+            network_events.debug(LogMessage("Infection batch packet result is going to be sent: {raw_data}", raw_data=repr(packet_result_batch)))
+        yield packet_result_batch
+        network_events.debug(LogMessage("Infection batch packet result sent for {player_name}.", player_name=player_name))
+        raise StopIteration
+
+    def on_leaderboard(self, player_id, count):
+        """
+        Answer a LEADERBOARD request with the rank and the score of the player, the number of players
+        listed then the id, the score and the name of the count (at most MAXIMUM_LEADERBOARD) best players.
+        """
+        player_manager = self.player_manager
+        player_manager.leaderboard.refresh(player_manager.player_score.values)
+        score = player_manager.score(player_id)
+        top = player_manager.leaderboard.top(min(count, MAXIMUM_LEADERBOARD))
+        rank = player_manager.leaderboard.rank(player_manager.leaderboard.scores[player_id])
+        packet_leaderboard = struct.pack('!BIIH', ServerOpcode.LEADERBOARD, rank, score, len(top)) + ''.join(
+            LEADERBOARD_RECORD.pack(top_player_id, player_manager.player_score.values[top_player_id], player_manager.name(top_player_id))
+            for top_player_id in top)
+        yield packet_leaderboard
+        network_events.debug(LogMessage("Leaderboard of {count} players sent to {player_name}.", count=len(top),
+            player_name=player_manager.name(player_id)))
+        raise StopIteration
+
+    def _try_infection(self, player_id, player_name, pattern):
+        c_id = self.network.random_index()
+        with metrics.timed(self.network.shard_lock(c_id), Metric.SHARD_LOCK_WAIT):
+            return self._apply_infection(player_id, player_name, pattern, c_id, self.network.state[c_id],
+                self.network.predicat_system(c_id).eval_system(pattern))
+
+    def _apply_infection(self, player_id, player_name, pattern, c_id, state, result):
+        # Called with the shard lock of c_id held
+        result = bool(result)
+        metrics.count(Metric.INFECTIONS_SUCCESS if result else Metric.INFECTIONS_FAILURE)
+        timestamp = next(self.clock)
         if result:
-            game_events.debug("{player_name} has infected computer (id: {computer_id}) with pattern {pattern_code} at {timest} seconds.".format(player_name=player_name,
+            game_events.debug(LogMessage("{player_name} has infected computer (id: {computer_id}) with pattern {pattern_code} at {timest} seconds.", player_name=player_name,
                     computer_id=c_id, pattern_code=pattern, timest=(timestamp - self.start_time)))
 
             self.network.set_state(c_id, player_id)
 
             if state != NetworkValueState.COMPUTER_ALIVE and state != player_id:
-                    self.player_manager.add_score(state, -1)
-                    game_events.debug("{player_name_adv} has lost the computer id {computer_id} against {player_name}!".format(player_name=player_name,
+                    self.player_manager.lose_computer(state, c_id)
+                    self.notifications.computer_lost(state, NotificationKind.COMPUTER_INFECTED, c_id, player_id)
+                    if game_events.isEnabledFor(logging.DEBUG):
+                        game_events.debug(LogMessage("{player_name_adv} has lost the computer id {computer_id} against {player_name}!", player_name=player_name,
                             computer_id=c_id, player_name_adv=self.player_manager.name(state)))
 
             if state != player_id:
-                self.player_manager.add_score(player_id, 1)
-
-            if self.player_manager.score(player_id) != current_taken:
-                self.event_publisher.send("INFECTION_OCCURRED {player_id} {timestamp} {start_time} {score} {pattern} {net_size}".format(player_id=player_id,
-                    timestamp=timestamp, start_time=self.start_time, score=self.player_manager.score(player_id),
-                    pattern=pattern, net_size=self.network.size))
+                score = self.player_manager.gain_computer(player_id, c_id)
+                self.events.publish(EventTopic.INFECTION_OCCURRED, (player_id, c_id, timestamp, score, pattern))
         else:
-            game_events.debug("{player_name} has failed to infect computer (id: {computer_id}) with pattern {pattern_code}.".format(player_name=player_name,
+            game_events.debug(LogMessage("{player_name} has failed to infect computer (id: {computer_id}) with pattern {pattern_code}.", player_name=player_name,
                 computer_id=c_id, pattern_code=pattern))
 
+        if self.archive is not None:
+            # The pattern is encoded by the archive thread, out of the shard lock
+            self.archive.append((timestamp, player_id, c_id, self.player_manager.player_score.values[player_id], pattern,
+                ARCHIVE_INFECTION if result else ARCHIVE_FAILURE))
         self.last_time = timestamp
-        game_events.info("Infection result for {player_name} is: infection {result} ".format(player_name=player_name, result=("SUCCESS" if result else "FAILED")))
-        packet_result_infection = struct.pack('!BII', ServerOpcode.RESULT_INFECTION, current_taken, bool(result))
-        network_events.debug("Infection packet result is going to be sent: {raw_data}".format(raw_data=repr(packet_result_infection)))
-        yield packet_result_infection
-        network_events.info("Infection packet result sent for {player_name}.".format(player_name=player_name))
-        raise StopIteration
-
+        return result
+
+
+# ROOMS
+class RoomRegistry(object):
+    """
+    Network size of every room id, 0 for a room which does not exist. Moved to shared memory
+    with the multiprocess engine: a room created through any worker is known to all of them.
+    """
+
+    def __init__(self, maximum_rooms, maximum_network_size):
+        self.sizes = array('I', [0]) * MAXIMUM_ROOMS
+        self.lock = Lock()
+        self.maximum_rooms = maximum_rooms
+        self.maximum_network_size = maximum_network_size
+
+    def size(self, room_id):
+        # An int: the unsigned values of the array are read as longs
+        return int(self.sizes[room_id]) if 0 <= room_id < MAXIMUM_ROOMS else 0
+
+    def define(self, room_id, size):
+        # The default room is not counted in maximum_rooms
+        if not 0 < room_id < MAXIMUM_ROOMS or not 0 < size <= self.maximum_network_size:
+            return RoomStatus.INVALID
+        with self.lock:
+            if self.sizes[room_id]:
+                return RoomStatus.EXISTS
+            if sum(1 for room_size in self.sizes[1:] if room_size) >= self.maximum_rooms:
+                return RoomStatus.LIMIT_REACHED
+            self.sizes[room_id] = size
+            return RoomStatus.CREATED
+
+    def share_memory(self):
+        self.sizes = multiprocessing.RawArray('I', self.sizes)
+        self.lock = multiprocessing.Lock()
+
+
+class RoomManager(object):
+    """
+    Game states of the rooms served by this process, each one with its own network, scores, checkpoint,
+    world events and event prefix, built by factory(room_id, network size) on their first use.
+    The default room is served by every worker of the multiprocess engine, room r by worker r % workers only.
+    """
+
+    def __init__(self, default_state, factory, maximum_rooms=16, maximum_network_size=200000, maximum_players=0):
+        self.rooms = {DEFAULT_ROOM: default_state}
+        self.factory = factory
+        self.lock = Lock()
+        self.registry = RoomRegistry(maximum_rooms, maximum_network_size)
+        self.registry.sizes[DEFAULT_ROOM] = default_state.network.size
+        self.maximum_players = maximum_players
+        self.workers = 1
+        self.worker_idx = 0
+
+    def owner(self, room_id):
+        return room_id % self.workers
+
+    def served_here(self, room_id):
+        return room_id == DEFAULT_ROOM or self.owner(room_id) == self.worker_idx
+
+    def served_elsewhere(self, room_id):
+        return self.registry.size(room_id) != 0 and not self.served_here(room_id)
+
+    def is_full(self, state):
+        # Called with the game lock of the room held
+        return self.maximum_players > 0 and state.player_manager.online_count() >= self.maximum_players
+
+    def create(self, room_id, size):
+        status = self.registry.define(room_id, size)
+        if status == RoomStatus.CREATED:
+            game_events.info(LogMessage("Room {room_id} of {size} computers has been created.", room_id=room_id, size=size))
+            if self.served_here(room_id):
+                self.get(room_id)
+        else:
+            game_events.warning(LogMessage("Room {room_id} of {size} computers cannot be created: {status}.", room_id=room_id, size=size,
+                status=status.name))
+        return status
+
+    def get(self, room_id):
+        """
+        Return the game state of a room served here, built on the first call. None when the room does not exist.
+        """
+        state = self.rooms.get(room_id)
+        if state is not None:
+            return state
+        size = self.registry.size(room_id)
+        if not size or not self.served_here(room_id):
+            return None
+        with self.lock:
+            if room_id not in self.rooms:
+                state = self.factory(room_id, size)
+                state.scheduler.start()
+                self.rooms[room_id] = state
+            return self.rooms[room_id]
+
+    def open_served(self):
+        # Rooms defined at startup, built before the first connection
+        for room_id in xrange(1, MAXIMUM_ROOMS):
+            if self.registry.size(room_id) and self.served_here(room_id):
+                self.get(room_id)
+
+    def share_memory(self, workers):
+        # Workers call use_worker once forked, this process serves no room
+        self.registry.share_memory()
+        self.workers = workers
+        self.worker_idx = None
+
+    def use_worker(self, worker_idx):
+        self.worker_idx = worker_idx
+
+    def stop(self):
+        # The default room is stopped by the process which created it
+        for room_id, state in self.rooms.items():
+            if room_id != DEFAULT_ROOM:
+                state.stop()
+
+
+def is_local_address(address):
+    return address.startswith('127.') or address == '::1'
+
+
+class FrameReader(object):
+    """
+    Reads a blocking socket into a reusable buffer with recv_into. read() returns the offset of the next field
+    in the buffer, to be decoded in place with struct.unpack_from: several frames received at once are decoded
+    without any other recv. before_blocking is called before waiting for more data, to flush the responses.
+    """
+
+    def __init__(self, sock, size=FRAME_BUFFER_SIZE, before_blocking=None):
+        self.socket = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.before_blocking = before_blocking
+
+    def read(self, size):
+        assert size <= len(self.buffer)
+        while self.end - self.start < size:
+            if self.start == self.end:
+                self.start = self.end = 0
+            elif len(self.buffer) - self.start < size:
+                # The field would not fit at the end of the buffer: the beginning received is moved to the front
+                pending = self.end - self.start
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, pending
+            if self.before_blocking is not None:
+                self.before_blocking()
+            received = self.socket.recv_into(self.view[self.end:])
+            if not received:
+                raise EOFError("Connection closed while {size} bytes were expected.".format(size=size))
+            self.end += received
+            metrics.count(Metric.BYTES_IN, received)
+        offset = self.start
+        self.start += size
+        return offset
 
 
 class VirusGameTCPHandler(SocketServer.BaseRequestHandler):
 
-    def authenticate(self, player_id):
-        with self.server.rlock:
-            network_events.info("Player with id {player_id} is trying to authenticating himself on the server.".format(player_id=player_id))
-            if not self.server.state.player_manager.exists(player_id):
+    def setup(self):
+        metrics.count(Metric.CONNECTIONS_OPENED)
+        # Responses are sent together once every frame already received is handled
+        self.write_buffer = bytearray()
+        self.reader = FrameReader(self.request, before_blocking=self.flush)
+        # Notification frames waiting to be sent: the notification thread of the game only sends them when it does not block,
+        # the handler sends the rest between two requests. Nothing is sent by the notification thread while writing is set.
+        self.pushed = bytearray()
+        self.push_lock = Lock()
+        self.writing = False
+        self.subscribed = False
+
+    def finish(self):
+        metrics.count(Metric.CONNECTIONS_CLOSED)
+
+    def send(self, packet):
+        self.write_buffer += packet
+
+    def flush(self):
+        if self.write_buffer:
+            with self.push_lock:
+                self.writing = True
+            try:
+                # The notification frames started are completed before the responses
+                while True:
+                    with self.push_lock:
+                        pushed = str(self.pushed)
+                        del self.pushed[:]
+                    if not pushed:
+                        break
+                    self.request.sendall(pushed)
+                    metrics.count(Metric.BYTES_OUT, len(pushed))
+                self.request.sendall(self.write_buffer)
+            finally:
+                with self.push_lock:
+                    self.writing = False
+            metrics.count(Metric.BYTES_OUT, len(self.write_buffer))
+            del self.write_buffer[:]
+        if self.subscribed:
+            self.wait_request()
+
+    def wait_request(self):
+        # Sends the notifications left by the notification thread until a request comes
+        while True:
+            with self.push_lock:
+                pending = len(self.pushed) > 0
+            readable, writable, errors = select.select([self.request], [self.request] if pending else [], [], self.game.notifications.interval)
+            if writable:
+                with self.push_lock:
+                    self.send_pushed()
+            if readable:
+                return
+
+    def push(self, frame):
+        # Called by the notification thread of the game, never blocks: a subscriber which does not read its socket misses the notifications
+        with self.push_lock:
+            if len(self.pushed) > NOTIFICATION_BACKLOG_LIMIT:
+                network_events.debug(LogMessage("{player_name} does not read the notifications, {size} bytes dropped.", player_name=self.player_name,
+                    size=len(frame)))
+                return
+            self.pushed += frame
+            if not self.writing:
+                self.send_pushed()
+
+    def send_pushed(self):
+        # Called with push_lock held
+        try:
+            sent = self.request.send(self.pushed, socket.MSG_DONTWAIT)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                # The handler finds the connection closed on its next recv
+                del self.pushed[:]
+            return
+        del self.pushed[:sent]
+        metrics.count(Metric.BYTES_OUT, sent)
+
+    def authenticate(self, player_id, room_id=DEFAULT_ROOM):
+        game = self.server.rooms.get(room_id)
+        if game is None:
+            network_events.warning(LogMessage("Room {room_id} doesn't exist! Closing the connection.", room_id=room_id))
+            self.request.close()
+            return False
+        with metrics.timed(game.rlock, Metric.GAME_LOCK_WAIT):
+            network_events.info(LogMessage("Player with id {player_id} is trying to authenticating himself on the server.", player_id=player_id))
+            if not game.player_manager.exists(player_id):
                 network_events.warning("This player doesn't exists in the database! Closing the connection.")
                 self.request.close()
                 return False
-            if self.server.state.player_manager.connected(player_id):
-                network_events.error("The player {player_name} is already connected! Hacking attempt!".format(player_name=self.server.state.player_manager.name(player_id)))
+            if game.player_manager.connected(player_id):
+                network_events.error(LogMessage("The player {player_name} is already connected! Hacking attempt!", player_name=game.player_manager.name(player_id)))
+                self.request.close()
+                return False
+            if self.server.rooms.is_full(game):
+                network_events.warning(LogMessage("Room {room_id} is full! Closing the connection.", room_id=room_id))
                 self.request.close()
                 return False
 
-            self.player_name = self.server.state.player_manager.name(player_id)
+            self.game = game
+            self.player_name = game.player_manager.name(player_id)
             self.player_id = player_id
-            network_events.info("Player with id {player_id} has been authenticated as {player_name}.".format(player_id=self.player_id,
-                player_name=self.player_name))
+            network_events.info(LogMessage("Player with id {player_id} has been authenticated as {player_name} in room {room_id}.", player_id=self.player_id,
+                player_name=self.player_name, room_id=room_id))
 
-            packet_auth_response = struct.pack('!BI', ServerOpcode.NETWORK_SIZE_ANNOUNCEMENT, self.server.state.network.size)
-            self.request.sendall(packet_auth_response)
+            packet_auth_response = struct.pack('!BI', ServerOpcode.NETWORK_SIZE_ANNOUNCEMENT, game.network.size)
+            self.send(packet_auth_response)
+            game.on_new_player_connected(player_id)
 
             return True
 
     def dispatch_infection(self, player_infection_pattern):
-        for packet in self.server.state.on_dispatch_infection(self.player_id, player_infection_pattern):
-            self.request.sendall(packet)
+        for packet in self.game.on_dispatch_infection(self.player_id, player_infection_pattern):
+            self.send(packet)
+
+    def dispatch_infection_batch(self, player_infection_patterns):
+        for packet in self.game.on_dispatch_infection_batch(self.player_id, player_infection_patterns):
+            self.send(packet)
 
     def handle(self):
-        network_events.debug("Connection received, a new client has spawn ({ip}:{port})!".format(ip=self.client_address[0], port=self.client_address[1]))
+        network_events.debug(LogMessage("Connection received, a new client has spawn ({ip}:{port})!", ip=self.client_address[0], port=self.client_address[1]))
         Running = True
         Authenticated = False
         while Running:
             try:
                 if not Authenticated:
-                    network_events.debug("Data received from {ip}!".format(ip=self.client_address[0]))
+                    network_events.debug(LogMessage("Data received from {ip}!", ip=self.client_address[0]))
                 else:
-                    network_events.debug("Data received from {player_name}!".format(player_name=self.player_name))
+                    network_events.debug(LogMessage("Data received from {player_name}!", player_name=self.player_name))
 
-                opcode, = struct.unpack('!B', self.request.recv(1))
+                received = self.reader.buffer
+                opcode = received[self.reader.read(1)]
+                if metrics.enabled:
+                    opcode_start = time.time()
                 if not Authenticated:
-                    network_events.debug("Opcode decoded is {opcode_id} from {ip}!".format(opcode_id=opcode, ip=self.client_address[0]))
+                    network_events.debug(LogMessage("Opcode decoded is {opcode_id} from {ip}!", opcode_id=opcode, ip=self.client_address[0]))
                 else:
-                    network_events.debug("Opcode decoded is {opcode_id} from {player_name}!".format(opcode_id=opcode, player_name=self.player_name))
+                    network_events.debug(LogMessage("Opcode decoded is {opcode_id} from {player_name}!", opcode_id=opcode, player_name=self.player_name))
 
-                if opcode == ClientOpcode.AUTH:
-                    player_id, = struct.unpack('!H', self.request.recv(2))
-                    Authenticated = self.authenticate(player_id)
+                if opcode in (ClientOpcode.AUTH, ClientOpcode.AUTH_ROOM):
+                    if opcode == ClientOpcode.AUTH:
+                        player_id, = struct.unpack_from('!H', received, self.reader.read(2))
+                        room_id = DEFAULT_ROOM
+                    else:
+                        player_id, room_id = struct.unpack_from('!HH', received, self.reader.read(4))
+                    Authenticated = self.authenticate(player_id, room_id)
 
                     if not Authenticated:
-                        network_events.info("{player_id}/{ip} has been refused and disconnected.".format(player_id=player_id, ip=self.client_address[0]))
+                        network_events.info(LogMessage("{player_id}/{ip} has been refused and disconnected.", player_id=player_id, ip=self.client_address[0]))
                         Running = False
                     else:
-                        network_events.info("{player_name} is now authenticated as {ip}.".format(player_name=self.player_name, ip=self.client_address[0]))
-                        self.server.state.on_new_player_connected(player_id)
+                        network_events.info(LogMessage("{player_name} is now authenticated as {ip}.", player_name=self.player_name, ip=self.client_address[0]))
 
                 elif opcode == ClientOpcode.INFECTION and Authenticated:
-                    network_events.debug("Received infection opcode from {player_name}...".format(player_name=self.player_name))
-                    player_infection_pattern, = map(str.strip, struct.unpack('!8s', self.request.recv(8)))
-                    network_events.debug("{player_name} is trying to infect computers with pattern {pattern_code}.".format(player_name=self.player_name,
+                    network_events.debug(LogMessage("Received infection opcode from {player_name}...", player_name=self.player_name))
+                    offset = self.reader.read(8)
+                    player_infection_pattern = str(received[offset:offset + 8]).strip()
+                    network_events.debug(LogMessage("{player_name} is trying to infect computers with pattern {pattern_code}.", player_name=self.player_name,
                         pattern_code=player_infection_pattern))
                     self.dispatch_infection(player_infection_pattern)
-                elif opcode == ClientOpcode.INFECTION and not Authenticated:
-                    network_events.error("Received infection opcode without authentication from {ip}... Disconnecting the client.".format(ip=self.client_address[0]))
+                elif opcode == ClientOpcode.INFECTION_BATCH and Authenticated:
+                    count, = struct.unpack_from('!H', received, self.reader.read(2))
+                    if count == 0 or count > MAXIMUM_INFECTION_BATCH:
+                        network_events.error(LogMessage("{player_name} has sent an invalid batch of {count} patterns... Disconnecting the client.", player_name=self.player_name,
+                            count=count))
+                        self.request.close()
+                        Running = False
+                        self.game.on_player_disconnected(self.player_id)
+                        continue
+                    offset = self.reader.read(8 * count)
+                    player_infection_patterns = [str(received[start:start + 8]).strip() for start in xrange(offset, offset + 8 * count, 8)]
+                    network_events.debug(LogMessage("{player_name} is trying to infect computers with a batch of {count} patterns.", player_name=self.player_name,
+                        count=count))
+                    self.dispatch_infection_batch(player_infection_patterns)
+                elif opcode == ClientOpcode.LEADERBOARD and Authenticated:
+                    count, = struct.unpack_from('!H', received, self.reader.read(2))
+                    for packet in self.game.on_leaderboard(self.player_id, count):
+                        self.send(packet)
+                elif opcode == ClientOpcode.SUBSCRIBE and Authenticated:
+                    flags = received[self.reader.read(1)]
+                    self.subscribed = flags != 0
+                    self.game.notifications.subscribe(self.player_id, flags, self.push)
+                    network_events.debug(LogMessage("{player_name} has subscribed to the notifications {flags}.", player_name=self.player_name, flags=flags))
+                elif opcode in (ClientOpcode.INFECTION, ClientOpcode.INFECTION_BATCH, ClientOpcode.LEADERBOARD, ClientOpcode.SUBSCRIBE) and not Authenticated:
+                    network_events.error(LogMessage("Received infection opcode without authentication from {ip}... Disconnecting the client.", ip=self.client_address[0]))
                     self.request.close()
                     Running = False
                 elif opcode == ClientOpcode.DISCONNECTION:
-                    network_events.info("{player_name} has send the end opcode which means that he wants to disconnect.".format(player_name=self.player_name))
+                    network_events.info(LogMessage("{player_name} has send the end opcode which means that he wants to disconnect.", player_name=self.player_name))
+                    Running = False
+                    self.game.on_player_disconnected(self.player_id)
+                elif opcode == ClientOpcode.STATS and is_local_address(self.client_address[0]):
+                    self.send(pack_stats())
+                elif opcode == ClientOpcode.CREATE_ROOM and is_local_address(self.client_address[0]):
+                    room_id, size = struct.unpack_from('!HI', received, self.reader.read(6))
+                    self.send(struct.pack('!BHB', ServerOpcode.ROOM_CREATED, room_id, self.server.rooms.create(room_id, size)))
+                elif opcode in (ClientOpcode.STATS, ClientOpcode.CREATE_ROOM):
+                    network_events.error(LogMessage("Received administration opcode {opcode_id} from {ip} which is not a local address... Disconnecting the client.",
+                        opcode_id=opcode, ip=self.client_address[0]))
+                    self.request.close()
                     Running = False
-                    self.server.state.on_player_disconnected(self.player_id)
+
+                if metrics.enabled:
+                    metrics.observe_opcode(opcode, opcode_start)
             except Exception as e:
                 if Authenticated:
-                    network_events.exception("Player {player_name} (id: {player_id}) seems to have crashed.".format(player_name=self.player_name, player_id=self.player_id))
+                    network_events.exception(LogMessage("Player {player_name} (id: {player_id}) seems to have crashed.", player_name=self.player_name, player_id=self.player_id))
                     self.request.close()
-                    self.server.state.on_player_disconnected(self.player_id)
+                    self.game.on_player_disconnected(self.player_id)
                 else:
-                    network_events.exception("Player {ip} seems to have crashed.".format(ip=self.client_address[0]))
+                    network_events.exception(LogMessage("Player {ip} seems to have crashed.", ip=self.client_address[0]))
                     self.request.close()
 
                 Running = False
 
-            # self.timers += [Timer(2500, partial(GameState.randomize_network, self.server.state)), Timer(8600, partial(GameState.kill_viruses, self.server.state))]
+        # Responses to the last frames, before a disconnection
+        self.subscribed = False
+        try:
+            self.flush()
+        except socket.error:
+            pass
+
+
+class EventPoller(object):
+    """
+    Readiness notification over epoll, poll or select, whichever the platform provides.
+    Events are reported as (fd, mask) pairs using the READ/WRITE/ERROR masks of the instance.
+    """
+
+    def __init__(self):
+        self.registered = {}
+        if hasattr(select, 'epoll'):
+            self.backend = select.epoll()
+            self.READ, self.WRITE, self.ERROR = select.EPOLLIN, select.EPOLLOUT, select.EPOLLERR | select.EPOLLHUP
+            self.timeout_scale = 1
+        elif hasattr(select, 'poll'):
+            self.backend = select.poll()
+            self.READ, self.WRITE, self.ERROR = select.POLLIN, select.POLLOUT, select.POLLERR | select.POLLHUP
+            self.timeout_scale = 1000
+        else:
+            self.backend = None
+            self.READ, self.WRITE, self.ERROR = 1, 4, 8
+            self.timeout_scale = 1
+
+    def register(self, fd, events):
+        self.registered[fd] = events
+        if self.backend is not None:
+            self.backend.register(fd, events)
+
+    def modify(self, fd, events):
+        self.registered[fd] = events
+        if self.backend is not None:
+            self.backend.modify(fd, events)
+
+    def unregister(self, fd):
+        del self.registered[fd]
+        if self.backend is not None:
+            self.backend.unregister(fd)
+
+    def poll(self, timeout):
+        try:
+            if self.backend is not None:
+                return self.backend.poll(timeout * self.timeout_scale)
+
+            readers = [fd for fd, events in self.registered.items() if events & self.READ]
+            writers = [fd for fd, events in self.registered.items() if events & self.WRITE]
+            readable, writable, errored = select.select(readers, writers, readers, timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        ready = {}
+        for fd in readable:
+            ready[fd] = ready.get(fd, 0) | self.READ
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | self.WRITE
+        for fd in errored:
+            ready[fd] = ready.get(fd, 0) | self.ERROR
+        return ready.items()
+
+
+class VirusGameConnection(object):
+    """
+    One client of the event-loop engine.
+
+    The blocking while-loop of VirusGameTCPHandler.handle() is replaced by a state machine:
+    each state knows how many bytes it is waiting for, whatever the socket returns is appended
+    to a per-connection read buffer and fields are consumed as soon as they are complete.
+    Responses go to a write buffer which is flushed when the socket is writable.
+    """
+    WAIT_OPCODE = 0
+    WAIT_AUTH = 1
+    WAIT_PATTERN = 2
+    WAIT_BATCH_COUNT = 3
+    WAIT_BATCH_PATTERNS = 4
+    WAIT_LEADERBOARD_COUNT = 5
+    WAIT_AUTH_ROOM = 6
+    WAIT_CREATE_ROOM = 7
+    WAIT_SUBSCRIBE = 8
+
+    READ_SIZE = 65536
+    # Stop reading from a client which does not read its responses
+    WRITE_BUFFER_LIMIT = 1024 * 1024
+
+    def __init__(self, server, request, client_address):
+        self.server = server
+        self.request = request
+        self.client_address = client_address
+        self.fd = None
+
+        self.read_buffer = bytearray()
+        self.write_buffer = bytearray()
+        self.state = self.WAIT_OPCODE
+        self.expected = 1
+        self.events = 0
+
+        self.running = True
+        self.authenticated = False
+        self.game = None
+        self.player_id = None
+        self.player_name = None
+        self.opcode = None
+        self.opcode_start = None
+
+        network_events.debug(LogMessage("Connection received, a new client has spawn ({ip}:{port})!", ip=client_address[0], port=client_address[1]))
+
+    def wants_read(self):
+        return self.running and len(self.write_buffer) < self.WRITE_BUFFER_LIMIT
+
+    def wants_write(self):
+        return len(self.write_buffer) > 0
+
+    def wait_for(self, state, size):
+        self.state = state
+        self.expected = size
+
+    def send(self, packet):
+        self.write_buffer += packet
+        self.flush()
+
+    def flush(self):
+        while self.write_buffer:
+            try:
+                sent = self.request.send(self.write_buffer)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            del self.write_buffer[:sent]
+            metrics.count(Metric.BYTES_OUT, sent)
+
+    def on_readable(self):
+        try:
+            data = self.request.recv(self.READ_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        if not data:
+            raise EOFError("Connection closed by {ip}.".format(ip=self.client_address[0]))
+        metrics.count(Metric.BYTES_IN, len(data))
+        self.consume(data)
+
+    def consume(self, data):
+        self.read_buffer += data
+        offset = 0
+        while self.running and len(self.read_buffer) - offset >= self.expected:
+            size = self.expected
+            self.on_field(offset)
+            offset += size
+        del self.read_buffer[:offset]
+
+    def on_field(self, offset):
+        if self.state == self.WAIT_OPCODE:
+            self.on_opcode(self.read_buffer[offset])
+
+        elif self.state == self.WAIT_AUTH:
+            player_id, = struct.unpack_from('!H', self.read_buffer, offset)
+            self.on_authentication(player_id, DEFAULT_ROOM)
+            self.wait_for(self.WAIT_OPCODE, 1)
+
+        elif self.state == self.WAIT_AUTH_ROOM:
+            player_id, room_id = struct.unpack_from('!HH', self.read_buffer, offset)
+            if self.server.rooms.served_elsewhere(room_id):
+                self.hand_off(player_id, room_id, offset + self.expected)
+            else:
+                self.on_authentication(player_id, room_id)
+            self.wait_for(self.WAIT_OPCODE, 1)
+
+        elif self.state == self.WAIT_CREATE_ROOM:
+            room_id, size = struct.unpack_from('!HI', self.read_buffer, offset)
+            self.send(struct.pack('!BHB', ServerOpcode.ROOM_CREATED, room_id, self.server.rooms.create(room_id, size)))
+            self.on_frame_handled()
+            self.wait_for(self.WAIT_OPCODE, 1)
+
+        elif self.state == self.WAIT_PATTERN:
+            player_infection_pattern = str(self.read_buffer[offset:offset + 8]).strip()
+            network_events.debug(LogMessage("{player_name} is trying to infect computers with pattern {pattern_code}.", player_name=self.player_name,
+                pattern_code=player_infection_pattern))
+            for packet in self.game.on_dispatch_infection(self.player_id, player_infection_pattern):
+                self.send(packet)
+            self.on_frame_handled()
+            self.wait_for(self.WAIT_OPCODE, 1)
+
+        elif self.state == self.WAIT_BATCH_COUNT:
+            count, = struct.unpack_from('!H', self.read_buffer, offset)
+            if count == 0 or count > MAXIMUM_INFECTION_BATCH:
+                network_events.error(LogMessage("{player_name} has sent an invalid batch of {count} patterns... Disconnecting the client.", player_name=self.player_name,
+                    count=count))
+                self.running = False
+                self.game.on_player_disconnected(self.player_id)
+            else:
+                self.wait_for(self.WAIT_BATCH_PATTERNS, 8 * count)
+
+        elif self.state == self.WAIT_SUBSCRIBE:
+            flags = self.read_buffer[offset]
+            self.game.notifications.subscribe(self.player_id, flags, partial(self.server.push, self))
+            network_events.debug(LogMessage("{player_name} has subscribed to the notifications {flags}.", player_name=self.player_name, flags=flags))
+            self.on_frame_handled()
+            self.wait_for(self.WAIT_OPCODE, 1)
+
+        elif self.state == self.WAIT_LEADERBOARD_COUNT:
+            count, = struct.unpack_from('!H', self.read_buffer, offset)
+            for packet in self.game.on_leaderboard(self.player_id, count):
+                self.send(packet)
+            self.on_frame_handled()
+            self.wait_for(self.WAIT_OPCODE, 1)
+
+        elif self.state == self.WAIT_BATCH_PATTERNS:
+            player_infection_patterns = [str(self.read_buffer[start:start + 8]).strip() for start in xrange(offset, offset + self.expected, 8)]
+            network_events.debug(LogMessage("{player_name} is trying to infect computers with a batch of {count} patterns.", player_name=self.player_name,
+                count=len(player_infection_patterns)))
+            for packet in self.game.on_dispatch_infection_batch(self.player_id, player_infection_patterns):
+                self.send(packet)
+            self.on_frame_handled()
+            self.wait_for(self.WAIT_OPCODE, 1)
+
+    def on_authentication(self, player_id, room_id):
+        self.authenticated = self.authenticate(player_id, room_id)
+
+        if not self.authenticated:
+            network_events.info(LogMessage("{player_id}/{ip} has been refused and disconnected.", player_id=player_id, ip=self.client_address[0]))
+            self.running = False
+        else:
+            network_events.info(LogMessage("{player_name} is now authenticated as {ip}.", player_name=self.player_name, ip=self.client_address[0]))
+        self.on_frame_handled()
+
+    def hand_off(self, player_id, room_id, end):
+        # The worker serving the room authenticates the player, with what was received after AUTH_ROOM and is not sent yet
+        network_events.debug(LogMessage("{player_id}/{ip} is handed off to the worker of room {room_id}.", player_id=player_id, ip=self.client_address[0],
+            room_id=room_id))
+        self.server.handoff.send(self.server.rooms.owner(room_id), self.request,
+            (player_id, room_id, self.client_address, str(self.read_buffer[end:]), str(self.write_buffer)))
+        del self.write_buffer[:]
+        self.running = False
+        self.on_frame_handled()
+
+    def on_frame_handled(self):
+        if metrics.enabled:
+            metrics.observe_opcode(self.opcode, self.opcode_start)
+
+    def on_opcode(self, opcode):
+        if not self.authenticated:
+            network_events.debug(LogMessage("Opcode decoded is {opcode_id} from {ip}!", opcode_id=opcode, ip=self.client_address[0]))
+        else:
+            network_events.debug(LogMessage("Opcode decoded is {opcode_id} from {player_name}!", opcode_id=opcode, player_name=self.player_name))
+        self.opcode = opcode
+        if metrics.enabled:
+            self.opcode_start = time.time()
+
+        if opcode == ClientOpcode.AUTH:
+            self.wait_for(self.WAIT_AUTH, 2)
+        elif opcode == ClientOpcode.AUTH_ROOM:
+            self.wait_for(self.WAIT_AUTH_ROOM, 4)
+        elif opcode == ClientOpcode.INFECTION and self.authenticated:
+            self.wait_for(self.WAIT_PATTERN, 8)
+        elif opcode == ClientOpcode.INFECTION_BATCH and self.authenticated:
+            self.wait_for(self.WAIT_BATCH_COUNT, 2)
+        elif opcode == ClientOpcode.LEADERBOARD and self.authenticated:
+            self.wait_for(self.WAIT_LEADERBOARD_COUNT, 2)
+        elif opcode == ClientOpcode.SUBSCRIBE and self.authenticated:
+            self.wait_for(self.WAIT_SUBSCRIBE, 1)
+        elif opcode in (ClientOpcode.INFECTION, ClientOpcode.INFECTION_BATCH, ClientOpcode.LEADERBOARD, ClientOpcode.SUBSCRIBE) and not self.authenticated:
+            network_events.error(LogMessage("Received infection opcode without authentication from {ip}... Disconnecting the client.", ip=self.client_address[0]))
+            self.running = False
+        elif opcode == ClientOpcode.DISCONNECTION and self.authenticated:
+            network_events.info(LogMessage("{player_name} has send the end opcode which means that he wants to disconnect.", player_name=self.player_name))
+            self.running = False
+            self.game.on_player_disconnected(self.player_id)
+            self.on_frame_handled()
+        elif opcode == ClientOpcode.DISCONNECTION:
+            self.running = False
+        elif opcode == ClientOpcode.STATS and is_local_address(self.client_address[0]):
+            self.send(pack_stats())
+            self.on_frame_handled()
+        elif opcode == ClientOpcode.CREATE_ROOM and is_local_address(self.client_address[0]):
+            self.wait_for(self.WAIT_CREATE_ROOM, 6)
+        elif opcode in (ClientOpcode.STATS, ClientOpcode.CREATE_ROOM):
+            network_events.error(LogMessage("Received administration opcode {opcode_id} from {ip} which is not a local address... Disconnecting the client.",
+                opcode_id=opcode, ip=self.client_address[0]))
+            self.running = False
+
+    def authenticate(self, player_id, room_id):
+        game = self.server.rooms.get(room_id)
+        if game is None:
+            network_events.warning(LogMessage("Room {room_id} doesn't exist! Closing the connection.", room_id=room_id))
+            return False
+        with metrics.timed(game.rlock, Metric.GAME_LOCK_WAIT):
+            network_events.info(LogMessage("Player with id {player_id} is trying to authenticating himself on the server.", player_id=player_id))
+            if not game.player_manager.exists(player_id):
+                network_events.warning("This player doesn't exists in the database! Closing the connection.")
+                return False
+            if game.player_manager.connected(player_id):
+                network_events.error(LogMessage("The player {player_name} is already connected! Hacking attempt!", player_name=game.player_manager.name(player_id)))
+                return False
+            if self.server.rooms.is_full(game):
+                network_events.warning(LogMessage("Room {room_id} is full! Closing the connection.", room_id=room_id))
+                return False
 
+            self.game = game
+            self.player_name = game.player_manager.name(player_id)
+            self.player_id = player_id
+            network_events.info(LogMessage("Player with id {player_id} has been authenticated as {player_name} in room {room_id}.", player_id=self.player_id,
+                player_name=self.player_name, room_id=room_id))
+
+            packet_auth_response = struct.pack('!BI', ServerOpcode.NETWORK_SIZE_ANNOUNCEMENT, game.network.size)
+            self.send(packet_auth_response)
+            game.on_new_player_connected(player_id)
+
+            return True
+
+    def on_crash(self):
+        if self.authenticated and self.running:
+            network_events.exception(LogMessage("Player {player_name} (id: {player_id}) seems to have crashed.", player_name=self.player_name, player_id=self.player_id))
+            self.game.on_player_disconnected(self.player_id)
+        else:
+            network_events.exception(LogMessage("Player {ip} seems to have crashed.", ip=self.client_address[0]))
+        self.running = False
+        del self.write_buffer[:]
+
+
+class VirusGameEventLoopServer(object):
+    """
+    Single-threaded, non-blocking alternative to SocketServer.ThreadingTCPServer.
+    Speaks the same opcodes as VirusGameTCPHandler without one OS thread per connection.
+    In a worker of the multiprocess engine, the connections to the rooms of the other workers go through handoff,
+    and the notifications of its subscribers produced by the other processes are received from router.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, rooms, listener=None, handoff=None, router=None):
+        self.server_address = server_address
+        self.rooms = rooms
+        self.handoff = handoff
+        self.router = router
+
+        if listener is None:
+            listener = create_listener(server_address, self.request_queue_size)
+        self.socket = listener
+
+        self.poller = EventPoller()
+        self.poller.register(self.socket.fileno(), self.poller.READ)
+        if handoff is not None:
+            self.poller.register(handoff.fileno(), self.poller.READ)
+        if router is not None:
+            self.poller.register(router.fileno(), self.poller.READ)
+        self.connections = {}
+
+        # Notifications pushed by other threads, sent from the loop once it is woken up by the pipe
+        self.pushed = collections.deque()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.poller.register(self.wakeup_read, self.poller.READ)
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            while True:
+                for fd, events in self.poller.poll(poll_interval):
+                    if fd == self.socket.fileno():
+                        self.accept_connections()
+                        continue
+                    if self.handoff is not None and fd == self.handoff.fileno():
+                        self.adopt_connection()
+                        continue
+                    if self.router is not None and fd == self.router.fileno():
+                        self.rooms.get(DEFAULT_ROOM).notifications.deliver_forwarded(self.router.receive())
+                        continue
+                    if fd == self.wakeup_read:
+                        self.send_pushed()
+                        continue
+
+                    connection = self.connections.get(fd)
+                    if connection is None:
+                        continue
+
+                    try:
+                        if events & (self.poller.READ | self.poller.ERROR):
+                            connection.on_readable()
+                        if events & self.poller.WRITE:
+                            connection.flush()
+                    except Exception:
+                        connection.on_crash()
+                    self.update_connection(fd, connection)
+        finally:
+            for fd, connection in self.connections.items():
+                self.close_connection(fd, connection)
+            self.socket.close()
+            os.close(self.wakeup_read)
+            os.close(self.wakeup_write)
+
+    def push(self, connection, frame):
+        # Called by the notification threads: the loop is woken up once for all the frames pushed before it runs
+        wake_up = not self.pushed
+        self.pushed.append((connection, frame))
+        if wake_up:
+            os.write(self.wakeup_write, '\0')
+
+    def send_pushed(self):
+        os.read(self.wakeup_read, 4096)
+        while self.pushed:
+            connection, frame = self.pushed.popleft()
+            # A subscriber which does not read its responses misses the notifications
+            if self.connections.get(connection.fd) is not connection or not connection.running or not connection.wants_read():
+                continue
+            try:
+                connection.send(frame)
+            except Exception:
+                connection.on_crash()
+            self.update_connection(connection.fd, connection)
 
-def configure_logger(logger, filename, fmt, level, datefmt):
+    def accept_connections(self):
+        while True:
+            try:
+                request, client_address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    network_events.exception("Failed to accept a new connection.")
+                return
+
+            request.setblocking(0)
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.add_connection(VirusGameConnection(self, request, client_address))
+
+    def adopt_connection(self):
+        # A connection handed off by another worker after its AUTH_ROOM frame
+        request, (player_id, room_id, client_address, unread, unsent) = self.handoff.receive()
+        request.setblocking(0)
+        connection = VirusGameConnection(self, request, client_address)
+        connection.write_buffer += unsent
+        self.add_connection(connection)
+        try:
+            connection.on_authentication(player_id, room_id)
+            if connection.running:
+                connection.consume(unread)
+        except Exception:
+            connection.on_crash()
+        self.update_connection(request.fileno(), connection)
+
+    def add_connection(self, connection):
+        metrics.count(Metric.CONNECTIONS_OPENED)
+        connection.events = self.poller.READ
+        connection.fd = connection.request.fileno()
+        self.connections[connection.fd] = connection
+        self.poller.register(connection.fd, connection.events)
+
+    def update_connection(self, fd, connection):
+        if not connection.running and not connection.wants_write():
+            self.close_connection(fd, connection)
+            return
+
+        events = (self.poller.READ if connection.wants_read() else 0) | (self.poller.WRITE if connection.wants_write() else 0)
+        if events != connection.events:
+            connection.events = events
+            self.poller.modify(fd, events)
+
+    def close_connection(self, fd, connection):
+        self.poller.unregister(fd)
+        del self.connections[fd]
+        connection.request.close()
+        metrics.count(Metric.CONNECTIONS_CLOSED)
+
+
+def create_listener(server_address, request_queue_size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(server_address)
+    listener.listen(request_queue_size)
+    listener.setblocking(0)
+    return listener
+
+
+class ConnectionHandoff(object):
+    """
+    Moves a connection to the worker process serving its room: the socket is passed over a Unix socket pair
+    of that worker, followed by the player, the room and the bytes not handled yet.
+    """
+
+    def __init__(self, workers):
+        self.pipes = [multiprocessing.Pipe() for worker_idx in range(workers)]
+        # Any worker sends to a pipe, the descriptor and the message must not be interleaved with another handoff
+        self.locks = [multiprocessing.Lock() for worker_idx in range(workers)]
+        self.worker_idx = None
+
+    def use_worker(self, worker_idx):
+        self.worker_idx = worker_idx
+
+    def fileno(self):
+        return self.pipes[self.worker_idx][0].fileno()
+
+    def send(self, worker_idx, request, message):
+        with self.locks[worker_idx]:
+            sending = self.pipes[worker_idx][1]
+            reduction.send_handle(sending, request.fileno(), None)
+            sending.send(message)
+
+    def receive(self):
+        receiving = self.pipes[self.worker_idx][0]
+        fd = reduction.recv_handle(receiving)
+        request = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        return request, receiving.recv()
+
+
+def run_worker(worker_idx, server_address, listener, rooms, handoff, router, events_endpoint):
+    # Forked processes must not share the random generator state nor the ZeroMQ context of their parent
+    random.seed()
+    log_writer.restart_after_fork()
+    metrics.use_shared_shard(worker_idx)
+    # Being terminated by the parent must still flush the logs and close the sockets
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    state = rooms.get(DEFAULT_ROOM)
+    worker_context = zmq.Context()
+    state.event_publisher = worker_context.socket(zmq.PUSH)
+    state.event_publisher.connect(events_endpoint)
+    state.events.start()
+    if state.archive is not None:
+        state.archive.start("worker{idx}".format(idx=worker_idx))
+    rooms.use_worker(worker_idx)
+    handoff.use_worker(worker_idx)
+    router.use_worker(worker_idx)
+    state.notifications.start()
+
+    server = VirusGameEventLoopServer(server_address, rooms, listener, handoff, router)
+    try:
+        rooms.open_served()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rooms.stop()
+        if state.archive is not None:
+            state.archive.close()
+        state.event_publisher.close(linger=0)
+        worker_context.term()
+        log_writer.stop()
+
+
+class VirusGameMultiprocessServer(object):
+    """
+    Pre-forked server: the listening socket is created here and accepted from by worker processes,
+    each one running an event loop over a game state moved to shared memory beforehand.
+    The other rooms are not shared: each one lives in the worker serving it, which is handed the connections to it.
+    Workers push their events to this process, the only one publishing on the event publisher.
+    """
+    request_queue_size = 1024
+
+    def __init__(self, server_address, rooms, workers):
+        self.server_address = server_address
+        self.rooms = rooms
+        self.state = rooms.get(DEFAULT_ROOM)
+        self.workers_count = workers
+        self.workers = []
+
+        self.state.share_memory()
+        rooms.share_memory(workers)
+        metrics.share_memory(workers)
+        self.handoff = ConnectionHandoff(workers)
+        # The notifications produced here (world events) and in the workers reach the worker of their subscriber
+        self.router = NotificationRouter(workers)
+        self.state.notifications.use_router(self.router)
+        self.socket = create_listener(server_address, self.request_queue_size)
+
+        self.events = context.socket(zmq.PULL)
+        self.events_endpoint = 'tcp://127.0.0.1:{port}'.format(port=self.events.bind_to_random_port('tcp://127.0.0.1'))
+
+    def serve_forever(self):
+        for worker_idx in range(self.workers_count):
+            worker = multiprocessing.Process(target=run_worker, name="VirusGame worker {idx}".format(idx=worker_idx),
+                args=(worker_idx, self.server_address, self.socket, self.rooms, self.handoff, self.router, self.events_endpoint))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        network_events.info(LogMessage("{count} worker processes are serving connections.", count=self.workers_count))
+        # World events run in this process, over the shared game state
+        self.state.scheduler.start()
+
+        # Being terminated must still stop the workers
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                self.state.send_event(self.events.recv())
+        finally:
+            for worker in self.workers:
+                worker.terminate()
+                worker.join()
+            self.events.close(linger=0)
+            self.socket.close()
+
+
+def configure_logger(logger, filename, fmt, level, datefmt, writer=None):
     stderr = StreamHandler()
     filehandler = FileHandler(filename)
     formatter = Formatter(fmt=fmt, datefmt=datefmt)
 
-    logger.addHandler(stderr)
-    logger.addHandler(filehandler)
+    if writer is not None:
+        writer.attach(logger, [stderr, filehandler])
+    else:
+        logger.addHandler(stderr)
+        logger.addHandler(filehandler)
 
     logger.setLevel(level)
 
@@ -423,7 +3191,7 @@ if __name__ == "__main__":
     baseConfiguration = {}
     with open("config.conf", "r") as f:
         for line in f:
-            if not line.startswith("#"):
+            if line.strip() and not line.startswith("#"):
                 conf_data = line.split("=")
                 if 'logging_level' in conf_data[0].lower():
                     numeric_value = getattr(logging, conf_data[1].upper().strip(), None)
@@ -436,21 +3204,76 @@ if __name__ == "__main__":
     basicDateFmt = "%d/%m/%Y %H:%M:%S"
 
     try:
-        configure_logger(game_events, 'game.log', basicFormat, baseConfiguration["game_events_logging_level"], basicDateFmt)
-        configure_logger(network_events, 'network.log', basicFormat, baseConfiguration["network_events_logging_level"], basicDateFmt)
-        configure_logger(api_events, 'api.log', basicFormat, baseConfiguration['api_events_logging_level'], basicDateFmt)
+        logging_mode = baseConfiguration.get("logging_mode", "queued")
+        if logging_mode not in ("direct", "queued"):
+            raise ValueError("Unknown logging mode {mode}.".format(mode=logging_mode))
+        writer = log_writer if logging_mode == "queued" else None
+        configure_logger(game_events, 'game.log', basicFormat, baseConfiguration["game_events_logging_level"], basicDateFmt, writer)
+        configure_logger(network_events, 'network.log', basicFormat, baseConfiguration["network_events_logging_level"], basicDateFmt, writer)
+        configure_logger(api_events, 'api.log', basicFormat, baseConfiguration['api_events_logging_level'], basicDateFmt, writer)
+        if writer is not None:
+            writer.start()
     except Exception as e:
         raise Exception("Failed to configure loggers, verify the configuration file (config.conf). The syntax may be broken or needed value absent.\nOriginal exception: {exc}".format(exc=repr(e)))
 
-    rlock = RLock()
+    if baseConfiguration.get("metrics", "disabled") == "enabled":
+        metrics = Metrics()
+
+    server_engine = baseConfiguration.get("server_engine", "threaded")
+    rlock = multiprocessing.RLock() if server_engine == "multiprocess" else RLock()
 
     game_events.info("Generating the game world state...")
-    state = GameState(rlock)
+    game_settings = dict(shards=int(baseConfiguration.get("network_lock_shards", NETWORK_LOCK_SHARDS)),
+        event_format=baseConfiguration.get("event_format", "text"),
+        event_batch_interval=int(baseConfiguration.get("event_batch_interval", 0)),
+        event_batch_size=int(baseConfiguration.get("event_batch_size", 256)),
+        checkpoint_interval=float(baseConfiguration.get("checkpoint_interval", 0)),
+        randomization_period=float(baseConfiguration.get("network_randomization_period", 0)),
+        randomization_chance=float(baseConfiguration.get("network_randomization_chance", AV_DETECTION_CHANCE)),
+        world_slice_size=int(baseConfiguration.get("world_slice_size", WORLD_SLICE_SIZE)),
+        world_slice_interval=int(baseConfiguration.get("world_slice_interval", WORLD_SLICE_INTERVAL * 1000)) / 1000.0,
+        archive_directory=baseConfiguration.get("event_archive") or None,
+        archive_limit=int(baseConfiguration.get("event_archive_limit", 0)) * 2**20,
+        notification_interval=int(baseConfiguration.get("notification_interval", NOTIFICATION_INTERVAL * 1000)) / 1000.0,
+        network_construction=baseConfiguration.get("network_construction", "lazy"),
+        construction_processes=int(baseConfiguration.get("network_construction_processes", 0)))
+    if game_settings["network_construction"] not in NETWORK_CONSTRUCTIONS:
+        raise Exception("Unknown network construction {construction}, verify the configuration file (config.conf).".format(
+            construction=game_settings["network_construction"]))
+    network_seed = int(baseConfiguration["network_seed"]) if baseConfiguration.get("network_seed") else None
+    checkpoint_filename = baseConfiguration.get("checkpoint_file") or None
+    state = GameState(rlock, players_filename=baseConfiguration.get("players_database", "player_database.db"),
+        checkpoint_filename=checkpoint_filename, network_seed=network_seed, **game_settings)
+
+    def create_room(room_id, network_size):
+        # The rooms share the players of the default room and send their events through its publisher
+        room_checkpoint_filename = None
+        if checkpoint_filename is not None:
+            base, extension = os.path.splitext(checkpoint_filename)
+            room_checkpoint_filename = "{base}-room{room_id}{extension}".format(base=base, room_id=room_id, extension=extension)
+        # Every room its own network, reproducible as well when the seed is configured
+        room_seed = network_seed + room_id if network_seed is not None else None
+        return GameState(RLock(), network_size=network_size, room_id=room_id, player_store=state.player_manager.player_list,
+            event_sender=state.send_event, checkpoint_filename=room_checkpoint_filename, network_seed=room_seed, **game_settings)
+
+    rooms = RoomManager(state, create_room, maximum_rooms=int(baseConfiguration.get("rooms_maximum", 16)),
+        maximum_network_size=int(baseConfiguration.get("room_network_size_maximum", 200000)),
+        maximum_players=int(baseConfiguration.get("room_players_maximum", 0)))
+    for room_definition in filter(None, baseConfiguration.get("rooms", "").split(",")):
+        room_id, network_size = map(int, room_definition.split(":"))
+        if rooms.registry.define(room_id, network_size) != RoomStatus.CREATED:
+            raise Exception("Room {room} cannot be created, verify the configuration file (config.conf).".format(room=room_definition))
 
     # Create the server, binding to all interfaces on port 5481
-    server = SocketServer.ThreadingTCPServer((HOST, PORT), VirusGameTCPHandler)
-    server.rlock = rlock
-    server.state = state
+    if server_engine == "threaded":
+        server = SocketServer.ThreadingTCPServer((HOST, PORT), VirusGameTCPHandler)
+        server.rooms = rooms
+    elif server_engine == "event_loop":
+        server = VirusGameEventLoopServer((HOST, PORT), rooms)
+    elif server_engine == "multiprocess":
+        server = VirusGameMultiprocessServer((HOST, PORT), rooms, int(baseConfiguration.get("server_workers", multiprocessing.cpu_count())))
+    else:
+        raise Exception("Unknown server engine {engine}, verify the configuration file (config.conf).".format(engine=server_engine))
 
     game_events.info("Configurating network system and game system...")
     network_events.info("Configurating network system and game system...")
@@ -459,12 +3282,21 @@ if __name__ == "__main__":
 
     # Activate the server; this will keep running until you
     # interrupt the program with Ctrl-C
-    network_events.info("Server is now listening on {host}:{port}.".format(host=HOST, port=PORT))
+    network_events.info(LogMessage("Server is now listening on {host}:{port}.", host=HOST, port=PORT))
+    # Being terminated must still write the last checkpoint
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if server_engine != "multiprocess":
+        state.scheduler.start()
+        rooms.open_served()
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         game_events.info("Game has ended.")
         network_events.info("Server has stopped to serve.")
         api_events.info("API is now disabled.")
+    finally:
+        rooms.stop()
+        state.stop()
+        log_writer.stop()
 
     
\ No newline at end of file
@@ -0,0 +1,560 @@
+"""
+Headless games for the study of infection strategies: no sockets, no locks, no events and no logging.
+
+A Simulation plays the rules of GameState on a Network built by the server: every step, each player
+sends a batch of codes chosen by its strategy to random computers, the whole step is evaluated at once
+against the compiled predicat tables, then the computers change owner. A player owning every computer has
+its batch refused (MAXIMUM_INFECTION). Network randomizations (AV detection) start every randomization_period
+steps and sweep the network one slice of randomization_slice computers per step, as the world events of the server.
+A game is seeded: the same seed, sizes and strategies give the same game. With numpy the steps are vectorized,
+without it the same rules run in plain Python (much slower, and not the same game for a given seed).
+
+Sweeps over network sizes and difficulties run one game per task in a process pool:
+    python simulation.py --sizes 2000 200000 --difficulties 1 2 --players 8 --steps 500 --strategies adaptive random
+The rules are checked against the server by replaying seeded games through GameState, along with the networks
+(a bulk construction in a pool of processes, lazy networks randomized while other threads read them):
+    python simulation.py --check --sizes 2000 --difficulties 1 2 --steps 20 --randomization-period 5
+"""
+import argparse
+import bisect
+import itertools
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from threading import Event, RLock, Thread
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import server
+from server import GAME_PATTERN_LENGTH, GAME_PATTERN_SPACE, GAME_PREDICAT_LEVEL, AV_DETECTION_CHANCE, WORLD_SLICE_SIZE, Network
+from server import GameState, PlayerStore, NetworkValueState, NETWORK_CHUNK_SIZE, UNDRAWN_SYSTEM
+
+# Owner of a computer nobody owns
+FREE = -1
+# Codes sent by every player in one step
+DEFAULT_BATCH = 256
+# Letters checked by the computers: the first one and the last SUFFIX_LENGTH (the client strategies learn the same parts)
+SUFFIX_LENGTH = 3
+PREFIX_SHIFT = 2 * (GAME_PATTERN_LENGTH - 1)
+MIDDLE_SHIFT = 2 * SUFFIX_LENGTH
+MIDDLE_SPACE = 4 ** (GAME_PATTERN_LENGTH - 1 - SUFFIX_LENGTH)
+PREFIX_COUNT = 4
+SUFFIX_COUNT = 4 ** SUFFIX_LENGTH
+# Exponent of the sampled success rates, as in the adaptive mutation of the client
+SAMPLING_SHARPNESS = 3
+
+
+def create_rng(seed):
+    return numpy.random.RandomState(seed) if numpy is not None else random.Random(seed)
+
+
+# STRATEGIES
+class RandomStrategy(object):
+    """
+    Uniform random codes. A strategy returns the codes of a step with codes(count) (a numpy array when numpy
+    is installed, a list otherwise) and is then given their results with record(codes, successes).
+    """
+    name = 'random'
+
+    def __init__(self, seed):
+        self.rng = create_rng(seed)
+
+    def codes(self, count):
+        if numpy is not None:
+            return self.rng.randint(0, GAME_PATTERN_SPACE, count)
+        return [self.rng.randrange(GAME_PATTERN_SPACE) for x in xrange(count)]
+
+    def record(self, codes, successes):
+        pass
+
+
+class AdaptiveStrategy(RandomStrategy):
+    """
+    The adaptive mutation of the client, one step at a time: a success rate is drawn for each first letter
+    and each suffix from its Beta posterior, then the parts of the codes of the step are picked in proportion
+    to their drawn rate (raised to SAMPLING_SHARPNESS); the letters in between stay random.
+    """
+    name = 'adaptive'
+
+    def __init__(self, seed):
+        RandomStrategy.__init__(self, seed)
+        # successes and failures per first letter and per suffix
+        if numpy is not None:
+            self.prefix_results = numpy.zeros((2, PREFIX_COUNT), numpy.int64)
+            self.suffix_results = numpy.zeros((2, SUFFIX_COUNT), numpy.int64)
+        else:
+            self.prefix_results = [[0] * PREFIX_COUNT, [0] * PREFIX_COUNT]
+            self.suffix_results = [[0] * SUFFIX_COUNT, [0] * SUFFIX_COUNT]
+
+    def sample(self, results, count):
+        if numpy is not None:
+            weights = self.rng.beta(results[0] + 1, results[1] + 1) ** SAMPLING_SHARPNESS
+            return self.rng.choice(len(weights), count, p=weights / weights.sum())
+        weights = [self.rng.betavariate(successes + 1, failures + 1) ** SAMPLING_SHARPNESS for successes, failures in zip(*results)]
+        cumulated = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            cumulated.append(total)
+        return [min(bisect.bisect(cumulated, self.rng.random() * cumulated[-1]), len(weights) - 1) for x in xrange(count)]
+
+    def codes(self, count):
+        prefixes = self.sample(self.prefix_results, count)
+        suffixes = self.sample(self.suffix_results, count)
+        if numpy is not None:
+            return (prefixes << PREFIX_SHIFT) | (self.rng.randint(0, MIDDLE_SPACE, count) << MIDDLE_SHIFT) | suffixes
+        return [(prefix << PREFIX_SHIFT) | (self.rng.randrange(MIDDLE_SPACE) << MIDDLE_SHIFT) | suffix for prefix, suffix in zip(prefixes, suffixes)]
+
+    def record(self, codes, successes):
+        if numpy is not None:
+            prefixes = codes >> PREFIX_SHIFT
+            suffixes = codes & (SUFFIX_COUNT - 1)
+            for outcome, selected in enumerate((successes, ~successes)):
+                self.prefix_results[outcome] += numpy.bincount(prefixes[selected], minlength=PREFIX_COUNT)
+                self.suffix_results[outcome] += numpy.bincount(suffixes[selected], minlength=SUFFIX_COUNT)
+            return
+        for code, success in zip(codes, successes):
+            outcome = 0 if success else 1
+            self.prefix_results[outcome][code >> PREFIX_SHIFT] += 1
+            self.suffix_results[outcome][code & (SUFFIX_COUNT - 1)] += 1
+
+
+class MutationStrategy(RandomStrategy):
+    """
+    Plays a mutation strategy of the client (next_code and record of one pattern at a time), for the
+    strategies written for real games. Much slower: the codes are generated one by one, from the random module.
+    """
+
+    def __init__(self, seed, mutation):
+        RandomStrategy.__init__(self, seed)
+        self.mutation = mutation
+        self.name = type(mutation).__name__
+
+    def codes(self, count):
+        codes = [server.encode_pattern(self.mutation.next_code()) for x in xrange(count)]
+        return numpy.array(codes) if numpy is not None else codes
+
+    def record(self, codes, successes):
+        for code, success in zip(codes, successes):
+            self.mutation.record(server.decode_pattern(code), bool(success))
+
+
+STRATEGIES = {'random': RandomStrategy, 'adaptive': AdaptiveStrategy}
+
+
+# GAMES
+class Simulation(object):
+    """
+    Game of len(strategies) players, player i playing strategies[i], on a random network of the given size and difficulty.
+    Within a step the requests reach the computers in a random order: the last successful infection of a computer decides
+    its owner. Scores are the number of computers owned, as in the server.
+    With trace set, the requests of every step (in their order of arrival) and the computers detected are kept in trace,
+    for check to replay them through GameState.
+    """
+
+    def __init__(self, size, difficulty, strategies, seed=0, batch=DEFAULT_BATCH, randomization_period=0, randomization_chance=AV_DETECTION_CHANCE,
+            randomization_slice=WORLD_SLICE_SIZE, trace=False):
+        self.size = size
+        self.difficulty = difficulty
+        self.batch = batch
+        self.randomization_period = randomization_period
+        self.randomization_chance = randomization_chance
+        self.randomization_slice = randomization_slice
+        # Next computer of the randomization in progress, None between two
+        self.randomization_position = None
+        seeds = random.Random(seed)
+        self.rng = create_rng(seeds.randrange(2**32))
+        self.strategies = [strategy(seeds.randrange(2**32)) if isinstance(strategy, type) else strategy for strategy in strategies]
+        self.trace = [] if trace else None
+
+        # The network is built by the server code, from a seed of the game
+        self.network_seed = seeds.randrange(2**32)
+        network = Network(size, None, None, shards=1, seed=self.network_seed, difficulty=difficulty)
+        network.construct_network('bulk')
+
+        # Acceptance tables of every system one after the other, each computer being the offset of its table
+        records = list(itertools.product(*[range(len(GAME_PREDICAT_LEVEL[level_idx])) for level_idx in range(self.difficulty)]))
+        self.records = records
+        self.systems_count = len(records)
+        system_ids = dict(itertools.izip(records, itertools.count()))
+        offsets = [system_ids[tuple(network.predicats[x:x + self.difficulty])] * GAME_PATTERN_SPACE
+            for x in xrange(0, size * self.difficulty, self.difficulty)]
+        tables = ''.join(str(network.systems[record].table) for record in records)
+        players = len(self.strategies)
+        if numpy is not None:
+            self.tables = numpy.frombuffer(tables, numpy.bool_)
+            self.offsets = numpy.array(offsets, numpy.int64)
+            self.owner = numpy.full(size, FREE, numpy.int32)
+            self.scores = numpy.zeros(players, numpy.int64)
+            self.successes = numpy.zeros(players, numpy.int64)
+            self.attempts = numpy.zeros(players, numpy.int64)
+        else:
+            self.tables = bytearray(tables)
+            self.offsets = offsets
+            self.owner = [FREE] * size
+            self.scores = [0] * players
+            self.successes = [0] * players
+            self.attempts = [0] * players
+        self.steps = 0
+        self.infections = 0
+        self.lost = 0
+
+    def run(self, steps):
+        """
+        Play steps steps, returns the seconds they took.
+        """
+        start = time.time()
+        step = self.step_numpy if numpy is not None else self.step_python
+        for x in xrange(steps):
+            if self.trace is not None:
+                self.trace.append(([], []))
+            step()
+            self.steps += 1
+            if self.randomization_period and self.steps % self.randomization_period == 0 and self.randomization_position is None:
+                self.randomization_position = 0
+            if self.randomization_position is not None:
+                end = min(self.size, self.randomization_position + self.randomization_slice)
+                self.randomize_network(self.randomization_position, end)
+                self.randomization_position = end if end < self.size else None
+        return time.time() - start
+
+    def step_numpy(self):
+        batch = self.batch
+        players = len(self.strategies)
+        # A player owning every computer is refused its batch
+        playing = self.scores < self.size
+        codes = numpy.concatenate([strategy.codes(batch) for strategy in self.strategies])
+        targets = self.rng.randint(0, self.size, len(codes))
+        successes = self.tables[self.offsets[targets] + codes] & numpy.repeat(playing, batch)
+        for player_id, strategy in enumerate(self.strategies):
+            if playing[player_id]:
+                strategy.record(codes[player_id * batch:(player_id + 1) * batch], successes[player_id * batch:(player_id + 1) * batch])
+        self.successes += successes.reshape(-1, batch).sum(axis=1)
+        self.attempts += playing * batch
+
+        won = numpy.flatnonzero(successes)
+        self.rng.shuffle(won)
+        if self.trace is not None:
+            failed = numpy.flatnonzero(~successes & numpy.repeat(playing, batch))
+            self.trace[-1][0].extend((int(idx // batch), int(targets[idx]), int(codes[idx]), bool(successes[idx]))
+                for idx in itertools.chain(failed, won))
+        # Last infection of every computer, in the order of arrival
+        won = won[::-1]
+        computers, last = numpy.unique(targets[won], return_index=True)
+        winners = (won[last] // batch).astype(numpy.int32)
+        previous = self.owner[computers]
+        changed = previous != winners
+        computers, winners, previous = computers[changed], winners[changed], previous[changed]
+        self.scores -= numpy.bincount(previous[previous != FREE], minlength=players)
+        self.scores += numpy.bincount(winners, minlength=players)
+        self.owner[computers] = winners
+        self.infections += len(computers)
+
+    def step_python(self):
+        batch = self.batch
+        tables, offsets, owner, scores = self.tables, self.offsets, self.owner, self.scores
+        requests = []
+        failed = []
+        playing = [score < self.size for score in scores]
+        for player_id, strategy in enumerate(self.strategies):
+            codes = strategy.codes(batch)
+            targets = [self.rng.randrange(self.size) for x in xrange(batch)]
+            if not playing[player_id]:
+                # A player owning every computer is refused its batch
+                continue
+            successes = [tables[offsets[c_id] + code] for c_id, code in zip(targets, codes)]
+            strategy.record(codes, successes)
+            self.successes[player_id] += sum(successes)
+            self.attempts[player_id] += batch
+            requests.extend((player_id, c_id, code) for c_id, code, success in zip(targets, codes, successes) if success)
+            if self.trace is not None:
+                failed.extend((player_id, c_id, code) for c_id, code, success in zip(targets, codes, successes) if not success)
+
+        self.rng.shuffle(requests)
+        if self.trace is not None:
+            self.trace[-1][0].extend([(player_id, c_id, code, False) for player_id, c_id, code in failed] +
+                [(player_id, c_id, code, True) for player_id, c_id, code in requests])
+        for player_id, c_id, code in requests:
+            previous = owner[c_id]
+            if previous != player_id:
+                if previous != FREE:
+                    scores[previous] -= 1
+                scores[player_id] += 1
+                owner[c_id] = player_id
+                self.infections += 1
+
+    def randomize_network(self, start=0, end=None):
+        """
+        AV detection over the computers start to end: each computer is triggered with randomization_chance,
+        gets a new system and is freed.
+        """
+        end = self.size if end is None else end
+        if numpy is not None:
+            triggered = start + numpy.flatnonzero(self.rng.random_sample(end - start) < self.randomization_chance)
+            systems = self.rng.randint(0, self.systems_count, len(triggered))
+            self.offsets[triggered] = systems * GAME_PATTERN_SPACE
+            lost = self.owner[triggered]
+            lost = lost[lost != FREE]
+            self.scores -= numpy.bincount(lost, minlength=len(self.strategies))
+            self.owner[triggered] = FREE
+            self.lost += len(lost)
+            if self.trace is not None:
+                self.trace[-1][1].extend(itertools.izip(triggered.tolist(), systems.tolist()))
+            return
+        for c_id in xrange(start, end):
+            if self.rng.random() < self.randomization_chance:
+                system = self.rng.randrange(self.systems_count)
+                self.offsets[c_id] = system * GAME_PATTERN_SPACE
+                if self.trace is not None:
+                    self.trace[-1][1].append((c_id, system))
+                if self.owner[c_id] != FREE:
+                    self.scores[self.owner[c_id]] -= 1
+                    self.owner[c_id] = FREE
+                    self.lost += 1
+
+    def summary(self):
+        return {
+            'steps': self.steps,
+            'attempts': int(sum(self.attempts)),
+            'infections': self.infections,
+            'lost': self.lost,
+            'strategies': [strategy.name for strategy in self.strategies],
+            'scores': [int(score) for score in self.scores],
+            'success_rates': [float(successes) / max(1, attempts) for successes, attempts in zip(self.successes, self.attempts)],
+        }
+
+
+# SWEEPS
+def play(params):
+    """
+    Play one game of a sweep, params being (size, difficulty, strategy names, seed, steps, batch, randomization period, randomization slice).
+    """
+    size, difficulty, names, seed, steps, batch, randomization_period, randomization_slice = params
+    simulation = Simulation(size, difficulty, [STRATEGIES[name] for name in names], seed, batch, randomization_period,
+        randomization_slice=randomization_slice)
+    elapsed = simulation.run(steps)
+    result = simulation.summary()
+    result.update(size=size, difficulty=difficulty, seed=seed, seconds=elapsed)
+    return result
+
+
+def sweep(sizes, difficulties, names, seeds=(0,), steps=100, batch=DEFAULT_BATCH, randomization_period=0, processes=None,
+        randomization_slice=WORLD_SLICE_SIZE):
+    """
+    Play a game for every network size, difficulty and seed in a pool of processes (one per CPU by default),
+    yields their summaries in order.
+    """
+    games = [(size, difficulty, tuple(names), seed, steps, batch, randomization_period, randomization_slice)
+        for size in sizes for difficulty in difficulties for seed in seeds]
+    if processes == 1:
+        for params in games:
+            yield play(params)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(play, games):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+# CHECKS
+CHECK_FIRST_PLAYER_ID = 10000
+
+
+def check(size, difficulty, names, seed=0, steps=20, batch=DEFAULT_BATCH, randomization_period=0, randomization_slice=WORLD_SLICE_SIZE):
+    """
+    Play a traced game and replay it through a GameState on the same network: every request is evaluated
+    by the predicat system of its computer and applied by GameState._apply_infection, every detected computer
+    is freed by Network.detect. Returns the mismatches of the results, owners and scores after every step (none
+    when the simulation plays the rules of the server).
+    """
+    simulation = Simulation(size, difficulty, [STRATEGIES[name] for name in names], seed, batch, randomization_period,
+        randomization_slice=randomization_slice, trace=True)
+    directory = tempfile.mkdtemp()
+    try:
+        text_filename = os.path.join(directory, 'players.data')
+        with open(text_filename, 'w') as f:
+            for idx in range(len(names)):
+                f.write("{player_id}:check-{idx}\n".format(player_id=CHECK_FIRST_PLAYER_ID + idx, idx=idx))
+        players_filename = os.path.join(directory, 'players.db')
+        PlayerStore.import_text(text_filename, players_filename).close()
+        game = GameState(RLock(), network_size=size, players_filename=players_filename, event_sender=lambda message: None,
+            network_construction='bulk', network_seed=simulation.network_seed, difficulty=difficulty)
+        try:
+            return replay(simulation, game, steps)
+        finally:
+            game.stop()
+            game.player_manager.player_list.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def replay(simulation, game, steps):
+    network = game.network
+    player_manager = game.player_manager
+    player_ids = [CHECK_FIRST_PLAYER_ID + idx for idx in range(len(simulation.strategies))]
+    mismatches = []
+    for step in xrange(steps):
+        refused = set(idx for idx, player_id in enumerate(player_ids) if player_manager.score(player_id) == network.size)
+        simulation.run(1)
+        requests, detected = simulation.trace[-1]
+        for idx, c_id, code, success in requests:
+            if idx in refused:
+                mismatches.append("step {step}: player {idx} played with every computer".format(step=step, idx=idx))
+                continue
+            pattern = server.decode_pattern(code)
+            with network.shard_lock(c_id):
+                result = game._apply_infection(player_ids[idx], player_manager.name(player_ids[idx]), pattern, c_id, network.state[c_id],
+                    network.predicat_system(c_id).eval_system(pattern))
+            if result != success:
+                mismatches.append("step {step}: {pattern} on computer {c_id} is {result} in the server".format(step=step, pattern=pattern,
+                    c_id=c_id, result=result))
+        for c_id, system in detected:
+            record = simulation.records[system]
+            with network.shard_lock(c_id):
+                for level_idx, predicat_idx in enumerate(record):
+                    network.predicats[c_id * network.difficulty + level_idx] = predicat_idx
+                network.detect(c_id)
+
+        owners = [NetworkValueState.COMPUTER_ALIVE if owner == FREE else player_ids[owner] for owner in simulation.owner]
+        if owners != list(network.state):
+            mismatches.append("step {step}: {count} owners differ".format(step=step,
+                count=sum(1 for owner, state in itertools.izip(owners, network.state) if owner != state)))
+        scores = [player_manager.score(player_id) for player_id in player_ids]
+        if scores != [int(score) for score in simulation.scores]:
+            mismatches.append("step {step}: scores {scores} in the server, {simulated} simulated".format(step=step, scores=scores,
+                simulated=[int(score) for score in simulation.scores]))
+    return mismatches
+
+
+def check_construction(difficulty, seed=0, processes=2):
+    """
+    Construct the same bulk network in this process and in a pool of processes, over several chunks (a single
+    chunk is never given to the pool). Returns the mismatches (none when the processes do not change the network).
+    """
+    size = 2 * NETWORK_CHUNK_SIZE + NETWORK_CHUNK_SIZE // 2
+    networks = []
+    for count in (0, processes):
+        network = Network(size, None, None, seed=seed, difficulty=difficulty)
+        network.construct_network('bulk', count)
+        networks.append(network)
+    if networks[0].predicats != networks[1].predicats:
+        return ["{count} computers differ with {processes} processes".format(processes=processes,
+            count=sum(1 for x in xrange(0, size * difficulty, difficulty) if networks[0].predicats[x:x + difficulty] != networks[1].predicats[x:x + difficulty]))]
+    return []
+
+
+def check_lazy_randomization(size, difficulty, seed=0, trials=20):
+    """
+    Randomize every computer of lazy networks while another thread reads them as batch infections do: the
+    drawn systems without any lock, then the computers not drawn yet under their shard lock. Returns the
+    mismatches: a read which failed, or predicats given by the randomization then overwritten by a lazy draw.
+    """
+    mismatches = []
+    check_interval = sys.getcheckinterval()
+    # The threads switch after every bytecode instruction
+    sys.setcheckinterval(1)
+    try:
+        for trial in xrange(trials):
+            network, reference = [Network(size, None, None, seed=seed + trial, difficulty=difficulty) for x in range(2)]
+            network.construct_network('lazy')
+            reference.construct_network('lazy')
+            random_state = random.getstate()
+            stop = Event()
+            errors = []
+            reader = Thread(target=read_computers, args=(network, random.Random(seed + trial), stop, errors))
+            reader.start()
+            try:
+                network.randomize_network(chance=1.0)
+            finally:
+                stop.set()
+                reader.join()
+            # The same randomization without any reader
+            random.setstate(random_state)
+            reference.randomize_network(chance=1.0)
+            mismatches.extend("trial {trial}: {error!r} while reading".format(trial=trial, error=error) for error in errors)
+            if network.predicats != reference.predicats:
+                mismatches.append("trial {trial}: {count} computers lost their new predicats".format(trial=trial,
+                    count=sum(1 for x in xrange(0, size * difficulty, difficulty) if network.predicats[x:x + difficulty] != reference.predicats[x:x + difficulty])))
+    finally:
+        sys.setcheckinterval(check_interval)
+    return mismatches
+
+
+def read_computers(network, rng, stop, errors):
+    try:
+        while not stop.is_set():
+            c_id = int(rng.random() * network.size)
+            network.drawn_system(c_id, UNDRAWN_SYSTEM)
+            with network.shard_lock(c_id):
+                network.predicat_system(c_id)
+    except Exception as e:
+        errors.append(e)
+
+
+def report(title, mismatches):
+    print "{title}: {result}".format(title=title, result="{count} mismatches".format(count=len(mismatches)) if mismatches else "ok")
+    for mismatch in mismatches[:10]:
+        print "    " + mismatch
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless games of infection strategies.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 200000], help="network sizes")
+    parser.add_argument('--difficulties', type=int, nargs='+', default=[1, 2], help="GAME_DIFFICULTY values")
+    parser.add_argument('--players', type=int, default=8)
+    parser.add_argument('--strategies', nargs='+', choices=sorted(STRATEGIES), default=['adaptive', 'random'],
+        help="strategies given to the players in turn")
+    parser.add_argument('--steps', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=DEFAULT_BATCH, help="codes sent by every player in one step")
+    parser.add_argument('--randomization-period', type=int, default=0, help="steps between two network randomizations (0 disables them)")
+    parser.add_argument('--randomization-slice', type=int, default=WORLD_SLICE_SIZE, help="computers randomized per step during a randomization")
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--processes', type=int, default=None, help="processes of the pool (one per CPU by default)")
+    parser.add_argument('--check', action='store_true', help="replay the games through GameState instead, and report where they differ")
+    args = parser.parse_args()
+
+    for difficulty in args.difficulties:
+        if not 1 <= difficulty <= len(GAME_PREDICAT_LEVEL):
+            parser.error("difficulties must be between 1 and {maximum}".format(maximum=len(GAME_PREDICAT_LEVEL)))
+    # Nothing is logged by the games, the construction of the networks included
+    logging.disable(logging.CRITICAL)
+
+    names = [args.strategies[x % len(args.strategies)] for x in range(args.players)]
+    if args.check:
+        passed = True
+        for difficulty, seed in itertools.product(args.difficulties, args.seeds):
+            passed &= report("difficulty {difficulty}  seed {seed}  bulk construction in processes".format(difficulty=difficulty, seed=seed),
+                check_construction(difficulty, seed))
+        for size, difficulty, seed in itertools.product(args.sizes, args.difficulties, args.seeds):
+            title = "size {size:>7}  difficulty {difficulty}  seed {seed}".format(size=size, difficulty=difficulty, seed=seed)
+            passed &= report(title + "  lazy randomization", check_lazy_randomization(size, difficulty, seed))
+            passed &= report(title + "  replay through GameState", check(size, difficulty, names, seed, args.steps, args.batch,
+                args.randomization_period, args.randomization_slice))
+        sys.exit(0 if passed else 1)
+
+    for result in sweep(args.sizes, args.difficulties, names, args.seeds, args.steps, args.batch, args.randomization_period, args.processes,
+            args.randomization_slice):
+        print "size {size:>7}  difficulty {difficulty}  seed {seed}: {attempts} attempts in {seconds:.2f} s, {rate:.0f} attempts/s, {infections} infections, {lost} lost".format(
+            rate=result['attempts'] / result['seconds'], **result)
+        totals = {}
+        for name, score, success_rate in zip(result['strategies'], result['scores'], result['success_rates']):
+            totals.setdefault(name, []).append((score, success_rate))
+        for name in sorted(totals):
+            scores = [score for score, success_rate in totals[name]]
+            print "    {name:<10} mean score {score:>9.1f}  success rate {rate:6.2%}".format(name=name, score=float(sum(scores)) / len(scores),
+                rate=sum(success_rate for score, success_rate in totals[name]) / len(scores))
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,23 @@ from gevent import Greenlet, sleep, event, queue
 
 from flask import Flask
 from flask import render_template
+from flask import request
 
-from flask.ext.socketio import SocketIO
+from flask.ext.socketio import SocketIO, emit
+from socketio import packet
 from json import dumps
+from collections import deque
 
-import zmq
+import os
+import struct
+import sys
+import time
+import zmq.green as zmq
+
+SERVER_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Server')
+sys.path.insert(0, SERVER_DIRECTORY)
+
+from event_archive import ArchiveReader
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '\x1234uaqz~{^@~\iazieojh'
@@ -16,55 +28,296 @@ context = zmq.Context()
 socketio = SocketIO(app)
 
 EVENT_PUBLISHER_PORT = 5488
+# Must match event_format in the server configuration: text or binary
+EVENT_FORMAT = 'text'
+# Room shown by the chart: the events of the rooms other than the default one (0) are prefixed with their room id
+EVENT_ROOM = 0
+EVENT_ROOM_HEADER = struct.Struct('!cH')
+
+# Binary frames: header (topic, format version, number of records) then fixed-width records
+EVENT_HEADER = struct.Struct('!cBH')
+EVENT_RECORDS = {
+	'C': struct.Struct('!Id'),
+	'N': struct.Struct('!H32s'),
+	'D': struct.Struct('!H32s'),
+	'I': struct.Struct('!HIdI8s'),
+	'L': struct.Struct('!HIdI'),
+}
+# Only the events shown by the chart are received
+SUBSCRIBED_EVENTS = {
+	'text': ['NETWORK_CONFIGURATION', 'NEW_PLAYER', 'INFECTION_OCCURRED', 'COMPUTER_LOST'],
+	'binary': ['C', 'N', 'I', 'L'],
+}
+
+# Infections are downsampled to the last score of every player per bucket of this many seconds
+DOWNSAMPLING_BUCKET = 0.5
+
+# Points kept per player for the clients joining during the game (the oldest ones are dropped)
+HISTORY_LENGTH = 512
+
+# Frames sent to the browsers per second, each one with every batch processed since the previous one
+FRAME_RATE = 5
+# Packets a browser may leave unsent in its socket before it is behind: its frames then wait in its own queue,
+# where the score updates are merged into the last point of every player, until it catches up.
+# A browser with more than CLIENT_QUEUE_LENGTH other events waiting is sent a new snapshot instead.
+CLIENT_BACKLOG = 8
+CLIENT_QUEUE_LENGTH = 64
+
+# Event archive of the room shown, read at startup to fill the history of the game in progress
+EVENT_ARCHIVE = os.path.join(SERVER_DIRECTORY, 'archive', 'room{room}'.format(room=EVENT_ROOM))
+
+network_configuration = {'net_size': 0, 'start_time': 0}
 
 queue_buffer = queue.Queue()
 processed_buffer = queue.Queue()
 
+class ChartState(object):
+	"""
+	What the chart currently shows: the network size and a bounded history of every player score.
+	A new client receives it as one snapshot, then only the deltas emitted after it.
+	"""
+
+	def __init__(self, history_length=HISTORY_LENGTH):
+		self.history_length = history_length
+		self.net_size = 0
+		self.players = {}
+		self.history = {}
+
+	def add_player(self, fields):
+		self.players[fields[0]] = fields[1]
+		if fields[0] not in self.history:
+			self.history[fields[0]] = deque([[0, 0]], maxlen=self.history_length)
+
+	def add_points(self, points):
+		for fields in points:
+			if fields[0] not in self.history:
+				self.add_player([fields[0], fields[0]])
+			self.history[fields[0]].append([int(float(fields[1])) - int(float(fields[2])), int(fields[3])])
+			self.net_size = int(fields[5])
+
+	def backfill(self, points):
+		# Players are named after their id until they connect again
+		for player_id, player_points in points.iteritems():
+			self.add_player([str(player_id), str(player_id)])
+			self.history[str(player_id)].extend(player_points)
+
+	def apply(self, e_type, items):
+		if e_type == 'new_player':
+			for fields in items:
+				self.add_player(fields)
+		elif e_type == 'infection_occurred':
+			self.add_points(items)
+		elif e_type == 'network_configuration':
+			self.net_size = int(items[-1][0])
+
+	def snapshot(self):
+		return {
+			'net_size': self.net_size,
+			'players': [[player_id, self.players[player_id], list(points)] for player_id, points in self.history.iteritems()],
+		}
+
+chart_state = ChartState()
+
+def encode_event(name, data):
+	# Socket.IO packet of an event of the default namespace, as queued on the socket of every client
+	return packet.encode({'type': 'event', 'name': name, 'args': [data], 'endpoint': ''})
+
+class ClientChannel(object):
+	"""
+	Frames of one browser which fell behind: the events other than the scores in order (at most queue_length),
+	and the last point of every player, which replaces the points it did not receive yet.
+	"""
+
+	def __init__(self, socket, queue_length=CLIENT_QUEUE_LENGTH):
+		self.socket = socket
+		self.queue_length = queue_length
+		self.events = deque()
+		self.points = {}
+		self.resync = False
+
+	def behind(self, backlog):
+		return self.socket.client_queue.qsize() > backlog
+
+	def send(self, frame, backlog):
+		if not self.events and not self.points and not self.resync and not self.behind(backlog):
+			for e_type, items, message in frame:
+				self.socket.put_client_msg(message)
+			return
+
+		for e_type, items, message in frame:
+			if e_type == 'infection_occurred':
+				for fields in items:
+					self.points[fields[0]] = fields
+			elif len(self.events) < self.queue_length:
+				self.events.append([e_type, items])
+			else:
+				self.resync = True
+		if self.behind(backlog):
+			return
+
+		if self.resync:
+			# Too much was missed: the current state of the chart replaces it
+			self.events.clear()
+			self.points = {}
+			self.resync = False
+			self.socket.put_client_msg(encode_event('chart_snapshot', dumps(chart_state.snapshot())))
+			return
+		for e_type, items in self.events:
+			self.socket.put_client_msg(encode_event(e_type + '_processed', dumps(items)))
+		self.events.clear()
+		if self.points:
+			points = sorted(self.points.values(), key=lambda fields: float(fields[1]))
+			self.socket.put_client_msg(encode_event('infection_occurred_processed', dumps(points)))
+			self.points = {}
+
+class Broadcaster(object):
+	"""
+	Sends the frames to every connected browser: each batch is serialized once, and the same packet is queued
+	on all the sockets. A browser reading slowly does not hold the others back, its frames wait in its channel.
+	"""
+
+	def __init__(self, backlog=CLIENT_BACKLOG, queue_length=CLIENT_QUEUE_LENGTH):
+		self.backlog = backlog
+		self.queue_length = queue_length
+		self.clients = {}
+
+	def add(self, socket):
+		self.clients[socket.sessid] = ClientChannel(socket, self.queue_length)
+
+	def remove(self, socket):
+		self.clients.pop(socket.sessid, None)
+
+	def broadcast(self, batches):
+		frame = [[e_type, items, encode_event(e_type + '_processed', dumps(items))] for e_type, items in batches]
+		for sessid, client in self.clients.items():
+			if not client.socket.connected:
+				del self.clients[sessid]
+			else:
+				client.send(frame, self.backlog)
+
+broadcaster = Broadcaster()
+
+def merge_batches(batches):
+	# Consecutive batches of the same event type are sent as one
+	merged = []
+	for e_type, items in batches:
+		if merged and merged[-1][0] == e_type:
+			merged[-1][1].extend(items)
+		else:
+			merged.append([e_type, list(items)])
+	return merged
+
 def worker_emitter():
-	for item in processed_buffer:
-		sleep(0.2)
-		socketio.emit(item[0] + '_processed', dumps(item[1]))
+	frame_interval = 1.0 / FRAME_RATE
+	while True:
+		frame_start = time.time()
+		batches = []
+		while not processed_buffer.empty():
+			batches.append(processed_buffer.get_nowait())
+		if batches:
+			batches = merge_batches(batches)
+			# Updated right before the emission: a snapshot never contains a delta the client will receive again
+			for e_type, items in batches:
+				chart_state.apply(e_type, items)
+			broadcaster.broadcast(batches)
+		sleep(max(0, frame_interval - (time.time() - frame_start)))
+
+class ScoreDownsampler(object):
+	"""
+	Keeps only the last infection of every player during a bucket: the chart receives
+	at most one point per player per bucket, whatever the number of infections per second.
+	"""
+
+	def __init__(self):
+		self.last_infections = {}
+
+	def add(self, fields):
+		self.last_infections[fields[0]] = fields
+
+	def flush(self):
+		points = sorted(self.last_infections.values(), key=lambda fields: float(fields[1]))
+		self.last_infections = {}
+		return points
 
 def worker_processor():
+	downsampler = ScoreDownsampler()
+	pending = {}
+	next_flush = time.time() + DOWNSAMPLING_BUCKET
 	while True:
-		tmp_queue = {}
-		count_item = 0
-		for item in queue_buffer:
-			if item[0] not in tmp_queue:
-				tmp_queue[item[0]] = []
-
-			tmp_queue[item[0]] += [item[1]]
-			count_item += 1
-
-			if count_item > 125:
-				count_item = 0
-				for key, item in tmp_queue.items():
-					processed_buffer.put([key, item])
-				tmp_queue.clear()
-		# Flush anyway
-		for key, item in tmp_queue.items():
-			processed_buffer.put([key, item])
-			tmp_queue.clear()
+		try:
+			e_type, fields = queue_buffer.get(timeout=max(0, next_flush - time.time()))
+			# A lost computer is one more point of the score of its player
+			if e_type in ('infection_occurred', 'computer_lost'):
+				downsampler.add(fields)
+			else:
+				pending.setdefault(e_type, []).append(fields)
+		except queue.Empty:
+			pass
+
+		if time.time() >= next_flush:
+			# Other events first: the series of a new player must exist before its points
+			for e_type, items in pending.items():
+				processed_buffer.put([e_type, items])
+			pending = {}
+			points = downsampler.flush()
+			if points:
+				processed_buffer.put(['infection_occurred', points])
+			next_flush = time.time() + DOWNSAMPLING_BUCKET
+
 
+def decode_event(message):
+	"""
+	Turn a published message into [event type, fields] items, the fields being those of the text format.
+	"""
+	if EVENT_FORMAT == 'text':
+		data = message.split(" ")
+		return [[data[0].lower(), data[1:]]]
+
+	topic, version, count = EVENT_HEADER.unpack_from(message)
+	record = EVENT_RECORDS[topic]
+	items = []
+	for idx in range(count):
+		fields = record.unpack_from(message, EVENT_HEADER.size + idx * record.size)
+		if topic == 'C':
+			network_configuration['net_size'], network_configuration['start_time'] = fields
+			items.append(['network_configuration', [str(fields[0])]])
+		elif topic == 'N':
+			items.append(['new_player', [str(fields[0]), fields[1].rstrip('\0')]])
+		elif topic == 'D':
+			items.append(['player_disconnection', [str(fields[0]), fields[1].rstrip('\0')]])
+		elif topic == 'I':
+			player_id, computer_id, timestamp, score, pattern = fields
+			items.append(['infection_occurred', [str(player_id), str(timestamp), str(network_configuration['start_time']), str(score),
+				pattern.rstrip('\0'), str(network_configuration['net_size'])]])
+		elif topic == 'L':
+			player_id, computer_id, timestamp, score = fields
+			items.append(['computer_lost', [str(player_id), str(timestamp), str(network_configuration['start_time']), str(score),
+				str(computer_id), str(network_configuration['net_size'])]])
+	return items
+
+def room_prefix(room):
+	if room == 0:
+		return ''
+	elif EVENT_FORMAT == 'text':
+		return 'ROOM {room} '.format(room=room)
+	return EVENT_ROOM_HEADER.pack('R', room)
 
 def background_thread():
 	z_socket = context.socket(zmq.SUB)
 	z_socket.bind("tcp://127.0.0.1:{port}".format(port=EVENT_PUBLISHER_PORT))
-	z_socket.setsockopt(zmq.SUBSCRIBE, '')
+	prefix = room_prefix(EVENT_ROOM)
+	for event_prefix in SUBSCRIBED_EVENTS[EVENT_FORMAT]:
+		z_socket.setsockopt(zmq.SUBSCRIBE, prefix + event_prefix)
 
 	print 'Connecting through the TCP system...'
 	while True:
+		# zmq.green makes this receive yield to the other greenlets until a message arrives
+		string = z_socket.recv()[len(prefix):]
 		try:
-			string = z_socket.recv(zmq.NOBLOCK)
-			data = string.split(" ")
-
-			e_type = data[0].lower()
-
-			item = [e_type, data[1:]]
-			queue_buffer.put(item)
-		except:
-			queue_buffer.put(StopIteration)
-			sleep(1)
+			for item in decode_event(string):
+				queue_buffer.put(item)
+		except Exception as e:
+			print 'Failed to decode an event: {error}'.format(error=repr(e))
 
 background_thread_spawned = False
 
@@ -77,6 +330,12 @@ def handle_connection():
 		Greenlet.spawn(worker_emitter)
 		Greenlet.spawn(worker_processor)
 		print 'Realtime thread spawned and workers spawned.'
+	emit('chart_snapshot', dumps(chart_state.snapshot()))
+	broadcaster.add(request.namespace.socket)
+
+@socketio.on('disconnect')
+def handle_disconnection():
+	broadcaster.remove(request.namespace.socket)
 
 @socketio.on_error()
 def error_handler(e):
@@ -87,4 +346,9 @@ def show_realtime_chart():
 	return render_template('realtime_chart.html')
 
 if __name__ == '__main__':
+	if os.path.isdir(EVENT_ARCHIVE):
+		history = ArchiveReader(EVENT_ARCHIVE).chart_history(HISTORY_LENGTH)
+		if history is not None:
+			chart_state.backfill(history[1])
+			print 'Chart history filled from {archive}.'.format(archive=EVENT_ARCHIVE)
 	socketio.run(app, host='0.0.0.0', port=5462)
\ No newline at end of file